@@ -5,14 +5,8 @@ import shutil
 import time
 import datetime
 import pandas as pd
-import glob
-import json
-import mammoth # for word doc to html conversion
-import io
-import matplotlib.pyplot as plt
-from main import process_file_with_ai, add_entry_to_index, get_file_type, DocumentClassificationResult # Import backend functions
-from PIL import Image
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from main import tail_lines, compressed_log, todays_log_files, work_queue, BackgroundProcessor, persist_upload, preview_cache, PREVIEW_PREFETCH, preclassifier_report, add_entry_to_index, IndexAggregator, CONFIDENCE_BINS, result_cache, search_index, load_metrics, METRICS_PROM_PATH, get_file_type, DocumentClassificationResult # Import backend functions
 
 # --- Configuration ---
 INPUT_FOLDER = "./temp_dir"
@@ -30,7 +24,8 @@ st.title("Document Classification System")
 # --- Function to get file list ---
 def get_files_to_process(folder):
     # check the returned list of items from listdir to ensure they are files and not directories.
-    files = [f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f))]
+    # hidden files are uploads still being written
+    files = [f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f)) and not f.startswith(".")]
     #### Alternate method ######
     # for f in os.listdir(folder):
     # full_path = os.path.join(folder, f)
@@ -38,12 +33,55 @@ def get_files_to_process(folder):
     #     files.append(f)
     return files
 
+# --- The gzipped full log, only built when the download button is clicked (Streamlit calls this off the script thread) ---
+def read_compressed_log(log_path):
+    with open(compressed_log(log_path), "rb") as f:
+        return f.read()
+
+# --- Analytics aggregation kept across reruns and sessions so each rerun only reads newly indexed lines ---
+@st.cache_resource
+def get_index_aggregator():
+    return IndexAggregator(OUTPUT_DIR, categories=["Memberdoc", "Loans", "Statements"])
+
+# --- Uploads are saved and queued off the UI thread, one pool shared by every session ---
+@st.cache_resource
+def get_upload_executor():
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="upload")
+
+# --- One background queue drainer per app process, every session sees and controls the same run ---
+@st.cache_resource
+def get_background_processor():
+    return BackgroundProcessor(EXCEPTION_FOLDER)
+
+# --- Live status, polled from the work queue every couple of seconds without rerunning the whole page ---
+@st.fragment(run_every=2)
+def show_processing_status(processor):
+    status = processor.status()
+    counts = status["counts"]
+    st.progress(status["progress"])
+    eta = "n/a" if status["eta_seconds"] is None else str(datetime.timedelta(seconds=round(status["eta_seconds"])))
+    state = "Paused" if status["paused"] else ("Running" if status["running"] else "Idle")
+    st.text(f"{state}. {status['finished']} finished this run, {status['remaining']} remaining "
+            f"(pending {counts['pending']}, running {counts['running']}). "
+            f"Throughput {status['docs_per_sec']:.2f} docs/sec, ETA {eta}.")
+    if status["last_result"]:
+        filename, success, message = status["last_result"]
+        st.caption(f"Last file: {filename} - {message}")
+    if status["error"]:
+        st.error(f"Processing stopped: {status['error']}")
+    jobs = work_queue.recent_jobs(limit=50)
+    if jobs:
+        df_jobs = pd.DataFrame(jobs)
+        df_jobs["updated_at"] = pd.to_datetime(df_jobs["updated_at"], unit="s")
+        st.dataframe(df_jobs, width='stretch', hide_index=True)
+
 # --- Tab Navigation ---
-tab1, tab2, tab3, tab4 = st.tabs([
+tab1, tab2, tab3, tab4, tab5 = st.tabs([
     "Process Documents", 
     "Review Exceptions", 
     "Analytics Dashboard", 
-    "System Logs"
+    "System Logs",
+    "Search Documents"
 ])
 
 ############ Tab 1: Process Documents   ############
@@ -61,53 +99,44 @@ with tab1:
         type=['png', 'jpg', 'jpeg', 'pdf', 'docx', 'tif', 'tiff']
         )
 
-        ######### Process the files
+        ######### Save and queue the files
     if uploaded_files:
-        st.info(f"Loaded {len(uploaded_files)} files for processing.")
-        
+        # each upload is handed to the background saver once per session, reruns (e.g. switching tabs) don't write it again.
+        # Streamlit keeps every uploaded file in memory for the session anyway, saving only moves the disk write off the rerun
+        saved_uploads = st.session_state.setdefault("saved_uploads", {})
         for uploaded_file in uploaded_files:
-            # Streamlit provides the file name and content (bytes)
-            filename = uploaded_file.name
-            
-            # Save a temporary copy because UnstructuredLoader/Pillow often need a path
-            temp_path = os.path.join("temp_dir", filename)
-            if not os.path.exists("temp_dir"):
-                os.makedirs("temp_dir")
-                
-            with open(temp_path, "wb") as f:
-                f.write(uploaded_file.getbuffer())
+            upload_key = getattr(uploaded_file, "file_id", None) or (uploaded_file.name, uploaded_file.size)
+            if upload_key not in saved_uploads:
+                saved_uploads[upload_key] = (uploaded_file.name, get_upload_executor().submit(persist_upload, uploaded_file, uploaded_file.name, INPUT_FOLDER))
 
-    selected_folder = "temp_dir"
+        still_saving = sum(1 for _, future in saved_uploads.values() if not future.done())
+        st.info(f"Loaded {len(uploaded_files)} files for processing." + (f" Saving {still_saving} in the background..." if still_saving else ""))
+        for filename, future in saved_uploads.values():
+            if future.done() and future.exception() is not None:
+                st.error(f"Could not save {filename}: {future.exception()}")
 
-    files_list = get_files_to_process(selected_folder)
-    initial_file_count = len(files_list)
+    selected_folder = "temp_dir"
 
-    if st.button("Start Processing"):
-        if not files_list:
+    # Processing runs in the background, reruns and other sessions only poll its status
+    processor = get_background_processor()
+    col_start, col_pause, col_cancel, col_requeue = st.columns(4)
+    if col_start.button("Start Processing", disabled=processor.running):
+        # Queue the files (already queued ones are skipped) so an interrupted run picks up where it stopped
+        work_queue.enqueue_folder(selected_folder)
+        if not work_queue.counts()["pending"]:
             st.warning("No files found in the input folder.")
         else:
-            start_time = time.time()
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            
-            for i, filename in enumerate(files_list): # Enumerate captures index to use for progress tracking
-                filepath = os.path.join(selected_folder, filename)
-                
-                # Call main functions to process file
-                success, message = process_file_with_ai(filepath, filename, EXCEPTION_FOLDER)
-                
-                # Show status and count remaining
-                status_text.text(f"Processing file {i+1}/{initial_file_count}: {filename} - Status: {message}")
-                
-                # Update progress bar
-                progress = (i + 1) / initial_file_count
-                progress_bar.progress(progress)
-            
-            end_time = time.time()
-            duration = end_time - start_time
-            # 8d. Estimate time (simple average)
-            st.success(f"Processing complete! Total time: {duration:.2f}s. Average time per file: {duration/initial_file_count:.2f}s.")
-            status_text.text("Idle.")
+            processor.start()
+    paused = work_queue.is_paused()
+    if col_pause.button("Resume" if paused else "Pause"):
+        work_queue.set_paused(not paused)
+        st.rerun()
+    if col_cancel.button("Cancel"):
+        st.info(f"Cancelled {processor.cancel()} pending file(s), files already in progress will finish. Cancelled files stay in the input folder until requeued.")
+    if col_requeue.button("Requeue Cancelled"):
+        st.info(f"Requeued {work_queue.requeue_cancelled()} cancelled file(s), press Start Processing to run them.")
+
+    show_processing_status(processor)
 
 
 
@@ -144,6 +173,10 @@ with tab2:
         # Display the image to the user
         with col1:
             st.subheader(f"Reviewing {st.session_state.exception_index + 1} of {len(exception_files)}")
+
+            # render the next few in the background so "Skip to Next Document" shows them instantly
+            upcoming = [exception_files[(st.session_state.exception_index + offset) % len(exception_files)] for offset in range(1, PREVIEW_PREFETCH + 1)]
+            preview_cache.prefetch([os.path.join(EXCEPTION_FOLDER, filename) for filename in dict.fromkeys(upcoming) if filename != current_file])
             try:
                 
                 #add logic here to determine how to handle file based on type
@@ -151,65 +184,25 @@ with tab2:
                 mime_type = get_file_type(file_path)
 
                 # compare mimetype then execute the appropriate display flow
-                if mime_type == "image/png" :
-                    with st.container (height=600):
-                        file_image =Image.open(file_path)
-                        try:
-                            st.image(file_image, caption="PNG Image", width='stretch')
-                        except Exception:
-                            st.warning("Cannot display this file  PNG type.")
-                elif mime_type == "application/pdf":
+                if mime_type == "application/pdf":
                     try:
                         with st.container(height=600):
                             pdf_viewer(file_path, zoom_level=1.2)
                     except Exception:
                             st.warning("Cannot display this file PDF type.")
-                elif mime_type =="application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-                    with st.container (height=600):
-                        try:
-                            # Use mammoth to convert the docx to html
-                            with open(file_path,"rb") as docx_file:
-                                result = mammoth.convert_to_html(docx_file)
-                                
-                                #display the markdown content.
-                                st.markdown(result.value, unsafe_allow_html=True)
-                        except Exception:
-                            st.warning("Cannot display this file Word Docx.")
-                elif mime_type == "image/jpeg":
-                    with st.container (height=600):
-                        file_image =Image.open(file_path)
-                        try:
-                            st.image(file_image, caption="JPEG Image", width='stretch')
-                        except Exception:
-                            st.warning(f"Cannot display this file JPEG/TIFF type. --> {file_path}.")
-                elif mime_type == "image/tiff":
-                        with st.container (height=600):
-                            try:
-                                # 1. Open with Pillow
-                                img = Image.open(file_path)
-                                
-                                # 2. Check if it's 16-bit (mode 'I;16')
-                                if img.mode == 'I;16':
-                                    # Convert to numpy to normalize the data
-                                    img_array = np.array(img)
-                                    
-                                    # Normalize 16-bit (0-65535) to 8-bit (0-255)
-                                    # This prevents the image from appearing completely black or white
-                                    img_8bit = (img_array / 256).astype('uint8')
-                                    
-                                    # Convert back to a Pillow image in 'L' (Grayscale) or 'RGB' mode
-                                    img = Image.fromarray(img_8bit).convert("RGB")
-                                else:
-                                    # For other non-standard modes, a direct conversion often works
-                                    img = img.convert("RGB")
-                                    
-                                st.image(img, width='stretch')
-                                    
-                            except Exception as e:
-                                st.error(f"Failed to process TIFF: {e}")
-                                st.warning(f"Cannot display this file type. review the file manually at this path --> {file_path} .")
-            except:
-               st.error(f"Cannot display image located at {file_path}") 
+                else:
+                    # images, TIFF scans and Word documents come from the preview cache (WebP thumbnail / pre-rendered HTML)
+                    with st.container(height=600):
+                        preview = preview_cache.get(file_path, mime_type)
+                        if preview is None:
+                            st.warning(f"Cannot display this file type. review the file manually at this path --> {file_path} .")
+                        elif preview["kind"] == "html":
+                            with open(preview["path"], "r", encoding="utf-8") as f:
+                                st.markdown(f.read(), unsafe_allow_html=True)
+                        else:
+                            st.image(preview["path"], caption=mime_type, width='stretch')
+            except Exception as e:
+               st.error(f"Cannot display image located at {file_path}: {e}") 
        
         # The skip button
         st.button("Skip to Next Document ⏭️", on_click=next_exception)
@@ -250,7 +243,7 @@ with tab2:
                     shutil.move(file_path, final_file_loc) # Remove item from exceptions folder
 
                     manual_data.file_loc = final_file_loc
-                    add_entry_to_index(destination_folder, manual_data.model_dump()) # Add to index file
+                    add_entry_to_index(destination_folder, manual_data.model_dump(), label_source="manual") # Add to index file
 
                     st.success(f"Manually indexed and moved {file_path} to {manual_category}.")
                     st.rerun() # Refresh the page to show the next exception file
@@ -262,38 +255,46 @@ with tab2:
 with tab3:
     st.header("Processing Statistics")
     
-    # Using pandas to iterate through index and exception files
-    # Load all index files from all categories
-    all_records = []
-    for category in ["Memberdoc", "Loans", "Statements"]:
-        category_path = os.path.join(OUTPUT_DIR, category)
-        if os.path.exists(category_path):
-            for file in glob.glob(os.path.join(category_path, "*.jsonl")):
-                with open(file, 'r') as f:
-                    for line in f:
-                        all_records.append(json.loads(line))
-    
-    df_completed = pd.DataFrame(all_records)
+    # Fold only the index lines added since the last rerun into the running totals
+    index_summary = get_index_aggregator().refresh()
     
     # Count exceptions
     exception_count = len(get_files_to_process(EXCEPTION_FOLDER))
 
     st.subheader("Completion Status")
     
-    if not df_completed.empty:
-        total_processed = len(df_completed)
+    if index_summary["total"]:
+        total_processed = index_summary["total"]
         st.write(f"Total documents automatically processed: **{total_processed}**")
         st.write(f"Documents currently in exception folder: **{exception_count}**")
 
+        # duplicates answered from the content hash cache instead of OCR + gpt-4o
+        cache_stats = result_cache.stats()
+        st.write(f"Result cache: **{cache_stats['hits']}** hits / **{cache_stats['misses']}** misses ({cache_stats['hit_rate']*100:.1f}% hit rate, {cache_stats['entries']} cached documents)")
+
+        import matplotlib.pyplot as plt # only needed once there is something to chart, keeps the first page load fast
+
         # 10. Create a graph of the amount of documents completed per category
         st.subheader("Documents Processed Per Category (Automatic)")
-        category_counts = df_completed['category_name'].value_counts()
+        category_counts = pd.Series(index_summary["category_counts"]).sort_values(ascending=False)
         
         fig, ax = plt.subplots()
         category_counts.plot(kind='bar', ax=ax)
         ax.set_ylabel('Count')
         ax.set_title('Document Count by Category')
         st.pyplot(fig)
+
+        # confidence distribution per category
+        st.subheader("Confidence Score Distribution")
+        bin_labels = [f"{i/CONFIDENCE_BINS:.1f}-{(i+1)/CONFIDENCE_BINS:.1f}" for i in range(CONFIDENCE_BINS)]
+        confidence_df = pd.DataFrame(index_summary["confidence_histograms"], index=bin_labels)
+
+        fig, ax = plt.subplots()
+        confidence_df.plot(kind='bar', stacked=True, ax=ax)
+        ax.set_xlabel('Confidence Score')
+        ax.set_ylabel('Count')
+        ax.set_title('Confidence Score by Category')
+        st.pyplot(fig)
         
     else:
         st.info("No documents processed yet for analytics.")
@@ -301,27 +302,93 @@ with tab3:
 with tab4:
     st.header("System Logs & Debugging")
     
-    # Generate today's log filename (matches core_processor.py format)
-    log_filename = f"log_{datetime.date.today().strftime('%Y-%m-%d')}.log"
-    
-    if os.path.exists(log_filename):
+    # Today's log files: the dashboard's own, plus one per CLI worker (watch/process) since processes can't share a rotating file
+    log_files = todays_log_files()
+
+    if log_files:
+        log_filename = st.selectbox("Log file", log_files)
         st.subheader(f"Viewing: {log_filename}")
         
-        with open(log_filename, "r") as f:
-            # Read all lines from the log file
-            log_lines = f.readlines()
-            
-            # Show the last 100 lines for quick debugging
-            # st.code provides a scrollable, formatted view ideal for logs
-            st.code("".join(log_lines[-100:]), language="log")
+        # Show the last 100 lines for quick debugging, read backwards from the end so the log size doesn't matter
+        # st.code provides a scrollable, formatted view ideal for logs
+        st.code("\n".join(tail_lines(log_filename, 100)), language="log")
             
-        # Add a download button so you can save the log locally for full analysis
+        # The full log is only packaged when the download is clicked (gzip, built in chunks on disk), not on every rerun
+        st.caption(f"Full log size: {os.path.getsize(log_filename) / (1024 * 1024):,.1f} MB")
         st.download_button(
-            label="Download Full Log File",
-            data="".join(log_lines),
-            file_name=log_filename,
-            mime="text/plain"
+            label="Download Full Log File (gzip)",
+            data=lambda log_path=log_filename: read_compressed_log(log_path),
+            file_name=log_filename + ".gz",
+            mime="application/gzip"
         )
     else:
-        st.warning(f"No log file found for today ({log_filename}). Ensure processing has started.")
-    
\ No newline at end of file
+        st.warning("No log file found for today. Ensure processing has started.")
+
+    # Per stage timings exported by the pipeline after every batch
+    st.subheader("Pipeline Stage Timings")
+    metrics = load_metrics()
+    if metrics and metrics["stages"]:
+        st.caption(f"Last exported {metrics['generated_at']}, timings of {metrics.get('processes', 1)} process(es) combined, counters since the first run")
+        df_stages = pd.DataFrame(metrics["stages"])
+        mime_filter = st.selectbox("Mime type", ["All"] + sorted(df_stages["mime_type"].unique()))
+        if mime_filter != "All":
+            df_stages = df_stages[df_stages["mime_type"] == mime_filter]
+        st.dataframe(df_stages.round(1), width='stretch', hide_index=True)
+
+        if metrics["counters"]:
+            st.write(" | ".join(f"{name}: **{value:,}**" for name, value in sorted(metrics["counters"].items())))
+
+        if metrics["counters"].get("preclassifier_accepted_total") or metrics["counters"].get("preclassifier_escalated_total"):
+            # local first pass classifier: how many gpt-4o calls it saved and how often it agrees with gpt-4o
+            report = preclassifier_report(metrics["counters"])
+            col1, col2, col3 = st.columns(3)
+            col1.metric("LLM calls saved", f"{report['llm_calls_saved']:,}", f"{report['share_saved']:.0%} of documents")
+            col2.metric("Agreement with LLM", "n/a" if report["agreement"] is None else f"{report['agreement']:.1%}", f"{report['compared']:,} compared")
+            col3.metric("Audit agreement", "n/a" if report["audit_agreement"] is None else f"{report['audit_agreement']:.1%}", f"{report['audited']:,} audited")
+
+        if os.path.exists(METRICS_PROM_PATH):
+            with st.expander("Prometheus format"):
+                with open(METRICS_PROM_PATH, "r") as f:
+                    st.code(f.read(), language="text")
+    else:
+        st.info("No pipeline timings recorded yet. They are exported after each processing run.")
+    
+
+
+
+############ Tab 5: Search Documents  ############
+
+with tab5:
+    st.header("Member Document Lookup")
+    st.write(f"Searching **{search_index.count()}** indexed documents.")
+
+    with st.form("search_form"):
+        search_col1, search_col2, search_col3 = st.columns(3)
+        with search_col1:
+            search_member_number = st.text_input("Member Number", "")
+            search_member_name = st.text_input("Member Name (starts with)", "")
+        with search_col2:
+            search_category = st.selectbox("Category", ["All", "Memberdoc", "Loans", "Statements"])
+            search_text = st.text_input("Text in document", "")
+        with search_col3:
+            search_date_from = st.text_input("Date from (YYYY-MM-DD)", "")
+            search_date_to = st.text_input("Date to (YYYY-MM-DD)", "")
+        search_submitted = st.form_submit_button("Search")
+
+    if search_submitted:
+        start_time = time.time()
+        search_results = search_index.search(
+            member_number=search_member_number or None,
+            member_name=search_member_name or None,
+            category_name=None if search_category == "All" else search_category,
+            date_from=search_date_from or None,
+            date_to=search_date_to or None,
+            text=search_text or None
+        )
+        duration = time.time() - start_time
+
+        if search_results:
+            st.success(f"Found {len(search_results)} documents in {duration*1000:.0f} ms.")
+            st.dataframe(pd.DataFrame(search_results).drop(columns=["id", "doc_date_iso"]), width='stretch', hide_index=True)
+        else:
+            st.info("No documents match this search.")
@@ -0,0 +1,485 @@
+""" Benchmarks for the document classification pipeline, run from the repo root:
+
+    python benchmark.py extraction --repeat 3
+    python benchmark.py pipeline --copies 20 --llm-latency 0.5 --baseline benchmark_baseline.json
+    python benchmark.py ratelimit --requests 200 --fail-fraction 0.3
+    python benchmark.py imports --baseline import_baseline.json --history import_times.jsonl
+
+uses the sample documents in exceptions/ and classified_output/ so no uploads are needed. The pipeline benchmark
+runs fully offline: the LLM is replaced by a deterministic fake and everything is written to a temp folder.
+The ratelimit check points the real ChatOpenAI client at a local stub server that answers with 429s.
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import tempfile
+import statistics
+import threading
+import subprocess
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import main
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+SAMPLE_FOLDERS = ["./exceptions", "./classified_output"]
+SKIP_SUFFIXES = (".jsonl", ".json", ".parquet", ".tmp", ".lock")
+
+##################   Sample Documents ##################
+
+def find_sample_documents(folders=SAMPLE_FOLDERS):
+    """All the sample documents in the repo (index shards, manifests and lock files are skipped)."""
+    documents = []
+    for folder in folders:
+        for root, dirs, files in os.walk(folder):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in sorted(files):
+                if not name.startswith(".") and not name.endswith(SKIP_SUFFIXES):
+                    documents.append(os.path.join(root, name))
+    return documents
+
+def time_call(func, repeat):
+    """Median wall clock milliseconds of func() over repeat runs, or None if it raised."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            func()
+        except Exception as e:
+            print(f"    failed: {str(e)[:100]}", file=sys.stderr)
+            return None
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+def format_ms(value):
+    return "n/a" if value is None else f"{value:,.1f}"
+
+##################   Extraction Benchmark ##################
+
+def unstructured_only(filepath, mime_type):
+    """The old path: everything through Unstructured (fast strategy for PDFs, OCR for images)."""
+    strategy = "fast" if mime_type == "application/pdf" else "hi_res" if mime_type.startswith("image/") else None
+    return main.collect_text(main.iter_document_text(filepath, mime_type, strategy), main.TEXT_CHAR_BUDGET)
+
+def benchmark_extraction(repeat=3, folders=SAMPLE_FOLDERS):
+    """Compares per mime type latency of the routed extract_text_from_file against Unstructured for every file."""
+    per_type = {}
+    for filepath in find_sample_documents(folders):
+        mime_type = main.get_file_type(filepath)
+        print(f"  {mime_type:<75} {os.path.basename(filepath)}", file=sys.stderr)
+        routed_ms = time_call(lambda: main.extract_text_from_file(filepath, mime_type), repeat)
+        unstructured_ms = time_call(lambda: unstructured_only(filepath, mime_type), repeat)
+        per_type.setdefault(mime_type, []).append((routed_ms, unstructured_ms))
+
+    print(f"\n{'mime type':<75} {'files':>5} {'routed ms':>12} {'unstructured ms':>16} {'speedup':>8}")
+    for mime_type, rows in sorted(per_type.items()):
+        routed = [r for r, u in rows if r is not None]
+        unstructured = [u for r, u in rows if u is not None]
+        routed_ms = statistics.median(routed) if routed else None
+        unstructured_ms = statistics.median(unstructured) if unstructured else None
+        speedup = f"{unstructured_ms / routed_ms:.1f}x" if routed_ms and unstructured_ms else "n/a"
+        print(f"{mime_type:<75} {len(rows):>5} {format_ms(routed_ms):>12} {format_ms(unstructured_ms):>16} {speedup:>8}")
+    return per_type
+
+##################   Fake LLM ##################
+
+class FakeStructuredLLM:
+    """Stands in for ChatOpenAI in DocumentClassifier. Sleeps for `latency` seconds (to mimic the API round trip) and
+    answers deterministically from keywords in the prompt, so runs are repeatable and cost nothing."""
+
+    def __init__(self, latency=0.5, jitter=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+    def with_structured_output(self, schema, **kwargs):
+        from langchain_core.runnables import RunnableLambda
+        return RunnableLambda(lambda prompt_value: self.respond(schema, prompt_value))
+
+    def respond(self, schema, prompt_value):
+        time.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+        content = prompt_value.to_messages()[-1].content
+        text = " ".join(part["text"] for part in content if isinstance(part, dict) and part.get("type") == "text") if isinstance(content, list) else str(content)
+        return fake_structured_answer(schema, text)
+
+def fake_structured_answer(schema, text):
+    """A single classification, or one per "--- Document N ---" section when asked for a batch."""
+    if "results" not in schema.model_fields:
+        return schema(**fake_classification(text))
+    sections = re.split(r"--- Document (\d+) ---", text)[1:]
+    return schema(results=[dict(fake_classification(body), document_id=int(number)) for number, body in zip(sections[::2], sections[1::2])])
+
+def fake_classification(text):
+    """The keyword rules shared by the fake LLM and the stub server."""
+    lowered = text.lower()
+    if "statement" in lowered:
+        category_name = "Statements"
+    elif "loan" in lowered:
+        category_name = "Loans"
+    else:
+        category_name = "Memberdoc"
+    member_number = re.search(r"\b\d{6,10}\b", text)
+    return {"category_name": category_name, "confidence_score": 0.9, "member_name": "Benchmark Member",
+            "member_number": member_number.group(0) if member_number else "00000000", "doc_date": "2025-01-01"}
+
+##################   Pipeline Benchmark ##################
+
+def build_corpus(samples, target_folder, copies, duplicate_fraction=0.0, seed=0):
+    """Copies every sample document `copies` times into target_folder. Each copy gets a unique trailer appended
+    (PDF, DOCX/zip and image readers all ignore trailing bytes) so it misses the result cache, except the
+    duplicate_fraction of copies which are left byte identical to exercise cache hits."""
+    rng = random.Random(seed)
+    os.makedirs(target_folder, exist_ok=True)
+    paths = []
+    for copy_number in range(copies):
+        for sample_path in samples:
+            name, extension = os.path.splitext(os.path.basename(sample_path))
+            target_path = os.path.join(target_folder, f"{name}_copy{copy_number:04d}{extension}")
+            shutil.copyfile(sample_path, target_path)
+            if rng.random() >= duplicate_fraction:
+                with open(target_path, "ab") as f:
+                    f.write(f"\nbenchmark-{copy_number}-{rng.random()}".encode())
+            paths.append(target_path)
+    return paths
+
+def peak_rss_mb():
+    """Peak resident set size of this process and its (finished) worker processes, in MB."""
+    if resource is None:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+        except Exception:
+            return None
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024 # bytes on macOS, KB on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / divisor
+
+def benchmark_pipeline(copies=5, llm_latency=0.5, workers=None, llm_workers=main.DEFAULT_LLM_WORKERS,
+                       duplicate_fraction=0.0, index_entries=5000, keep_workdir=False, llm_batch_size=1):
+    """Runs process_batch, add_entry_to_index and the analytics load inside a temp working folder and returns a report dict."""
+    samples = [os.path.abspath(path) for path in find_sample_documents()]
+    original_dir = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="doc_classifier_bench_")
+    report = {"copies": copies, "llm_latency": llm_latency, "workers": workers or os.cpu_count(), "llm_workers": llm_workers, "llm_batch_size": llm_batch_size}
+    originals = (main.pipeline_metrics, main.metrics_store, main.result_cache, main.search_index)
+    try:
+        os.chdir(workdir)
+        os.makedirs("exceptions")
+        corpus = build_corpus(samples, "input", copies, duplicate_fraction)
+
+        # fresh metrics, caches and a fake model inside the temp folder, everything else is the real pipeline
+        main.pipeline_metrics = main.PipelineMetrics()
+        main.metrics_store = main.MetricsStore(os.path.join(workdir, "metrics.sqlite3"))
+        main.result_cache = main.ResultCache(os.path.join(workdir, "result_cache.sqlite3"))
+        main.search_index = main.SearchIndex(os.path.join(workdir, "search_index.sqlite3"))
+        unlimited = main.LLMScheduler(main.RateLimiter(requests_per_minute=None, tokens_per_minute=None))
+        main.set_classifier(main.DocumentClassifier(llm=FakeStructuredLLM(llm_latency), scheduler=unlimited, batch_size=llm_batch_size))
+
+        start = time.perf_counter()
+        results = list(main.process_batch(corpus, "exceptions", workers=workers, llm_workers=llm_workers))
+        duration = time.perf_counter() - start
+        report["documents"] = len(results)
+        report["classified"] = sum(1 for _, success, _ in results if success)
+        report["docs_per_sec"] = len(results) / duration if duration else 0.0
+        counters = main.pipeline_metrics.snapshot()["counters"]
+        report["docs_per_llm_request"] = counters.get("llm_calls_total", 0) / counters["llm_requests_total"] if counters.get("llm_requests_total") else 0.0
+        report["stages"] = {f"{row['stage']}|{row['mime_type']}": {key: round(row[key], 2) for key in ("count", "p50_ms", "p95_ms", "p99_ms")}
+                            for row in main.pipeline_metrics.snapshot()["stages"]}
+
+        # index writes on their own
+        entry = {"category_name": "Memberdoc", "confidence_score": 0.9, "member_name": "Benchmark Member",
+                 "member_number": "00000000", "doc_date": "2025-01-01", "loan_type": None, "file_loc": "bench"}
+        start = time.perf_counter()
+        for _ in range(index_entries):
+            main.add_entry_to_index(os.path.join("classified_output", "Memberdoc"), entry)
+        duration = time.perf_counter() - start
+        report["index_entries_per_sec"] = index_entries / duration if duration else 0.0
+
+        # the analytics dashboard load, cold
+        start = time.perf_counter()
+        main.IndexAggregator("classified_output").refresh()
+        report["analytics_load_sec"] = time.perf_counter() - start
+
+        report["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        main.set_classifier(None)
+        main.pipeline_metrics, main.metrics_store, main.result_cache, main.search_index = originals
+        os.chdir(original_dir)
+        if keep_workdir:
+            print(f"Benchmark files kept in {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+# higher is better for these, lower is better for the rest
+THROUGHPUT_KEYS = ("docs_per_sec", "index_entries_per_sec")
+LATENCY_KEYS = ("analytics_load_sec",)
+
+def compare_to_baseline(report, baseline, threshold):
+    """Returns a list of regression messages for every tracked number that got worse than baseline by more than threshold."""
+    regressions = []
+    for key in THROUGHPUT_KEYS:
+        if baseline.get(key) and report[key] < baseline[key] * (1 - threshold):
+            regressions.append(f"{key} dropped from {baseline[key]:.2f} to {report[key]:.2f}")
+    for key in LATENCY_KEYS:
+        if baseline.get(key) and report[key] > baseline[key] * (1 + threshold):
+            regressions.append(f"{key} rose from {baseline[key]:.3f} to {report[key]:.3f}")
+    return regressions
+
+def print_pipeline_report(report):
+    print(f"documents:           {report['documents']} ({report['classified']} classified)")
+    print(f"throughput:          {report['docs_per_sec']:.2f} docs/sec  (workers={report['workers']}, llm_workers={report['llm_workers']}, fake llm latency={report['llm_latency']}s)")
+    print(f"LLM requests:        {report.get('docs_per_llm_request', 0):.2f} docs/request  (llm_batch_size={report.get('llm_batch_size', 1)})")
+    print(f"index appends:       {report['index_entries_per_sec']:,.0f} entries/sec")
+    print(f"analytics load:      {report['analytics_load_sec']*1000:.1f} ms")
+    print(f"peak RSS:            {format_ms(report['peak_rss_mb'])} MB")
+    print(f"\n{'stage|mime type':<90} {'count':>6} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    for key, row in sorted(report["stages"].items()):
+        print(f"{key:<90} {row['count']:>6} {row['p50_ms']:>10.1f} {row['p95_ms']:>10.1f} {row['p99_ms']:>10.1f}")
+
+##################   Rate Limit Check ##################
+
+class StubOpenAIServer(ThreadingHTTPServer):
+    """Local stand in for the chat completions endpoint. Answers with the fake classification as a tool call, but
+    rejects a random fail_fraction of calls, and anything over requests_per_minute, with a 429 and a Retry-After."""
+
+    daemon_threads = True
+
+    def __init__(self, fail_fraction=0.3, requests_per_minute=None, latency=0.05, retry_after=0.2, seed=0):
+        super().__init__(("127.0.0.1", 0), StubOpenAIHandler)
+        self.fail_fraction = fail_fraction
+        self.requests_per_minute = requests_per_minute
+        self.latency = latency
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.accepted = []
+        self.requests = 0
+        self.rejected = 0
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def admit(self):
+        """True when this request should be answered, False for a 429."""
+        now = time.monotonic()
+        with self.lock:
+            self.requests += 1
+            recent = [t for t in self.accepted if t > now - 60]
+            if self.random.random() < self.fail_fraction or (self.requests_per_minute and len(recent) >= self.requests_per_minute):
+                self.rejected += 1
+                return False
+            self.accepted = recent + [now]
+            return True
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.server.admit():
+            self.send_json(429, {"error": {"message": "Rate limit reached for requests", "type": "requests", "code": "rate_limit_exceeded"}},
+                           {"retry-after-ms": str(int(self.server.retry_after * 1000))})
+            return
+        time.sleep(self.server.latency)
+        text = " ".join(part.get("text", "") if isinstance(part, dict) else str(part)
+                        for message in request.get("messages", []) if message.get("role") == "user"
+                        for part in (message["content"] if isinstance(message["content"], list) else [message["content"]]))
+        tool_name = request["tools"][0]["function"]["name"] if request.get("tools") else "DocumentClassificationResult"
+        schema = main.DocumentBatchClassificationResult if tool_name == "DocumentBatchClassificationResult" else main.DocumentClassificationResult
+        self.send_json(200, {
+            "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()), "model": request.get("model", "gpt-4o"),
+            "choices": [{"index": 0, "finish_reason": "tool_calls", "message": {"role": "assistant", "content": None, "tool_calls": [
+                {"id": "call_stub", "type": "function", "function": {"name": tool_name, "arguments": fake_structured_answer(schema, text).model_dump_json()}}]}}],
+            "usage": {"prompt_tokens": len(text) // 4, "completion_tokens": 40, "total_tokens": len(text) // 4 + 40}})
+
+def check_rate_limits(requests=100, llm_workers=main.DEFAULT_LLM_WORKERS, fail_fraction=0.3, server_rpm=None, client_rpm=None,
+                      client_tpm=None, max_retries=main.LLM_MAX_RETRIES):
+    """Classifies `requests` synthetic documents through the real ChatOpenAI client against the stub server and
+    reports how many made it through the 429s. Backoff is scaled down so the check runs in seconds."""
+    server = StubOpenAIServer(fail_fraction=fail_fraction, requests_per_minute=server_rpm)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    original_metrics = main.pipeline_metrics
+    main.pipeline_metrics = main.PipelineMetrics()
+    scheduler = main.LLMScheduler(main.RateLimiter(client_rpm, client_tpm), max_retries=max_retries, backoff_base=0.05, backoff_max=1.0)
+    classifier = main.DocumentClassifier(base_url=server.base_url, api_key="stub", scheduler=scheduler, max_connections=llm_workers)
+
+    def classify(number):
+        timings = {}
+        try:
+            classifier.classify("text/plain", f"Loan agreement for member {10000000 + number}", None, timings)
+            return True, timings.get("llm_wait", 0.0)
+        except Exception:
+            return False, timings.get("llm_wait", 0.0)
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=llm_workers) as pool:
+            results = list(pool.map(classify, range(requests)))
+        duration = time.perf_counter() - start
+        counters = main.pipeline_metrics.snapshot()["counters"]
+    finally:
+        classifier.close()
+        server.shutdown()
+        server.server_close()
+        main.pipeline_metrics = original_metrics
+    waits = sorted(wait for _, wait in results)
+    return {"requests": requests, "succeeded": sum(1 for success, _ in results if success), "server_requests": server.requests,
+            "server_429s": server.rejected, "retries": counters.get("llm_retries_total", 0), "duration_sec": duration,
+            "p95_wait_ms": main.percentile(waits, 0.95) * 1000 if waits else 0.0}
+
+##################   Import Time ##################
+
+# main is what every CLI worker, test and dashboard session pays on start, the rest are the stages main loads lazily
+IMPORT_MODULES = ["main", "langchain_openai", "langchain_unstructured", "pandas", "pyarrow", "streamlit"]
+
+def measure_import(module, repeat=3):
+    """Cold import of a module in a fresh interpreter with -X importtime. Returns the best of `repeat` runs as
+    {"ms": cumulative, "children": {direct dependency: ms}}, None when the module isn't installed."""
+    best = None
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True)
+        if result.returncode != 0:
+            return None
+        rows = []
+        for line in result.stderr.splitlines():
+            match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)", line)
+            if match:
+                rows.append((len(match.group(3)), match.group(4), int(match.group(2)) / 1000))
+        position = next((i for i, (depth, name, ms) in enumerate(rows) if name == module and depth == 0), None)
+        if position is None:
+            continue
+        # -X importtime prints a module's imports before it, one level deeper, after the previous top level import
+        start = max((i for i in range(position) if rows[i][0] == 0), default=-1) + 1
+        children = {name: ms for depth, name, ms in rows[start:position] if depth == 2}
+        if best is None or rows[position][2] < best["ms"]:
+            best = {"ms": rows[position][2], "children": dict(sorted(children.items(), key=lambda item: -item[1])[:8])}
+    return best
+
+def benchmark_imports(modules=IMPORT_MODULES, repeat=3):
+    report = {}
+    for module in modules:
+        measured = measure_import(module, repeat)
+        if measured is not None:
+            report[module] = measured
+    return report
+
+def print_import_report(report):
+    for module, measured in report.items():
+        print(f"{module:<28} {measured['ms']:>9.1f} ms")
+        for child, ms in measured["children"].items():
+            print(f"    {child:<40} {ms:>9.1f} ms")
+
+def compare_imports(report, baseline, threshold):
+    """Regression messages for modules whose import got slower than the baseline by more than threshold."""
+    return [f"import {module} rose from {baseline[module]['ms']:.1f} ms to {measured['ms']:.1f} ms"
+            for module, measured in report.items()
+            if module in baseline and measured["ms"] > baseline[module]["ms"] * (1 + threshold)]
+
+##################   Command Line ##################
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for the document classification pipeline.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    extraction_parser = subparsers.add_parser("extraction", help="Per mime type extraction latency, native text path vs Unstructured.")
+    extraction_parser.add_argument("--repeat", type=int, default=3)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="Offline end to end throughput with a fake LLM, optionally failing on regressions.")
+    pipeline_parser.add_argument("--copies", type=int, default=5, help="Copies of each sample document in the synthetic corpus.")
+    pipeline_parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds the fake LLM sleeps per call.")
+    pipeline_parser.add_argument("--workers", type=int, default=None, help="Extraction processes (default: core count).")
+    pipeline_parser.add_argument("--llm-workers", type=int, default=main.DEFAULT_LLM_WORKERS)
+    pipeline_parser.add_argument("--llm-batch-size", type=int, default=1, help="Small text documents packed into one LLM request.")
+    pipeline_parser.add_argument("--duplicates", type=float, default=0.0, help="Fraction of copies left byte identical to hit the result cache.")
+    pipeline_parser.add_argument("--index-entries", type=int, default=5000)
+    pipeline_parser.add_argument("--baseline", help="JSON report to compare against.")
+    pipeline_parser.add_argument("--threshold", type=float, default=0.2, help="Allowed regression against the baseline (0.2 = 20%%).")
+    pipeline_parser.add_argument("--save-baseline", help="Write this run's report to the given JSON file.")
+    pipeline_parser.add_argument("--keep-workdir", action="store_true")
+
+    ratelimit_parser = subparsers.add_parser("ratelimit", help="Classify against a local stub API that injects 429s, fails if any document is lost.")
+    ratelimit_parser.add_argument("--requests", type=int, default=100)
+    ratelimit_parser.add_argument("--llm-workers", type=int, default=main.DEFAULT_LLM_WORKERS)
+    ratelimit_parser.add_argument("--fail-fraction", type=float, default=0.3, help="Share of calls the stub randomly rejects with a 429.")
+    ratelimit_parser.add_argument("--server-rpm", type=int, default=None, help="Requests per minute the stub accepts before answering 429.")
+    ratelimit_parser.add_argument("--client-rpm", type=int, default=None, help="Requests per minute budget for the scheduler.")
+    ratelimit_parser.add_argument("--client-tpm", type=int, default=None, help="Tokens per minute budget for the scheduler.")
+
+    imports_parser = subparsers.add_parser("imports", help="Cold import time of main and of the dependencies it loads lazily (python -X importtime).")
+    imports_parser.add_argument("modules", nargs="*", default=IMPORT_MODULES)
+    imports_parser.add_argument("--repeat", type=int, default=3, help="Fresh interpreters per module, the fastest run counts.")
+    imports_parser.add_argument("--baseline", help="JSON report to compare against.")
+    imports_parser.add_argument("--threshold", type=float, default=0.3, help="Allowed regression against the baseline (0.3 = 30%%).")
+    imports_parser.add_argument("--save-baseline", help="Write this run's report to the given JSON file.")
+    imports_parser.add_argument("--history", help="Append this run, timestamped, to a JSON lines file to track import time over time.")
+
+    args = parser.parse_args(argv)
+    if args.command == "imports":
+        report = benchmark_imports(args.modules, args.repeat)
+        print_import_report(report)
+        if args.save_baseline:
+            with open(args.save_baseline, "w") as f:
+                json.dump(report, f, indent=1)
+        if args.history:
+            with open(args.history, "a") as f:
+                f.write(json.dumps({"time": datetime.datetime.now().isoformat(timespec="seconds"),
+                                    "imports_ms": {module: round(measured["ms"], 1) for module, measured in report.items()}}) + "\n")
+        if args.baseline:
+            with open(args.baseline, "r") as f:
+                regressions = compare_imports(report, json.load(f), args.threshold)
+            if regressions:
+                print("\nREGRESSION: " + "; ".join(regressions))
+                return 1
+            print(f"\nNo import time regressions beyond {args.threshold:.0%} of {args.baseline}.")
+        return 0
+    if args.command == "ratelimit":
+        report = check_rate_limits(args.requests, args.llm_workers, args.fail_fraction, args.server_rpm, args.client_rpm, args.client_tpm)
+        for key, value in report.items():
+            print(f"{key:<16} {value:.2f}" if isinstance(value, float) else f"{key:<16} {value}")
+        if report["succeeded"] < report["requests"]:
+            print(f"\nFAILED: {report['requests'] - report['succeeded']} document(s) would have gone to exceptions.")
+            return 1
+        return 0
+    if args.command == "extraction":
+        benchmark_extraction(args.repeat)
+    elif args.command == "pipeline":
+        report = benchmark_pipeline(args.copies, args.llm_latency, args.workers, args.llm_workers,
+                                    args.duplicates, args.index_entries, args.keep_workdir, args.llm_batch_size)
+        print_pipeline_report(report)
+        if args.save_baseline:
+            with open(args.save_baseline, "w") as f:
+                json.dump(report, f, indent=1)
+        if args.baseline:
+            with open(args.baseline, "r") as f:
+                regressions = compare_to_baseline(report, json.load(f), args.threshold)
+            if regressions:
+                print("\nREGRESSION: " + "; ".join(regressions))
+                return 1
+            print(f"\nNo regressions beyond {args.threshold:.0%} of {args.baseline}.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -1,37 +1,183 @@
 import os
+import sys
+import re
 from dotenv import load_dotenv
 import shutil
 import json
 import base64
 import logging
+import logging.handlers
+import multiprocessing
+import multiprocessing.connection
+import atexit
+import gzip
 import datetime
-import pandas as pd
-from PIL import Image
+import hashlib
+import sqlite3
+import threading
+import time
+import glob
+import argparse
+import cProfile
+import pstats
+import collections
+import math
+import zipfile
+import xml.etree.ElementTree as ElementTree
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, ImageChops, ImageDraw
+import io
 from pydantic import BaseModel, Field
-from typing import Optional, Union
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.messages import HumanMessage
+from typing import List, Optional, Union
 #from langchain_community.document_loaders import UnstructuredFileLoader
-from langchain_unstructured import UnstructuredLoader
-import pytesseract
 import filetype
-import streamlit as st
+import signal
+import socket
+import uuid
+import random
+import importlib
+import functools
+import itertools
+import weakref
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError: # optional, the watcher falls back to polling the folder
+    Observer = None
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+# Heavy dependencies (langchain/openai, unstructured, pandas, pyarrow, httpx) are imported inside the stage that needs
+# them, so the CLI, the dashboard and callers that only want e.g. get_file_type or add_entry_to_index start quickly.
+# Check with: python benchmark.py imports
+
+@functools.lru_cache(maxsize=None)
+def optional_module(name):
+    """ Imports an optional dependency on first use, None when it isn't installed (pyarrow: columnar index, mammoth: DOCX previews) """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
 
 # Explicitly setting the tesseract path for the pytesseract wrapper
 # Using r'' to handle Windows backslashes correctly
-# pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe' //used for local processing
+# import pytesseract; pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe' //used for local processing
 
 
 # load_dotenv() --> for local .env
 # The ChatOpenAI() call will now automatically find the key via os.environ
 
-OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
+def get_openai_api_key():
+    """ OPENAI_API_KEY from the environment (CLI workers, .env) and otherwise from Streamlit secrets when running under the dashboard.
+    streamlit is only imported here so main.py stays importable without it """
+    if os.environ.get("OPENAI_API_KEY"):
+        return os.environ["OPENAI_API_KEY"]
+    try:
+        import streamlit as st
+        return st.secrets["OPENAI_API_KEY"]
+    except Exception:
+        raise RuntimeError("OPENAI_API_KEY is not set. Export it, add it to a .env file or to .streamlit/secrets.toml.")
 
-# Setup logging
+# Setup logging. A RotatingFileHandler can't share its file with another process (a rotation renames the file out
+# from under the others), so only the dashboard writes log_<date>.log and every CLI worker gets a file of its own
 log_filename = f"log_{datetime.date.today().strftime('%Y-%m-%d')}.log"
-logging.basicConfig(filename=log_filename, level=logging.INFO, 
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+def process_log_filename(role):
+    """ log_<date>_<role>_<pid>.log, the log file of one CLI worker process """
+    return f"log_{datetime.date.today().strftime('%Y-%m-%d')}_{role}_{os.getpid()}.log"
+
+def todays_log_files():
+    """ Today's log files, the dashboard's first and then the CLI workers' (not the rotated .1, .2 ... backups) """
+    return sorted(glob.glob(f"log_{datetime.date.today().strftime('%Y-%m-%d')}*.log"), key=lambda path: (path != log_filename, path))
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_MAX_BYTES = 100 * 1024 * 1024 # rotate to log_<date>.log.1, .2, ... past this size
+LOG_BACKUP_COUNT = 10
+LOG_JSON = False # one JSON object per line instead of the plain text format (python main.py --json-logs ...)
+# worker processes are started by a fork server instead of being forked from this one: the dashboard and the watcher
+# run several threads, and a child forked from them can deadlock on a lock another thread held at that moment
+WORKER_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+class JsonLinesFormatter(logging.Formatter):
+    """ Log records as JSON lines, easy to ship to a log aggregator or load with pandas """
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name, "message": record.getMessage(),
+                 "process": record.process, "thread": record.threadName}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+_log_listener = None
+_log_queue = None
+
+def _stop_logging():
+    """ Flushes whatever is still queued to the file """
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+def setup_logging(filename=log_filename, json_lines=LOG_JSON, level=logging.INFO):
+    """ Callers only put records on a queue (QueueHandler), a listener thread does the formatting and the writing to a
+    size rotated file, so logging never blocks the pipeline on disk. The queue is a multiprocessing one so this
+    process's extraction workers log through the same listener (see log_to_queue). Calling it again swaps the file handler """
+    global _log_listener, _log_queue
+    _stop_logging()
+    file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8", delay=True)
+    file_handler.setFormatter(JsonLinesFormatter() if json_lines else logging.Formatter(LOG_FORMAT))
+    _log_queue = multiprocessing.get_context(WORKER_START_METHOD).Queue(-1)
+    log_to_queue(_log_queue, level)
+    _log_listener = logging.handlers.QueueListener(_log_queue, file_handler, respect_handler_level=True)
+    _log_listener.start()
+
+def log_to_queue(log_queue, level=logging.INFO):
+    """ Sends this process's log records to a parent's listener, pool workers get it from the pool initializer """
+    root = logging.getLogger()
+    for handler in [handler for handler in root.handlers if isinstance(handler, logging.handlers.QueueHandler)]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+
+atexit.register(_stop_logging)
+# a worker re-imports this module while it is still being unpickled (before parent_process() is set), it must not open
+# the parent's log file with a rotating handler of its own
+if multiprocessing.parent_process() is None and not getattr(multiprocessing.current_process(), "_inheriting", False):
+    setup_logging()
+
+LOG_TAIL_BLOCK_BYTES = 64 * 1024
+LOG_EXPORT_DIR = "./.log_exports"
+
+def tail_lines(path, max_lines=100, block_size=LOG_TAIL_BLOCK_BYTES):
+    """ The last max_lines lines of a file, read backwards from the end in blocks so the file size doesn't matter """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b""
+        while position > 0 and data.count(b"\n") <= max_lines:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+    return [line.decode("utf-8", errors="replace") for line in data.splitlines()[-max_lines:]]
+
+def compressed_log(path, export_dir=LOG_EXPORT_DIR):
+    """ A gzip copy of the log for download, streamed through in chunks and reused while the log hasn't changed """
+    os.makedirs(export_dir, exist_ok=True)
+    stat = os.stat(path)
+    target_path = os.path.join(export_dir, f"{os.path.basename(path)}.{stat.st_mtime_ns}.{stat.st_size}.gz")
+    if not os.path.exists(target_path):
+        for old_path in glob.glob(os.path.join(export_dir, os.path.basename(path) + ".*.gz")):
+            os.remove(old_path)
+        with open(path, "rb") as source, gzip.open(target_path + ".tmp", "wb") as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+        os.replace(target_path + ".tmp", target_path)
+    return target_path
 
 ##################    Pydantic category schemas #####################
 class DocumentClassificationResult(BaseModel):
@@ -43,6 +189,12 @@ class DocumentClassificationResult(BaseModel):
     loan_type: Optional[str] = Field(None, description="The type of loan, if applicable.")
     file_loc: Optional[str] = Field(None, description="The location where the file is stored after classification.")
 
+class BatchedDocumentResult(DocumentClassificationResult):
+    document_id: int = Field(description="The number of the document this result is for, as given in the input.")
+
+class DocumentBatchClassificationResult(BaseModel):
+    results: List[BatchedDocumentResult] = Field(description="Exactly one result for every input document.")
+
 ##################   File Handling Functions     ##################
 
 # def get_file_type(filepath):
@@ -57,100 +209,3077 @@ def get_file_type(filepath):
     except :
         return "application/octet-stream"
 
-def extract_text_from_file(filepath):
-    """Extracts text using Unstructured for multimodal functionality """
-    loader = UnstructuredLoader(filepath)
-    docs = loader.load()
-    return " ".join([doc.page_content for doc in docs])
+TEXT_CHAR_BUDGET = 2000 # only the first 2000 characters are sent to the model, so we stop extracting there
+EXTRACTION_MAX_PAGES = 3 # never partition or OCR past this page
+
+def limit_pages(filepath, mime_type, max_pages):
+    """Returns an in-memory copy of the first max_pages pages of a PDF or multi-page TIFF, or None when the file is already short enough."""
+    if max_pages is None:
+        return None
+    if mime_type == "application/pdf":
+        from pypdf import PdfReader, PdfWriter # part of unstructured's pdf extras, only needed for long PDFs
+        reader = PdfReader(filepath)
+        if len(reader.pages) <= max_pages:
+            return None
+        writer = PdfWriter()
+        for page in reader.pages[:max_pages]:
+            writer.add_page(page)
+    elif mime_type == "image/tiff":
+        with Image.open(filepath) as img:
+            if getattr(img, "n_frames", 1) <= max_pages:
+                return None
+            frames = []
+            for frame_number in range(max_pages):
+                img.seek(frame_number)
+                frames.append(img.copy())
+        writer = None
+    else:
+        return None
+
+    buffer = io.BytesIO()
+    if writer is not None:
+        writer.write(buffer)
+    else:
+        frames[0].save(buffer, format="TIFF", save_all=True, append_images=frames[1:])
+    buffer.seek(0)
+    return buffer
+
+def iter_document_text(filepath, mime_type, strategy=None, max_pages=EXTRACTION_MAX_PAGES):
+    """Yields (page number, text) for each Unstructured element of the first max_pages pages."""
+    from langchain_unstructured import UnstructuredLoader # pulls in the whole unstructured stack, only load it when OCR/partitioning is needed
+    kwargs = {"strategy": strategy} if strategy else {}
+    truncated = limit_pages(filepath, mime_type, max_pages)
+    if truncated is not None:
+        loader = UnstructuredLoader(file=truncated, metadata_filename=os.path.basename(filepath), **kwargs)
+    else:
+        loader = UnstructuredLoader(filepath, **kwargs)
+    for doc in loader.lazy_load():
+        page_number = doc.metadata.get("page_number") or 1
+        if max_pages is not None and page_number > max_pages:
+            return
+        yield page_number, doc.page_content
+
+def collect_text(elements, max_chars):
+    """Joins element text until the character budget is reached, then stops pulling elements."""
+    parts = []
+    length = 0
+    for page_number, text in elements:
+        if not text: continue
+        parts.append(text)
+        length += len(text) + 1
+        if max_chars is not None and length >= max_chars:
+            break
+    return " ".join(parts)
+
+# pages of one multi-page scan OCR'd at the same time at most, each is its own tesseract process
+OCR_PAGE_WORKERS = os.cpu_count() or 1
+# inside the extraction pool: the cores shared by every worker of the pool (see ExtractionPool). A worker holds one
+# while it runs a document, the pages past the first only start on cores nobody else is using
+_ocr_core_budget = None
+OCR_PDF_DPI = 200 # same rasterization resolution Unstructured uses for hi_res, so OCR quality doesn't change
+
+def count_scan_pages(filepath, mime_type):
+    """Number of pages in a multi-page TIFF or a PDF, 1 for everything else."""
+    if mime_type == "image/tiff":
+        with Image.open(filepath) as img:
+            return getattr(img, "n_frames", 1)
+    if mime_type == "application/pdf":
+        from pypdf import PdfReader
+        return len(PdfReader(filepath).pages)
+    return 1
+
+def page_ocr_available(mime_type):
+    """True when we can split this type into pages and OCR them ourselves (pytesseract, plus pdf2image/poppler for PDFs)."""
+    if optional_module("pytesseract") is None:
+        return False
+    return mime_type == "image/tiff" or (mime_type == "application/pdf" and optional_module("pdf2image") is not None)
+
+def ocr_scan_page(filepath, mime_type, page_number):
+    """Loads one page (a TIFF frame or a PDF page rasterized with poppler) and runs tesseract on it.
+    Every call opens the file itself so pages can be OCR'd from several threads at once."""
+    if mime_type == "application/pdf":
+        pages = optional_module("pdf2image").convert_from_path(filepath, dpi=OCR_PDF_DPI, first_page=page_number, last_page=page_number)
+        img = pages[0]
+    else:
+        with Image.open(filepath) as tiff:
+            tiff.seek(page_number - 1)
+            img = normalize_16bit(tiff.copy())
+    return optional_module("pytesseract").image_to_string(img)
+
+def iter_ocr_pages(filepath, mime_type, page_count, workers=None, cores=None):
+    """Yields (page number, text) in page order while up to `workers` pages are OCR'd in parallel. A page is only started
+    once the pages before it leave room, so when the caller stops pulling (character budget reached) the pages after
+    those in flight are never rasterized or OCR'd. With a core budget (a semaphore, by default the pool's) one page
+    runs on the caller's own core and every further one only when it can take a spare core without waiting."""
+    workers = workers or OCR_PAGE_WORKERS
+    cores = cores if cores is not None else _ocr_core_budget
+    pool = ThreadPoolExecutor(max_workers=min(workers, page_count))
+    in_flight = collections.deque()
+    next_page = 1
+    try:
+        while next_page <= page_count or in_flight:
+            while next_page <= page_count and len(in_flight) < workers:
+                borrowed = bool(in_flight) and cores is not None
+                if borrowed and not cores.acquire(False):
+                    break # every other core is busy, wait for our own pages
+                future = pool.submit(ocr_scan_page, filepath, mime_type, next_page)
+                if borrowed:
+                    future.add_done_callback(lambda _: cores.release())
+                in_flight.append((next_page, future))
+                next_page += 1
+            page_number, future = in_flight.popleft()
+            yield page_number, future.result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+DOCX_MIME_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+def iter_pdf_text_layer(filepath, max_pages=EXTRACTION_MAX_PAGES):
+    """Yields (page number, text) straight from a born-digital PDF's text layer with pdfminer, no OCR or layout models."""
+    from pdfminer.high_level import extract_pages # pdfminer.six comes with unstructured's pdf extras
+    from pdfminer.layout import LTTextContainer
+    for page_number, page_layout in enumerate(extract_pages(filepath, maxpages=max_pages or 0), start=1):
+        yield page_number, " ".join(element.get_text().strip() for element in page_layout if isinstance(element, LTTextContainer))
+
+def iter_docx_text(filepath, max_pages=None):
+    """Yields (1, paragraph text) from the document.xml inside a .docx, parsed incrementally so we can stop early.
+    Word doesn't store page breaks reliably so everything counts as page 1."""
+    with zipfile.ZipFile(filepath) as docx_zip, docx_zip.open("word/document.xml") as document_xml:
+        for event, element in ElementTree.iterparse(document_xml):
+            if element.tag == WORD_NAMESPACE + "p":
+                text = "".join(node.text or "" if node.tag == WORD_NAMESPACE + "t" else " "
+                               for node in element.iter() if node.tag in (WORD_NAMESPACE + "t", WORD_NAMESPACE + "tab"))
+                element.clear()
+                if text.strip():
+                    yield 1, text
+
+# born-digital formats we can read without Unstructured, keyed by get_file_type mime type
+NATIVE_TEXT_EXTRACTORS = {
+    "application/pdf": iter_pdf_text_layer,
+    DOCX_MIME_TYPE: iter_docx_text,
+}
+
+def extract_native_text(filepath, mime_type, max_chars=TEXT_CHAR_BUDGET, max_pages=EXTRACTION_MAX_PAGES):
+    """Fast path: text from the PDF text layer or DOCX XML. Returns "" for scans or when the file can't be read natively."""
+    extractor = NATIVE_TEXT_EXTRACTORS.get(mime_type)
+    if extractor is None:
+        return ""
+    try:
+        return collect_text(extractor(filepath, max_pages), max_chars)
+    except Exception as e:
+        logging.warning(f"Native text extraction failed for {filepath}, falling back to Unstructured: {e}")
+        return ""
+
+def extract_text_from_file(filepath, mime_type=None, max_chars=TEXT_CHAR_BUDGET, max_pages=EXTRACTION_MAX_PAGES, timings=None):
+    """Extracts text, routed by mime type. Born-digital PDFs and DOCX are read natively, Unstructured is only used for
+    scans, images and other formats. Only the first max_pages pages are read and extraction stops at max_chars.
+    Multi-page scans are OCR'd page by page across cores. Pass a timings dict to get the native/unstructured/ocr/ocr_pages
+    stage durations added to it."""
+    timings = {} if timings is None else timings
+    mime_type = mime_type or get_file_type(filepath)
+    if mime_type in NATIVE_TEXT_EXTRACTORS:
+        with stage_timer(timings, "extract_native"):
+            document_text = extract_native_text(filepath, mime_type, max_chars, max_pages)
+        if document_text.strip():
+            return document_text
+
+    if page_ocr_available(mime_type):
+        # multi-page scans are split into pages and OCR'd across cores, only as many pages as the budget needs
+        try:
+            page_count = min(count_scan_pages(filepath, mime_type), max_pages or math.inf)
+            if page_count > 1:
+                with stage_timer(timings, "extract_ocr_pages"):
+                    document_text = collect_text(iter_ocr_pages(filepath, mime_type, page_count), max_chars)
+                if document_text.strip():
+                    return document_text
+        except Exception as e:
+            logging.warning(f"Page parallel OCR failed for {filepath}, falling back to Unstructured: {e}")
+
+    if mime_type == "application/pdf":
+        strategies = ["hi_res"] # the text layer was empty so this is a scan, OCR it
+    elif mime_type.startswith("image/"):
+        strategies = ["hi_res"] # images have no text layer, go straight to OCR
+    else:
+        strategies = [None] # docx/other formats are parsed directly, strategy doesn't apply
+
+    document_text = ""
+    for strategy in strategies:
+        with stage_timer(timings, "extract_ocr" if strategy == "hi_res" else "extract_unstructured"):
+            document_text = collect_text(iter_document_text(filepath, mime_type, strategy, max_pages), max_chars)
+        if document_text.strip():
+            break
+    return document_text
+
+IMAGE_MAX_DIMENSION = 2048 # longest side in pixels sent to the vision model, gpt-4o downsizes anything bigger anyway
+IMAGE_OUTPUT_FORMAT = "JPEG" # or "WEBP"
+IMAGE_QUALITY = 80
+IMAGE_GRAYSCALE_TOLERANCE = 8 # max channel difference still treated as grey, scanners add a little colour noise
+
+def is_grayscale(img):
+    """True when an RGB image carries no real colour."""
+    red, green, blue = img.split()
+    return (ImageChops.difference(red, green).getextrema()[1] <= IMAGE_GRAYSCALE_TOLERANCE and
+            ImageChops.difference(green, blue).getextrema()[1] <= IMAGE_GRAYSCALE_TOLERANCE)
+
+def normalize_16bit(img):
+    """16 bit scans (common in TIFF) normalized down to 8 bit greyscale so they don't come out black or white."""
+    if img.mode in ("I;16", "I;16B", "I;16L", "I"):
+        return img.convert("I").point(lambda value: value * (1 / 256)).convert("L")
+    return img
+
+def prepare_image(img):
+    """Normalizes an opened image to RGB or L, shrinks it to IMAGE_MAX_DIMENSION and drops colour it doesn't use."""
+    img = normalize_16bit(img)
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, "white")
+        background.paste(img, mask=img.split()[-1])
+        img = background
+    elif img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+
+    img.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+    if img.mode == "RGB" and is_grayscale(img):
+        img = img.convert("L")
+    return img
 
 def encode_image_to_base64(image_path, mime_type):
-    """Encodes an image to a base64 string if it's an image type."""
+    """Downscales and recompresses an image for the vision model if it's an image type.
+    Returns (base64 string, mime type of the encoded image, original bytes, encoded bytes) or None."""
     if mime_type.startswith('image/'):
-        with open(image_path, "rb") as image_file:
-            # create a string from the bytes returned by the base64encoding
-            return base64.b64encode(image_file.read()).decode('utf-8')
+        original_bytes = os.path.getsize(image_path)
+        try:
+            with Image.open(image_path) as img:
+                img = prepare_image(img)
+                buffer = io.BytesIO()
+                img.save(buffer, format=IMAGE_OUTPUT_FORMAT, quality=IMAGE_QUALITY, optimize=True)
+            encoded = buffer.getvalue()
+            encoded_mime_type = f"image/{IMAGE_OUTPUT_FORMAT.lower()}"
+        except Exception as e:
+            # fall back to the raw bytes rather than losing the image
+            logging.warning(f"Could not recompress {image_path}, sending it as is: {e}")
+            with open(image_path, "rb") as image_file:
+                encoded = image_file.read()
+            encoded_mime_type = mime_type
+        if len(encoded) >= original_bytes and mime_type in ("image/jpeg", "image/png", "image/webp"):
+            # already compact and in a format the model accepts, keep the original
+            with open(image_path, "rb") as image_file:
+                encoded = image_file.read()
+            encoded_mime_type = mime_type
+        # create a string from the bytes returned by the base64encoding
+        return base64.b64encode(encoded).decode('utf-8'), encoded_mime_type, original_bytes, len(encoded)
     return None
 
 ##################   Index File Management Functions ##################   
 
-def get_next_index_file(category_folder, max_entries=10):
-    """search available file to see which has less than 10 entries. Then use that file."""
-    index_count = 0
-    while True:
-        index_filename = f"index_{index_count:03d}.jsonl"
-        index_path = os.path.join(category_folder, index_filename)
-        if not os.path.exists(index_path): return index_path
-        with open(index_path, 'r') as f:
-            line_count = sum(1 for line in f)
-        if line_count < max_entries: return index_path
-        index_count += 1
-
-def add_entry_to_index(category_folder, data_entry, max_entries=10):
-    """Writes a new dictionary entry as a JSON line to the appropriate index file."""
-    index_path = get_next_index_file(category_folder, max_entries)
-    with open(index_path, 'a') as f:
-        f.write(json.dumps(data_entry) + '\n')
+INDEX_MANIFEST_NAME = "manifest.json"
+INDEX_LOCK_NAME = ".index.lock"
+INDEX_MAX_SHARD_BYTES = 64 * 1024 * 1024 # roll over to a new index_NNN.jsonl once a shard reaches this size
+INDEX_MAX_SHARD_RECORDS = None # optional record count limit per shard, None means size only
+INDEX_COLUMNAR = True # also write a Parquet copy of every sealed shard (needs pyarrow) so analytics can read single columns
+DOC_DATE_FORMATS = ["%Y-%m-%d", "%m/%d/%Y", "%m/%d/%y", "%m-%d-%Y", "%Y/%m/%d", "%B %d, %Y", "%b %d, %Y", "%d %B %Y"]
+
+@contextmanager
+def locked_file(lock_path):
+    """Holds an exclusive OS level lock on lock_path so several workers/processes can share a folder."""
+    with open(lock_path, "a+") as lock_file:
+        if os.name == "nt":
+            while True:
+                try:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after ~10 seconds, keep waiting
+                    continue
+        else:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def shard_filename(shard_number):
+    return f"index_{shard_number:03d}.jsonl"
+
+def normalize_doc_date(doc_date):
+    """Returns the doc_date as an ISO YYYY-MM-DD string, or None when the model gave us something we can't parse."""
+    if not doc_date:
+        return None
+    for date_format in DOC_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(doc_date.strip(), date_format).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+def new_shard_stats(filename):
+    return {"file": filename, "records": 0, "bytes": 0, "min_doc_date": None, "max_doc_date": None}
+
+def update_shard_stats(shard, data_entry, line_bytes):
+    """Folds one record into a manifest shard entry."""
+    shard["records"] += 1
+    shard["bytes"] += line_bytes
+    doc_date = normalize_doc_date(data_entry.get("doc_date")) if isinstance(data_entry, dict) else None
+    if doc_date:
+        if shard["min_doc_date"] is None or doc_date < shard["min_doc_date"]: shard["min_doc_date"] = doc_date
+        if shard["max_doc_date"] is None or doc_date > shard["max_doc_date"]: shard["max_doc_date"] = doc_date
+
+def read_shard_stats(shard_path):
+    """Builds the manifest entry for an existing shard by reading it once."""
+    shard = new_shard_stats(os.path.basename(shard_path))
+    with open(shard_path, 'rb') as f:
+        for raw_line in f:
+            if not raw_line.strip(): continue
+            try:
+                data_entry = json.loads(raw_line)
+            except ValueError:
+                data_entry = None
+            update_shard_stats(shard, data_entry, len(raw_line))
+    return shard
+
+def list_shard_files(category_folder):
+    """All index_NNN.jsonl shards in the folder in shard order."""
+    return sorted(glob.glob(os.path.join(category_folder, "index_[0-9][0-9][0-9]*.jsonl")))
+
+def list_columnar_files(category_folder):
+    """All index_NNN.parquet columnar copies in the folder."""
+    return sorted(glob.glob(os.path.join(category_folder, "index_[0-9][0-9][0-9]*.parquet")))
+
+def columnar_index_enabled():
+    return INDEX_COLUMNAR and optional_module("pyarrow") is not None
+
+def index_arrow_schema():
+    """Arrow schema of an index record, taken from the pydantic model so the two can't drift apart."""
+    pa = optional_module("pyarrow")
+    return pa.schema([(name, pa.float64() if field.annotation is float else pa.string())
+                      for name, field in DocumentClassificationResult.model_fields.items()])
+
+def read_jsonl_records(shard_path):
+    records = []
+    with open(shard_path, 'rb') as f:
+        for raw_line in f:
+            if raw_line.strip():
+                records.append(json.loads(raw_line))
+    return records
+
+def write_columnar_shard(shard_path):
+    """Writes index_NNN.parquet next to a sealed JSONL shard and returns its file name."""
+    pa, pq = optional_module("pyarrow"), optional_module("pyarrow.parquet")
+    schema = index_arrow_schema()
+    records = []
+    for record in read_jsonl_records(shard_path):
+        # coerce to the schema types, the model has been known to return member numbers as ints
+        records.append({name: (None if record.get(name) is None else
+                               float(record[name]) if schema.field(name).type == pa.float64() else str(record[name]))
+                        for name in schema.names})
+    parquet_path = shard_path[:-len(".jsonl")] + ".parquet"
+    temp_path = parquet_path + ".tmp"
+    pq.write_table(pa.Table.from_pylist(records, schema=schema), temp_path, compression="zstd")
+    os.replace(temp_path, parquet_path)
+    return os.path.basename(parquet_path)
+
+class IndexWriter:
+    """Append-only writer for one category folder.
+    The current shard and its stats live in a small manifest.json next to the shards, so an append never
+    rescans the index. Shards roll over by byte size (and optionally record count). Appends take a file lock
+    so threads, worker processes and the dashboard can write at once."""
+
+    def __init__(self, category_folder, max_entries=INDEX_MAX_SHARD_RECORDS, max_bytes=INDEX_MAX_SHARD_BYTES):
+        self.category_folder = category_folder
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.manifest_path = os.path.join(category_folder, INDEX_MANIFEST_NAME)
+        self.lock_path = os.path.join(category_folder, INDEX_LOCK_NAME)
+        self._lock = threading.Lock()
+        self._manifest = None
+
+    def _scan_shards(self):
+        """One time bootstrap for folders written before the manifest existed."""
+        shards = [read_shard_stats(shard_path) for shard_path in list_shard_files(self.category_folder)]
+        if not shards:
+            shards.append(new_shard_stats(shard_filename(0)))
+        return {"shards": shards}
+
+    def _load_manifest(self):
+        """Returns the manifest. It is re-read under the lock because another process may have appended since."""
+        self._recover_compaction()
+        if not os.path.exists(self.manifest_path):
+            self._manifest = self._scan_shards()
+            self._save_manifest()
+        else:
+            with open(self.manifest_path, 'r') as f:
+                self._manifest = json.load(f)
+        return self._manifest
+
+    def _save_manifest(self):
+        # write to a temp file then swap it in so readers never see a half written manifest
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self._manifest, f, indent=1)
+        os.replace(temp_path, self.manifest_path)
+
+    def _swap_in_compacted(self, new_shards):
+        """Retires the old shards, moves the staged ones in and saves their manifest. Safe to run again after a crash
+        at any point: until the first new shard has been moved in, everything in place is an old shard."""
+        staging_folder = os.path.join(self.category_folder, ".compact_new")
+        retired_folder = os.path.join(self.category_folder, ".compact_old")
+        if all(os.path.exists(os.path.join(staging_folder, shard["file"])) for shard in new_shards):
+            os.makedirs(retired_folder, exist_ok=True)
+            for shard_path in list_shard_files(self.category_folder) + list_columnar_files(self.category_folder):
+                os.replace(shard_path, os.path.join(retired_folder, os.path.basename(shard_path)))
+        for shard in new_shards:
+            staged_path = os.path.join(staging_folder, shard["file"])
+            if os.path.exists(staged_path):
+                os.replace(staged_path, os.path.join(self.category_folder, shard["file"]))
+        for shard in new_shards[:-1]:
+            # the last shard stays open for appends, the rest are sealed
+            self._seal_shard(shard)
+        self._manifest = {"shards": new_shards}
+        self._save_manifest()
+        # the old shards are only dropped once the manifest points at the new ones
+        shutil.rmtree(retired_folder, ignore_errors=True)
+        shutil.rmtree(staging_folder, ignore_errors=True)
+
+    def _recover_compaction(self):
+        """Finishes a compaction that got as far as staging its manifest, otherwise throws the staged shards away.
+        Called under the lock before the manifest is read, so nobody appends to a half swapped folder."""
+        staging_folder = os.path.join(self.category_folder, ".compact_new")
+        retired_folder = os.path.join(self.category_folder, ".compact_old")
+        staged_manifest = os.path.join(staging_folder, INDEX_MANIFEST_NAME)
+        if os.path.exists(staged_manifest):
+            logging.warning(f"Finishing an interrupted compaction of {self.category_folder}.")
+            with open(staged_manifest, 'r') as f:
+                self._swap_in_compacted(json.load(f)["shards"])
+        elif os.path.isdir(retired_folder) and os.listdir(retired_folder):
+            # only a crash mid swap in a version without the staged manifest leaves this behind. The retired shards
+            # hold every record, so they go back in place and the manifest is rebuilt from them
+            logging.warning(f"Restoring the index shards of an interrupted compaction of {self.category_folder}.")
+            retired_names = set(os.listdir(retired_folder))
+            for shard_path in list_shard_files(self.category_folder) + list_columnar_files(self.category_folder):
+                if os.path.basename(shard_path) not in retired_names:
+                    os.remove(shard_path)
+            for name in retired_names:
+                os.replace(os.path.join(retired_folder, name), os.path.join(self.category_folder, name))
+            if os.path.exists(self.manifest_path):
+                os.remove(self.manifest_path)
+            shutil.rmtree(retired_folder, ignore_errors=True)
+            shutil.rmtree(staging_folder, ignore_errors=True)
+        elif os.path.isdir(staging_folder) or os.path.isdir(retired_folder):
+            # the new shards were never complete, the old ones were never touched
+            shutil.rmtree(staging_folder, ignore_errors=True)
+            shutil.rmtree(retired_folder, ignore_errors=True)
+
+    def current_shard_path(self):
+        """Path of the shard the next entry will be written to."""
+        with self._lock, locked_file(self.lock_path):
+            manifest = self._load_manifest()
+            self._rotate_if_full(manifest)
+            return os.path.join(self.category_folder, manifest["shards"][-1]["file"])
+
+    def _rotate_if_full(self, manifest, next_line_bytes=0):
+        shard = manifest["shards"][-1]
+        if shard["records"] == 0:
+            return # never leave an empty shard behind, even for a record larger than max_bytes
+        full_by_count = self.max_entries is not None and shard["records"] >= self.max_entries
+        full_by_size = self.max_bytes is not None and shard["bytes"] + next_line_bytes > self.max_bytes
+        if full_by_count or full_by_size:
+            self._seal_shard(shard)
+            next_number = int(shard["file"][len("index_"):-len(".jsonl")]) + 1
+            manifest["shards"].append(new_shard_stats(shard_filename(next_number)))
+            self._save_manifest()
+
+    def _seal_shard(self, shard):
+        """A full shard never changes again, so this is when its columnar copy gets written."""
+        if not columnar_index_enabled():
+            return
+        try:
+            shard["parquet"] = write_columnar_shard(os.path.join(self.category_folder, shard["file"]))
+        except Exception as e:
+            # the JSONL shard is still complete, analytics will just read it the slow way
+            logging.error(f"Could not write columnar copy of {shard['file']} in {self.category_folder}: {e}")
+
+    def append(self, data_entry):
+        """Writes a new dictionary entry as a JSON line to the current shard and returns the shard path."""
+        line = (json.dumps(data_entry) + '\n').encode('utf-8')
+        with self._lock, locked_file(self.lock_path):
+            manifest = self._load_manifest()
+            self._rotate_if_full(manifest, len(line))
+            shard = manifest["shards"][-1]
+            index_path = os.path.join(self.category_folder, shard["file"])
+            with open(index_path, 'ab') as f:
+                f.write(line)
+            update_shard_stats(shard, data_entry, len(line))
+            self._save_manifest()
+        return index_path
+
+    def compact(self):
+        """Merges every existing shard into as few shards as the size limits allow without losing records.
+        New shards are written to a staging folder first and the old ones are only removed once the record counts match
+        and the new manifest is saved. A compaction interrupted by a crash is finished (or undone) by the next writer."""
+        staging_folder = os.path.join(self.category_folder, ".compact_new")
+        with self._lock, locked_file(self.lock_path):
+            self._recover_compaction()
+            old_shards = list_shard_files(self.category_folder)
+            os.makedirs(staging_folder)
+
+            records_in = 0
+            new_shards = [new_shard_stats(shard_filename(0))]
+            out = open(os.path.join(staging_folder, new_shards[-1]["file"]), 'wb')
+            try:
+                for shard_path in old_shards:
+                    with open(shard_path, 'rb') as f:
+                        for raw_line in f:
+                            if not raw_line.strip(): continue
+                            line = raw_line.rstrip(b'\r\n') + b'\n'
+                            records_in += 1
+                            shard = new_shards[-1]
+                            full_by_count = self.max_entries is not None and shard["records"] >= self.max_entries
+                            full_by_size = self.max_bytes is not None and shard["bytes"] + len(line) > self.max_bytes
+                            if shard["records"] and (full_by_count or full_by_size):
+                                out.close()
+                                new_shards.append(new_shard_stats(shard_filename(len(new_shards))))
+                                out = open(os.path.join(staging_folder, new_shards[-1]["file"]), 'wb')
+                            out.write(line)
+                            try:
+                                data_entry = json.loads(line)
+                            except ValueError:
+                                data_entry = None # keep lines we can't parse, they just don't count towards the date range
+                            update_shard_stats(new_shards[-1], data_entry, len(line))
+            finally:
+                out.close()
+
+            records_out = sum(shard["records"] for shard in new_shards)
+            if records_out != records_in:
+                shutil.rmtree(staging_folder, ignore_errors=True)
+                raise RuntimeError(f"Compaction of {self.category_folder} wrote {records_out} records but read {records_in}, nothing was changed.")
+
+            # the manifest in the staging folder marks the new shards as complete, from here on a crash rolls forward
+            temp_path = os.path.join(staging_folder, INDEX_MANIFEST_NAME + ".tmp")
+            with open(temp_path, 'w') as f:
+                json.dump({"shards": new_shards}, f, indent=1)
+            os.replace(temp_path, os.path.join(staging_folder, INDEX_MANIFEST_NAME))
+            self._swap_in_compacted(new_shards)
+
+        logging.info(f"Compacted {len(old_shards)} index shards into {len(new_shards)} for {self.category_folder} ({records_out} records).")
+        return len(old_shards), len(new_shards), records_out
+
+_index_writers = {}
+_index_writers_lock = threading.Lock()
+
+def get_index_writer(category_folder, max_entries=None, max_bytes=None):
+    """Returns the shared IndexWriter for a category folder. Limits left as None use the configured defaults."""
+    key = os.path.abspath(category_folder)
+    with _index_writers_lock:
+        writer = _index_writers.get(key)
+        if writer is None:
+            os.makedirs(category_folder, exist_ok=True)
+            writer = _index_writers[key] = IndexWriter(category_folder)
+        writer.max_entries = max_entries if max_entries is not None else INDEX_MAX_SHARD_RECORDS
+        writer.max_bytes = max_bytes if max_bytes is not None else INDEX_MAX_SHARD_BYTES
+        return writer
+
+def get_next_index_file(category_folder, max_entries=None):
+    """Returns the index file the next entry goes to, taken from the manifest instead of a rescan."""
+    return get_index_writer(category_folder, max_entries).current_shard_path()
+
+def add_entry_to_index(category_folder, data_entry, max_entries=None, document_text=None, label_source=None):
+    """Writes a new dictionary entry as a JSON line to the appropriate index file and to the search index.
+    label_source says who picked the category: "llm", "manual" (a reviewer) or "local" (the pre-classifier)."""
+    index_path = get_index_writer(category_folder, max_entries).append(data_entry)
     logging.info(f"Added entry to index: {index_path}")
+    try:
+        search_index.add(data_entry, document_text, label_source)
+    except Exception as e:
+        # the JSONL shard is the source of truth, `python main.py reindex-search` can catch the search index up
+        logging.error(f"Could not add entry to search index: {e}")
 
+def compact_index(output_dir="./classified_output", max_bytes=None, max_entries=None):
+    """Compacts the index shards of every category folder under output_dir. Returns {category: (shards_before, shards_after, records)}."""
+    results = {}
+    for category in sorted(os.listdir(output_dir)):
+        category_folder = os.path.join(output_dir, category)
+        if os.path.isdir(category_folder) and list_shard_files(category_folder):
+            results[category] = get_index_writer(category_folder, max_entries, max_bytes).compact()
+    return results
 
-##################   Main Processing Logic ##################   
+def build_columnar_index(output_dir="./classified_output"):
+    """Writes the missing Parquet copies for every sealed shard (all but the last one in each manifest). Returns the number written."""
+    if not columnar_index_enabled():
+        raise RuntimeError("The columnar index needs pyarrow installed and INDEX_COLUMNAR switched on.")
+    written = 0
+    for category in sorted(os.listdir(output_dir)):
+        category_folder = os.path.join(output_dir, category)
+        if not (os.path.isdir(category_folder) and list_shard_files(category_folder)): continue
+        writer = get_index_writer(category_folder)
+        with writer._lock, locked_file(writer.lock_path):
+            manifest = writer._load_manifest()
+            for shard in manifest["shards"][:-1]:
+                if "parquet" not in shard:
+                    writer._seal_shard(shard)
+                    written += "parquet" in shard
+            writer._save_manifest()
+    return written
 
-def process_file_with_ai(filepath, filename, exception_folder):
-    """ Calls the AI for classification and manages file movement and creation """
+
+##################   Search Index ##################   
+
+SEARCH_DB_PATH = "./search_index.sqlite3"
+SEARCH_LOAN_TYPES_TTL_SECONDS = 300 # how long the pre-classifier's list of known loan types is reused
+
+class SearchIndex:
+    """Local SQLite index of every classified document for teller lookups.
+    B-tree indexes cover member_number, member_name, category_name and doc_date, and an FTS5 table holds the extracted text."""
+
+    def __init__(self, db_path=SEARCH_DB_PATH):
+        self.db_path = db_path
+        self._initialized = False
+        self._init_lock = threading.Lock()
+        self._loan_types = None
+        self._loan_types_loaded_at = 0.0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        if not self._initialized:
+            with self._init_lock:
+                conn.execute("PRAGMA journal_mode=WAL")
+                # member_name is NOCASE so prefix LIKE searches can use its index
+                conn.execute("""CREATE TABLE IF NOT EXISTS documents (
+                                    id INTEGER PRIMARY KEY,
+                                    category_name TEXT,
+                                    confidence_score REAL,
+                                    member_name TEXT COLLATE NOCASE,
+                                    member_number TEXT,
+                                    doc_date TEXT,
+                                    doc_date_iso TEXT,
+                                    loan_type TEXT,
+                                    file_loc TEXT UNIQUE,
+                                    indexed_at TEXT NOT NULL,
+                                    label_source TEXT)""")
+                if "label_source" not in {row["name"] for row in conn.execute("PRAGMA table_info(documents)")}:
+                    # indexes from before label sources were kept, their rows stay NULL (unknown)
+                    conn.execute("ALTER TABLE documents ADD COLUMN label_source TEXT")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_member_number ON documents (member_number)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_member_name ON documents (member_name)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_category_name ON documents (category_name)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_doc_date ON documents (doc_date_iso)")
+                conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(member_name, document_text)")
+                conn.commit()
+                self._initialized = True
+        return conn
+
+    def _upsert(self, conn, data_entry, document_text, label_source=None):
+        values = {name: data_entry.get(name) for name in DocumentClassificationResult.model_fields}
+        values["member_number"] = None if values["member_number"] is None else str(values["member_number"])
+        values["doc_date_iso"] = normalize_doc_date(values["doc_date"])
+        values["indexed_at"] = datetime.datetime.now().isoformat(timespec="seconds")
+        values["label_source"] = label_source
+        row = conn.execute("SELECT id FROM documents WHERE file_loc = ?", (values["file_loc"],)).fetchone() if values["file_loc"] else None
+        if row is not None:
+            # same file indexed again (e.g. a rebuild), replace it rather than duplicating
+            doc_id = row["id"]
+            conn.execute("""UPDATE documents SET category_name = :category_name, confidence_score = :confidence_score, member_name = :member_name,
+                                member_number = :member_number, doc_date = :doc_date, doc_date_iso = :doc_date_iso, loan_type = :loan_type,
+                                indexed_at = :indexed_at, label_source = COALESCE(:label_source, label_source) WHERE id = :id""", {**values, "id": doc_id})
+            if document_text is None:
+                # keep the text we already have, a rebuild from the JSONL shards doesn't know it
+                existing = conn.execute("SELECT document_text FROM documents_fts WHERE rowid = ?", (doc_id,)).fetchone()
+                document_text = existing["document_text"] if existing else None
+            conn.execute("DELETE FROM documents_fts WHERE rowid = ?", (doc_id,))
+        else:
+            doc_id = conn.execute("""INSERT INTO documents (category_name, confidence_score, member_name, member_number, doc_date, doc_date_iso, loan_type, file_loc, indexed_at, label_source)
+                                     VALUES (:category_name, :confidence_score, :member_name, :member_number, :doc_date, :doc_date_iso, :loan_type, :file_loc, :indexed_at, :label_source)""",
+                                  values).lastrowid
+        conn.execute("INSERT INTO documents_fts (rowid, member_name, document_text) VALUES (?, ?, ?)",
+                     (doc_id, values["member_name"] or "", document_text or ""))
+
+    def add(self, data_entry, document_text=None, label_source=None):
+        """Indexes one classification result (a DocumentClassificationResult dict) with its extracted text."""
+        conn = self._connect()
+        try:
+            with conn:
+                self._upsert(conn, data_entry, document_text, label_source)
+        finally:
+            conn.close()
+        if data_entry.get("loan_type") and self._loan_types is not None:
+            self._loan_types.add(data_entry["loan_type"])
+
+    def search(self, member_number=None, member_name=None, category_name=None, date_from=None, date_to=None, text=None, limit=100):
+        """Returns matching documents newest first. member_name is a case insensitive prefix match,
+        dates are YYYY-MM-DD bounds on the normalized doc_date and text is a full text query over the extracted text."""
+        clauses, params = [], []
+        if member_number:
+            clauses.append("d.member_number = ?"); params.append(member_number.strip())
+        if member_name:
+            clauses.append("d.member_name LIKE ?"); params.append(member_name.strip().replace("%", "").replace("_", "") + "%")
+        if category_name:
+            clauses.append("d.category_name = ?"); params.append(category_name)
+        if date_from:
+            clauses.append("d.doc_date_iso >= ?"); params.append(date_from)
+        if date_to:
+            clauses.append("d.doc_date_iso <= ?"); params.append(date_to)
+        if text and text.strip():
+            # quote every word so user input can't break the FTS5 query syntax
+            fts_query = " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+            sql = """SELECT d.*, snippet(documents_fts, 1, '[', ']', '...', 12) AS snippet FROM documents_fts
+                     JOIN documents d ON d.id = documents_fts.rowid WHERE documents_fts MATCH ?"""
+            params.insert(0, fts_query)
+            sql += "".join(" AND " + clause for clause in clauses) + " ORDER BY rank LIMIT ?"
+        else:
+            sql = "SELECT d.* FROM documents d" + (" WHERE " + " AND ".join(clauses) if clauses else "") + " ORDER BY d.doc_date_iso DESC, d.id DESC LIMIT ?"
+        params.append(limit)
+        conn = self._connect()
+        try:
+            return [dict(row) for row in conn.execute(sql, params).fetchall()]
+        finally:
+            conn.close()
+
+    def contains(self, file_loc):
+        """True when a document with this file location has been indexed."""
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT 1 FROM documents WHERE file_loc = ?", (file_loc,)).fetchone() is not None
+        finally:
+            conn.close()
+
+    def training_documents(self, limit=None, label_sources=("llm", "manual")):
+        """(id, category_name, document_text) of indexed documents that have extracted text, newest first. Only labels
+        from label_sources count, the pre-classifier must not learn from its own guesses."""
+        conn = self._connect()
+        try:
+            sql = f"""SELECT d.id, d.category_name, f.document_text FROM documents d JOIN documents_fts f ON f.rowid = d.id
+                      WHERE f.document_text != '' AND d.category_name IS NOT NULL AND d.label_source IN ({",".join("?" * len(label_sources))})
+                      ORDER BY d.id DESC"""
+            params = list(label_sources) + ([limit] if limit else [])
+            return [tuple(row) for row in conn.execute(sql + (" LIMIT ?" if limit else ""), params)]
+        finally:
+            conn.close()
+
+    def known_members(self, member_numbers):
+        """member_number -> the member_name most often filed under it, for the numbers that are already in the index."""
+        member_numbers = list(dict.fromkeys(member_numbers))
+        if not member_numbers:
+            return {}
+        conn = self._connect()
+        try:
+            rows = conn.execute(f"""SELECT member_number, member_name, COUNT(*) AS n FROM documents
+                                    WHERE member_number IN ({",".join("?" * len(member_numbers))}) AND member_name IS NOT NULL
+                                    GROUP BY member_number, member_name ORDER BY n""", member_numbers).fetchall()
+            return {row["member_number"]: row["member_name"] for row in rows} # most frequent name wins, it comes last
+        finally:
+            conn.close()
+
+    def known_loan_types(self):
+        """Every loan type in the index. Read once per SEARCH_LOAN_TYPES_TTL_SECONDS, types added here show up right away."""
+        if self._loan_types is None or time.monotonic() - self._loan_types_loaded_at > SEARCH_LOAN_TYPES_TTL_SECONDS:
+            conn = self._connect()
+            try:
+                self._loan_types = {row[0] for row in conn.execute("SELECT DISTINCT loan_type FROM documents WHERE loan_type IS NOT NULL AND loan_type != ''")}
+            finally:
+                conn.close()
+            self._loan_types_loaded_at = time.monotonic()
+        return list(self._loan_types)
+
+    def count(self):
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        finally:
+            conn.close()
+
+    def rebuild(self, output_dir="./classified_output"):
+        """Backfills the index from every JSONL shard under output_dir (without text, which the shards don't keep). Returns the record count."""
+        indexed = 0
+        conn = self._connect()
+        try:
+            with conn:
+                for category in sorted(os.listdir(output_dir)):
+                    category_folder = os.path.join(output_dir, category)
+                    if not os.path.isdir(category_folder): continue
+                    for shard_path in list_shard_files(category_folder):
+                        for data_entry in read_jsonl_records(shard_path):
+                            self._upsert(conn, data_entry, None)
+                            indexed += 1
+        finally:
+            conn.close()
+        return indexed
+
+search_index = SearchIndex()
+
+
+##################   Index Analytics ##################   
+
+CONFIDENCE_BINS = 10 # confidence histogram buckets of 0.1
+
+class IndexAggregator:
+    """Running per-category counts and confidence histograms over the index shards.
+    Each refresh() only reads the bytes appended since the last one (tracked per shard by inode, size, mtime and
+    byte offset), so the cost follows new documents instead of the whole history. A compaction or any other
+    rewrite of a shard is detected and triggers a full rebuild."""
+
+    def __init__(self, output_dir="./classified_output", categories=None):
+        self.output_dir = output_dir
+        self.categories = categories
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.shards = {} # shard path -> {"inode", "size", "mtime_ns", "offset"}
+        self.category_counts = {}
+        self.confidence_histograms = {}
+        self.total = 0
+
+    def _fold(self, category_name, confidence_score):
+        self.category_counts[category_name] = self.category_counts.get(category_name, 0) + 1
+        histogram = self.confidence_histograms.setdefault(category_name, [0] * CONFIDENCE_BINS)
+        if confidence_score is not None:
+            histogram[min(int(float(confidence_score) * CONFIDENCE_BINS), CONFIDENCE_BINS - 1)] += 1
+        self.total += 1
+
+    def _current_shards(self):
+        """Yields (shard path, parquet path or None) for every JSONL shard, parquet only for sealed shards."""
+        categories = self.categories
+        if categories is None:
+            categories = sorted(c for c in os.listdir(self.output_dir) if os.path.isdir(os.path.join(self.output_dir, c))) if os.path.exists(self.output_dir) else []
+        for category in categories:
+            category_folder = os.path.join(self.output_dir, category)
+            if not os.path.exists(category_folder): continue
+            parquet_files = {}
+            manifest_path = os.path.join(category_folder, INDEX_MANIFEST_NAME)
+            if os.path.exists(manifest_path):
+                with open(manifest_path, 'r') as f:
+                    parquet_files = {shard["file"]: shard["parquet"] for shard in json.load(f)["shards"] if shard.get("parquet")}
+            for shard_path in list_shard_files(category_folder):
+                parquet_name = parquet_files.get(os.path.basename(shard_path))
+                yield shard_path, os.path.join(category_folder, parquet_name) if parquet_name else None
+
+    def refresh(self):
+        """Folds any new index lines into the running totals and returns summary()."""
+        with self._lock:
+            current = list(self._current_shards())
+            if not self._still_valid({path for path, _ in current}):
+                self._reset()
+            for shard_path, parquet_path in current:
+                self._consume(shard_path, parquet_path)
+            return self.summary()
+
+    def _still_valid(self, current_paths):
+        for shard_path, state in self.shards.items():
+            if shard_path not in current_paths:
+                return False
+            stat = os.stat(shard_path)
+            if stat.st_ino != state["inode"] or stat.st_size < state["offset"]:
+                return False
+        return True
+
+    def _consume(self, shard_path, parquet_path):
+        stat = os.stat(shard_path)
+        state = self.shards.get(shard_path)
+        if state is not None and state["size"] == stat.st_size and state["mtime_ns"] == stat.st_mtime_ns:
+            return # nothing appended since last time
+
+        if state is None and parquet_path and optional_module("pyarrow") is not None and os.path.exists(parquet_path):
+            # a sealed shard we have never seen, read just the two columns from its Parquet copy
+            table = optional_module("pyarrow.parquet").read_table(parquet_path, columns=["category_name", "confidence_score"])
+            for category_name, confidence_score in zip(table.column("category_name").to_pylist(), table.column("confidence_score").to_pylist()):
+                self._fold(category_name, confidence_score)
+            offset = stat.st_size
+        else:
+            offset = state["offset"] if state else 0
+            with open(shard_path, 'rb') as f:
+                f.seek(offset)
+                new_bytes = f.read(stat.st_size - offset)
+            # only take complete lines, a writer may be half way through the last one
+            complete = new_bytes[:new_bytes.rfind(b'\n') + 1]
+            for raw_line in complete.splitlines():
+                if not raw_line.strip(): continue
+                try:
+                    record = json.loads(raw_line)
+                except ValueError:
+                    continue
+                self._fold(record.get("category_name"), record.get("confidence_score"))
+            offset += len(complete)
+        self.shards[shard_path] = {"inode": stat.st_ino, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "offset": offset}
+
+    def summary(self):
+        return {"total": self.total,
+                "category_counts": dict(self.category_counts),
+                "confidence_histograms": {category: list(histogram) for category, histogram in self.confidence_histograms.items()}}
+
+
+##################   Result Cache Functions ##################   
+
+CACHE_DB_PATH = "./result_cache.sqlite3"
+CACHE_MAX_ENTRIES = 50000 # oldest (least recently used) results are evicted past this size
+CACHE_MAX_AGE_DAYS = 90 # results older than this are evicted
+CONFIDENCE_THRESHOLD = 0.80 # below this a document goes to exceptions, and its result is never cached
+
+def hash_file(filepath, chunk_size=1024 * 1024):
+    """Returns the sha256 of the file bytes, read in chunks so large scans are not held in memory."""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ResultCache:
+    """Persistent SQLite cache of classification results keyed by the sha256 of the file bytes.
+    A connection is opened per call so the cache can be shared by threads and worker processes."""
+
+    def __init__(self, db_path=CACHE_DB_PATH, max_entries=CACHE_MAX_ENTRIES, max_age_days=CACHE_MAX_AGE_DAYS):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self._initialized = False
+        self._init_lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        if not self._initialized:
+            with self._init_lock:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("""CREATE TABLE IF NOT EXISTS results (
+                                    content_hash TEXT PRIMARY KEY,
+                                    result_json TEXT NOT NULL,
+                                    created_at REAL NOT NULL,
+                                    last_used REAL NOT NULL,
+                                    hits INTEGER NOT NULL DEFAULT 0)""")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_results_last_used ON results (last_used)")
+                conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+                conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('hits', 0), ('misses', 0)")
+                conn.commit()
+                self._initialized = True
+        return conn
+
+    def get(self, content_hash):
+        """Returns the cached DocumentClassificationResult for this hash or None, and counts the hit/miss.
+        A low confidence entry (cached before put refused them) counts as a miss so the model is asked again."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute("SELECT result_json FROM results WHERE content_hash = ? AND created_at >= ?",
+                                   (content_hash, now - self.max_age_days * 86400)).fetchone()
+                result = DocumentClassificationResult.model_validate_json(row[0]) if row is not None else None
+                if result is None or result.confidence_score < CONFIDENCE_THRESHOLD:
+                    conn.execute("UPDATE counters SET value = value + 1 WHERE name = 'misses'")
+                    return None
+                conn.execute("UPDATE results SET last_used = ?, hits = hits + 1 WHERE content_hash = ?", (now, content_hash))
+                conn.execute("UPDATE counters SET value = value + 1 WHERE name = 'hits'")
+            return result
+        finally:
+            conn.close()
+
+    def put(self, content_hash, result):
+        """Stores an LLM result (without its file location) and evicts expired or least recently used entries.
+        Results below CONFIDENCE_THRESHOLD aren't stored, a re-submitted document (e.g. after review) gets a fresh answer."""
+        if result.confidence_score < CONFIDENCE_THRESHOLD:
+            return
+        now = time.time()
+        result_json = result.model_copy(update={"file_loc": None}).model_dump_json()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO results (content_hash, result_json, created_at, last_used, hits) VALUES (?, ?, ?, ?, 0)",
+                             (content_hash, result_json, now, now))
+                self._evict(conn, now)
+        finally:
+            conn.close()
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM results WHERE created_at < ?", (now - self.max_age_days * 86400,))
+        conn.execute("""DELETE FROM results WHERE content_hash IN (
+                            SELECT content_hash FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)""", (self.max_entries,))
+
+    def stats(self):
+        """Returns the hit/miss counters and current size of the cache."""
+        conn = self._connect()
+        try:
+            counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+            entries = conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        finally:
+            conn.close()
+        lookups = counters["hits"] + counters["misses"]
+        return {"hits": counters["hits"], "misses": counters["misses"], "entries": entries,
+                "hit_rate": counters["hits"] / lookups if lookups else 0.0}
+
+result_cache = ResultCache()
+
+
+##################   Exception Previews ##################   
+
+PREVIEW_CACHE_DIR = "./.preview_cache"
+PREVIEW_MAX_DIMENSION = 1200 # plenty for the 600px high review pane
+PREVIEW_WEBP_QUALITY = 80
+PREVIEW_CACHE_MAX_FILES = 500
+PREVIEW_PREFETCH = 3 # exceptions after the current one rendered ahead of time
+
+class PreviewCache:
+    """Downscaled WebP thumbnails (images, TIFF scans) and pre-rendered HTML (DOCX) for the Review Exceptions tab,
+    keyed by path, mtime and size so a replaced file gets a fresh preview. PDFs are left to the PDF viewer."""
+
+    def __init__(self, cache_dir=PREVIEW_CACHE_DIR, max_files=PREVIEW_CACHE_MAX_FILES):
+        self.cache_dir = cache_dir
+        self.max_files = max_files
+        self._executor = None
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    def _key(self, filepath):
+        stat = os.stat(filepath)
+        return hashlib.sha1(f"{os.path.abspath(filepath)}|{stat.st_mtime_ns}|{stat.st_size}".encode()).hexdigest()
+
+    def _cached(self, key):
+        for kind, extension in (("image", ".webp"), ("html", ".html")):
+            path = os.path.join(self.cache_dir, key + extension)
+            if os.path.exists(path):
+                return {"kind": kind, "path": path}
+        return None
+
+    def render(self, filepath, mime_type):
+        """Builds the preview file, returns its path or None for types without a cached preview."""
+        key = self._key(filepath)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if mime_type == DOCX_MIME_TYPE and optional_module("mammoth") is not None:
+            with open(filepath, "rb") as docx_file:
+                html = optional_module("mammoth").convert_to_html(docx_file).value
+            target_path, tmp_path = os.path.join(self.cache_dir, key + ".html"), os.path.join(self.cache_dir, key + ".html.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(html)
+        elif mime_type and mime_type.startswith("image/"):
+            with Image.open(filepath) as img:
+                # JPEG can decode straight at a reduced scale, far cheaper than the full resolution scan
+                img.draft("RGB", (PREVIEW_MAX_DIMENSION, PREVIEW_MAX_DIMENSION))
+                img = normalize_16bit(img).convert("RGB")
+                img.thumbnail((PREVIEW_MAX_DIMENSION, PREVIEW_MAX_DIMENSION))
+                target_path, tmp_path = os.path.join(self.cache_dir, key + ".webp"), os.path.join(self.cache_dir, key + ".webp.tmp")
+                img.save(tmp_path, format="WEBP", quality=PREVIEW_WEBP_QUALITY)
+        else:
+            return None
+        os.replace(tmp_path, target_path)
+        return target_path
+
+    def get(self, filepath, mime_type=None):
+        """{"kind": "image" | "html", "path": cached file}, rendering it now if it isn't cached yet. None when the type
+        has no cached preview (PDFs) or the file is gone."""
+        try:
+            cached = self._cached(self._key(filepath))
+            if cached is None and self.render(filepath, mime_type or get_file_type(filepath)) is not None:
+                cached = self._cached(self._key(filepath))
+            return cached
+        except FileNotFoundError:
+            return None
+
+    def _render_quietly(self, filepath, key):
+        try:
+            if self._cached(key) is None:
+                self.render(filepath, get_file_type(filepath))
+        except Exception as e:
+            logging.warning(f"PREVIEW: could not render {filepath}: {e}")
+        finally:
+            with self._lock:
+                self._in_flight.discard(key)
+
+    def prefetch(self, filepaths):
+        """Renders previews for these files on a background thread, skipping ones that are cached or already queued."""
+        for filepath in filepaths:
+            try:
+                key = self._key(filepath)
+            except OSError:
+                continue
+            with self._lock:
+                if key in self._in_flight or self._cached(key) is not None:
+                    continue
+                self._in_flight.add(key)
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="preview")
+            self._executor.submit(self._render_quietly, filepath, key)
+        self.prune()
+
+    def prune(self):
+        """Drops the oldest previews beyond max_files (previews of reviewed files are never looked up again)."""
+        try:
+            entries = [entry for entry in os.scandir(self.cache_dir) if not entry.name.endswith(".tmp")]
+        except FileNotFoundError:
+            return
+        if len(entries) <= self.max_files:
+            return
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime)[:len(entries) - self.max_files]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+preview_cache = PreviewCache()
+
+
+##################   Pipeline Metrics ##################   
+
+METRICS_JSON_PATH = "./metrics.json"
+METRICS_PROM_PATH = "./metrics.prom" # Prometheus text format, point node_exporter's textfile collector at it
+METRICS_RESERVOIR_SIZE = 5000 # most recent samples kept per (stage, mime type) for the percentiles
+METRICS_DB_PATH = "./metrics.sqlite3" # lifetime counters, every process (dashboard, watch/process workers) adds to them
+METRICS_PROCESS_DIR = "./.metrics" # each process's own stage timings, merged into metrics.json/metrics.prom
+METRICS_PROCESS_MAX_AGE_DAYS = 7 # timings of a process that hasn't exported for this long are dropped
+NESTED_STAGES = {"llm_wait"} # time already counted inside another stage, left out of the per document total
+
+@contextmanager
+def stage_timer(timings, stage):
+    """Adds the wall clock seconds spent in the block to timings[stage], even when the block raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+def percentile(sorted_values, fraction):
+    """Nearest rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))]
+
+class PipelineMetrics:
+    """Per stage latency histograms broken down by mime type, plus simple counters.
+    Stages: mime, hash, cache_lookup, extract_native, extract_unstructured, extract_ocr, encode_image, llm, move, index and total."""
+
+    def __init__(self, reservoir_size=METRICS_RESERVOIR_SIZE):
+        self.reservoir_size = reservoir_size
+        self._lock = threading.Lock()
+        self.samples = {} # (stage, mime type) -> recent durations
+        self.totals = {} # (stage, mime type) -> [count, sum of seconds] over the whole run
+        self.counters = collections.Counter()
+        self.exported_counters = collections.Counter() # what has already been added to the shared counters
+        self.process_id = f"{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+
+    def record(self, stage, mime_type, seconds):
+        key = (stage, mime_type or "unknown")
+        with self._lock:
+            self.samples.setdefault(key, collections.deque(maxlen=self.reservoir_size)).append(seconds)
+            total = self.totals.setdefault(key, [0, 0.0])
+            total[0] += 1
+            total[1] += seconds
+
+    def record_timings(self, mime_type, timings):
+        """Records every stage of one document plus a total for the document."""
+        for stage, seconds in timings.items():
+            self.record(stage, mime_type, seconds)
+        self.record("total", mime_type, sum(seconds for stage, seconds in timings.items() if stage not in NESTED_STAGES))
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def snapshot(self):
+        """Returns {"stages": [{stage, mime_type, count, mean_ms, p50_ms, p95_ms, p99_ms}], "counters": {...}}."""
+        with self._lock:
+            items = [(key, sorted(values), list(self.totals[key])) for key, values in self.samples.items()]
+            counters = dict(self.counters)
+        stages = []
+        for (stage, mime_type), values, (count, seconds) in sorted(items):
+            stages.append({"stage": stage, "mime_type": mime_type, "count": count,
+                           "mean_ms": seconds / count * 1000,
+                           "p50_ms": percentile(values, 0.50) * 1000,
+                           "p95_ms": percentile(values, 0.95) * 1000,
+                           "p99_ms": percentile(values, 0.99) * 1000})
+        return {"generated_at": datetime.datetime.now().isoformat(timespec="seconds"), "stages": stages, "counters": counters}
+
+    def to_prometheus(self, snapshot=None):
+        """Renders the snapshot as Prometheus summaries (quantiles in seconds) and counters."""
+        snapshot = snapshot or self.snapshot()
+        lines = ["# HELP doc_classifier_stage_seconds Time spent in each pipeline stage per document.",
+                 "# TYPE doc_classifier_stage_seconds summary"]
+        for row in snapshot["stages"]:
+            labels = f'stage="{row["stage"]}",mime_type="{row["mime_type"]}"'
+            for quantile in ("50", "95", "99"):
+                lines.append(f'doc_classifier_stage_seconds{{{labels},quantile="0.{quantile}"}} {row[f"p{quantile}_ms"] / 1000:.6f}')
+            lines.append(f"doc_classifier_stage_seconds_sum{{{labels}}} {row['mean_ms'] * row['count'] / 1000:.6f}")
+            lines.append(f"doc_classifier_stage_seconds_count{{{labels}}} {row['count']}")
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"# TYPE doc_classifier_{name} counter")
+            lines.append(f"doc_classifier_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, json_path=METRICS_JSON_PATH, prom_path=METRICS_PROM_PATH, store=None, process_dir=METRICS_PROCESS_DIR):
+        """Adds the counters since the last export to the shared store, saves this process's stage timings, then
+        writes the JSON metrics file and the Prometheus text file for every process combined (swapped in atomically).
+        Several processes export to the same files, so each of them writes the merged view, never just its own."""
+        store = store or metrics_store
+        with self._lock:
+            deltas = self.counters - self.exported_counters
+        store.add(deltas)
+        with self._lock:
+            self.exported_counters.update(deltas)
+
+        os.makedirs(process_dir, exist_ok=True)
+        write_atomic(os.path.join(process_dir, f"{self.process_id}.json"), json.dumps(self.snapshot()))
+        merged = merge_metric_snapshots(load_process_snapshots(process_dir), store.totals())
+        for path, content in ((json_path, json.dumps(merged, indent=1)), (prom_path, self.to_prometheus(merged))):
+            if path:
+                write_atomic(path, content)
+        return merged
+
+def write_atomic(path, content):
+    with open(path + ".tmp", 'w') as f:
+        f.write(content)
+    os.replace(path + ".tmp", path)
+
+class MetricsStore:
+    """Lifetime pipeline counters in SQLite, so totals survive restarts and add up across processes.
+    Same connection per call pattern as ResultCache."""
+
+    def __init__(self, db_path=METRICS_DB_PATH):
+        self.db_path = db_path
+        self._initialized = False
+        self._init_lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        if not self._initialized:
+            with self._init_lock:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+                conn.commit()
+                self._initialized = True
+        return conn
+
+    def add(self, deltas):
+        if not deltas:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("""INSERT INTO counters (name, value) VALUES (?, ?)
+                                    ON CONFLICT (name) DO UPDATE SET value = value + excluded.value""", list(deltas.items()))
+        finally:
+            conn.close()
+
+    def totals(self):
+        conn = self._connect()
+        try:
+            return dict(conn.execute("SELECT name, value FROM counters").fetchall())
+        finally:
+            conn.close()
+
+def load_process_snapshots(process_dir=METRICS_PROCESS_DIR, max_age_days=METRICS_PROCESS_MAX_AGE_DAYS):
+    """The stage timing snapshots every process exported, dropping those of processes long gone."""
+    snapshots = []
+    for entry in os.scandir(process_dir) if os.path.isdir(process_dir) else []:
+        if not entry.name.endswith(".json"):
+            continue
+        try:
+            if entry.stat().st_mtime < time.time() - max_age_days * 86400:
+                os.remove(entry.path)
+                continue
+            with open(entry.path, 'r') as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue # removed or being replaced by another process
+    return snapshots
+
+def merge_metric_snapshots(snapshots, counters):
+    """Combines per process stage timings: counts and means are exact, the medians are count weighted and p95/p99 are
+    the worst process's (the raw samples stay in each process, so tail percentiles can't be merged exactly)."""
+    rows_by_key = {}
+    for snapshot in snapshots:
+        for row in snapshot["stages"]:
+            rows_by_key.setdefault((row["stage"], row["mime_type"]), []).append(row)
+    stages = []
+    for (stage, mime_type), rows in sorted(rows_by_key.items()):
+        count = sum(row["count"] for row in rows)
+        stages.append({"stage": stage, "mime_type": mime_type, "count": count,
+                       "mean_ms": sum(row["mean_ms"] * row["count"] for row in rows) / count,
+                       "p50_ms": sum(row["p50_ms"] * row["count"] for row in rows) / count,
+                       "p95_ms": max(row["p95_ms"] for row in rows),
+                       "p99_ms": max(row["p99_ms"] for row in rows)})
+    return {"generated_at": datetime.datetime.now().isoformat(timespec="seconds"), "processes": len(snapshots),
+            "stages": stages, "counters": counters}
+
+pipeline_metrics = PipelineMetrics()
+metrics_store = MetricsStore()
+
+def load_metrics(json_path=METRICS_JSON_PATH):
+    """Reads the last exported metrics snapshot, or None if nothing has been processed yet."""
+    if not os.path.exists(json_path):
+        return None
+    with open(json_path, 'r') as f:
+        return json.load(f)
+
+
+##################   LLM Rate Limiting ##################   
+
+# account budgets for the model, check the limits page of the OpenAI dashboard for the current tier. Defaults, the
+# LLM_REQUESTS_PER_MINUTE / LLM_TOKENS_PER_MINUTE environment variables (or --llm-rpm / --llm-tpm) override them
+LLM_REQUESTS_PER_MINUTE = 500
+LLM_TOKENS_PER_MINUTE = 30000
+LLM_MAX_RETRIES = 6 # transient failures (429, timeouts, 5xx) are retried this many times before the file goes to exceptions
+LLM_BACKOFF_BASE_SECONDS = 1.0
+LLM_BACKOFF_MAX_SECONDS = 60.0
+
+# rough token costs used to charge the budget before a call, the API only reports real usage afterwards
+PROMPT_OVERHEAD_TOKENS = 350 # system prompt and the function schema
+IMAGE_TOKENS = 765 # one high detail image after prepare_image's downscale (85 base + 170 per 512px tile)
+COMPLETION_TOKENS = 150
+
+@functools.lru_cache(maxsize=None)
+def transient_llm_errors():
+    """ Errors worth retrying: 429s, timeouts, dropped connections and 5xx (imported on first use, openai is slow to import) """
+    import openai
+    import httpx
+    return (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError,
+            httpx.TimeoutException, httpx.TransportError)
+
+def estimate_tokens(document_text, base64_image):
+    """ Approximate tokens a classification request will use, about 4 characters of text per token """
+    tokens = PROMPT_OVERHEAD_TOKENS + COMPLETION_TOKENS + len((document_text or "")[:TEXT_CHAR_BUDGET]) // 4
+    if base64_image:
+        tokens += IMAGE_TOKENS
+    return tokens
+
+def retry_after_seconds(error):
+    """ The server's Retry-After hint (retry-after-ms / retry-after headers) on a 429, None if it didn't send one """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+def llm_budgets():
+    """ (requests, tokens) per minute from the environment or the defaults above, 0 or "none" disables a budget """
+    budgets = []
+    for name, default in (("LLM_REQUESTS_PER_MINUTE", LLM_REQUESTS_PER_MINUTE), ("LLM_TOKENS_PER_MINUTE", LLM_TOKENS_PER_MINUTE)):
+        value = os.environ.get(name, "").strip().lower()
+        if not value:
+            budgets.append(default)
+        elif value in ("0", "none"):
+            budgets.append(None)
+        else:
+            budgets.append(int(value))
+    return tuple(budgets)
+
+class RateLimiter:
+    """Sliding 60 second window over requests and tokens. Callers queue in acquire() until both budgets have room,
+    so the LLM workers are paced instead of all firing and collecting 429s. None disables a budget."""
+
+    def __init__(self, requests_per_minute=LLM_REQUESTS_PER_MINUTE, tokens_per_minute=LLM_TOKENS_PER_MINUTE, window_seconds=60.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock() # held while waiting so callers are served roughly in arrival order
+        self._window = collections.deque() # (time sent, tokens charged)
+        self._tokens_in_window = 0
+        self._paused_until = 0.0
+
+    def _expire(self, now):
+        while self._window and self._window[0][0] <= now - self.window_seconds:
+            self._tokens_in_window -= self._window.popleft()[1]
+
+    def _seconds_until_room(self, now, tokens):
+        wait_for = self._paused_until - now
+        if self.requests_per_minute and len(self._window) >= self.requests_per_minute:
+            wait_for = max(wait_for, self._window[-self.requests_per_minute][0] + self.window_seconds - now)
+        if self.tokens_per_minute and self._tokens_in_window + tokens > self.tokens_per_minute:
+            # wait until enough of the oldest calls slide out of the window
+            freed = self.tokens_per_minute - self._tokens_in_window
+            for sent_at, charged in self._window:
+                freed += charged
+                if freed >= tokens:
+                    wait_for = max(wait_for, sent_at + self.window_seconds - now)
+                    break
+        return wait_for
+
+    def acquire(self, tokens=0):
+        """Blocks until a request of this many tokens fits in the budget, returns the seconds spent waiting."""
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute) # an oversized request would otherwise never fit
+        start = time.monotonic()
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                self._expire(now)
+                wait_for = self._seconds_until_room(now, tokens)
+                if wait_for <= 0:
+                    self._window.append((now, tokens))
+                    self._tokens_in_window += tokens
+                    return now - start
+                time.sleep(min(wait_for, 1.0)) # re-check at least every second in case pause() moved the goalposts
+
+    def pause(self, seconds):
+        """Holds back every caller for a while, used when the server says we're over the limit."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+class LLMScheduler:
+    """Wraps model calls with the rate limiter and retries transient errors with jittered exponential backoff.
+    Only the final failure is raised, so a burst of 429s slows the pipeline down instead of filling exceptions/."""
+
+    def __init__(self, limiter=None, max_retries=LLM_MAX_RETRIES, backoff_base=LLM_BACKOFF_BASE_SECONDS, backoff_max=LLM_BACKOFF_MAX_SECONDS):
+        self.limiter = limiter or RateLimiter(*llm_budgets())
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def backoff_seconds(self, attempt, error):
+        """Full jitter backoff, never sooner than the server asked for."""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = retry_after_seconds(error)
+        return max(delay, retry_after) if retry_after is not None else delay
+
+    def run(self, call, tokens=0, timings=None):
+        """Runs call() inside the budget, retrying transient errors. Time spent queued is recorded as the llm_wait stage."""
+        waited = 0.0
+        try:
+            for attempt in range(self.max_retries + 1):
+                waited += self.limiter.acquire(tokens)
+                try:
+                    result = call()
+                    pipeline_metrics.increment("llm_requests_total")
+                    return result
+                except transient_llm_errors() as e:
+                    if attempt == self.max_retries:
+                        pipeline_metrics.increment("llm_failures_total")
+                        raise
+                    delay = self.backoff_seconds(attempt, e)
+                    if getattr(e, "status_code", None) == 429: # openai.RateLimitError
+                        pipeline_metrics.increment("llm_rate_limited_total")
+                        self.limiter.pause(delay) # every worker backs off, not just this one
+                    pipeline_metrics.increment("llm_retries_total")
+                    logging.warning(f"LLM RETRY: {type(e).__name__} on attempt {attempt + 1}/{self.max_retries + 1}, retrying in {delay:.1f}s.")
+                    time.sleep(delay)
+                    waited += delay
+        finally:
+            if timings is not None:
+                timings["llm_wait"] = timings.get("llm_wait", 0.0) + waited
+
+
+##################   Classifier Client ##################   
+
+CLASSIFIER_SYSTEM_PROMPT = "You are an expert document classifier. Classify the input into one of three categories: Memberdoc, Loans, or Statements. Extract structured data including a confidence score into the JSON schema."
+CLASSIFIER_BATCH_SYSTEM_PROMPT = CLASSIFIER_SYSTEM_PROMPT + " The input contains several numbered documents: classify each one on its own and return exactly one result per document, with its document_id."
+
+LLM_BATCH_SIZE = 1 # small text documents packed into one request, 1 sends every document on its own
+LLM_BATCH_MAX_CHARS = TEXT_CHAR_BUDGET # only text documents up to this size are packed, images and long documents go alone
+LLM_BATCH_WAIT_SECONDS = 0.5 # how long a document waits for others to fill its batch
+
+class DocumentClassifier:
+    """ Owns one pooled HTTP client and a prebuilt prompt | structured output chain that is reused for every document.
+    Pass `llm` to swap in any chat model that supports with_structured_output (e.g. a local fake in tests).
+    With batch_size > 1 small text documents classified from concurrent threads are packed into shared requests. """
+
+    def __init__(self, llm=None, model="gpt-4o", max_connections=20, scheduler=None, base_url=None, api_key=None,
+                 batch_size=LLM_BATCH_SIZE, batch_wait_seconds=LLM_BATCH_WAIT_SECONDS):
+        from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+        if llm is None:
+            import httpx
+            from langchain_openai import ChatOpenAI
+            # keep-alive connection pool shared by every request so we skip the TCP/TLS setup per document
+            self.http_client = httpx.Client(limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+                                            timeout=httpx.Timeout(60.0, connect=10.0))
+            # retries are left to the scheduler so they are paced by the same budget as first attempts
+            llm = ChatOpenAI(api_key=api_key or get_openai_api_key(), model=model, temperature=0, http_client=self.http_client,
+                             base_url=base_url, max_retries=0)
+        else:
+            self.http_client = None
+        self.llm = llm
+        self.model = model
+        self.scheduler = scheduler or LLMScheduler()
+
+        # the document is passed in as an input variable so the template and schema are only built once
+        prompt_template = ChatPromptTemplate.from_messages([
+            ("system", CLASSIFIER_SYSTEM_PROMPT),
+            MessagesPlaceholder("document")
+        ])
+        # forced function calling, the same request request_body() writes for the Batch API export
+        self.chain = prompt_template | llm.with_structured_output(DocumentClassificationResult, method="function_calling")
+        # output here will be in the pydantic structure defined earlier
+
+        batch_template = ChatPromptTemplate.from_messages([
+            ("system", CLASSIFIER_BATCH_SYSTEM_PROMPT),
+            MessagesPlaceholder("document")
+        ])
+        self.batch_chain = batch_template | llm.with_structured_output(DocumentBatchClassificationResult, method="function_calling")
+        self.batcher = ClassificationBatcher(self, batch_size, batch_wait_seconds) if batch_size > 1 else None
+
+    def build_message(self, mime_type, document_text, base64_image):
+        """ Prepare multimodal input. only capture the first TEXT_CHAR_BUDGET characters to prevent AI context window threshold """
+        llm_input_content = [{"type": "text", "text": f"Classify this document based on its content and extracted text: {document_text[:TEXT_CHAR_BUDGET]}."}]
+        if base64_image:
+            llm_input_content.append({"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{base64_image}"}})
+        from langchain_core.messages import HumanMessage
+        return HumanMessage(content=llm_input_content)
+
+    def build_batch_message(self, document_texts):
+        """ One message holding several documents, numbered from 1 so results can be matched back by document_id """
+        parts = [f"Classify each of these {len(document_texts)} documents based on its extracted text."]
+        for document_id, document_text in enumerate(document_texts, start=1):
+            parts.append(f"--- Document {document_id} ---\n{document_text[:TEXT_CHAR_BUDGET]}")
+        from langchain_core.messages import HumanMessage
+        return HumanMessage(content=[{"type": "text", "text": "\n\n".join(parts)}])
+
+    def is_batchable(self, document_text, base64_image):
+        return self.batcher is not None and not base64_image and bool(document_text) and len(document_text) <= LLM_BATCH_MAX_CHARS
+
+    def classify(self, mime_type, document_text, base64_image, timings=None):
+        """ Sends the extracted text and image to the AI and returns the structured classification """
+        if self.is_batchable(document_text, base64_image):
+            result = self.batcher.classify(document_text, timings)
+            if result is not None:
+                return result
+            # the batched answer skipped this document, ask about it on its own
+        document = {"document": [self.build_message(mime_type, document_text, base64_image)]}
+        return self.scheduler.run(lambda: self.chain.invoke(document), estimate_tokens(document_text, base64_image), timings)
+
+    def classify_many(self, document_texts, timings=None):
+        """ Classifies several text documents in one request. Returns results in input order, None for any document
+        the model left out of its answer """
+        document = {"document": [self.build_batch_message(document_texts)]}
+        tokens = PROMPT_OVERHEAD_TOKENS + sum(estimate_tokens(text, None) - PROMPT_OVERHEAD_TOKENS for text in document_texts)
+        batch = self.scheduler.run(lambda: self.batch_chain.invoke(document), tokens, timings)
+        by_id = {result.document_id: DocumentClassificationResult(**result.model_dump(exclude={"document_id"})) for result in batch.results}
+        return [by_id.get(document_id) for document_id in range(1, len(document_texts) + 1)]
+
+    def request_body(self, message, batched=False):
+        """ The chat completions request this classifier would send for a message, as an OpenAI Batch API body.
+        Mirrors with_structured_output(method="function_calling") used by the online chains. """
+        schema = DocumentBatchClassificationResult if batched else DocumentClassificationResult
+        from langchain_core.utils.function_calling import convert_to_openai_tool
+        tool = convert_to_openai_tool(schema)
+        return {"model": self.model, "temperature": 0,
+                "messages": [{"role": "system", "content": CLASSIFIER_BATCH_SYSTEM_PROMPT if batched else CLASSIFIER_SYSTEM_PROMPT},
+                             {"role": "user", "content": message.content}],
+                "tools": [tool], "tool_choice": {"type": "function", "function": {"name": tool["function"]["name"]}},
+                "parallel_tool_calls": False}
+
+    def close(self):
+        if self.http_client is not None:
+            self.http_client.close()
+
+class ClassificationBatcher:
+    """ Collects small documents from the LLM worker threads into shared requests. A batch is sent by the thread that
+    fills it, or by the first waiting thread once LLM_BATCH_WAIT_SECONDS pass, every thread then picks up its own result. """
+
+    def __init__(self, classifier, batch_size, wait_seconds):
+        self.classifier = classifier
+        self.batch_size = batch_size
+        self.wait_seconds = wait_seconds
+        self._lock = threading.Lock()
+        self._pending = [] # (document text, future)
+
+    def _take(self):
+        batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+        return batch
+
+    def _send(self, batch, timings):
+        try:
+            results = self.classifier.classify_many([text for text, _ in batch], timings)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        pipeline_metrics.increment("llm_batched_documents_total", len(batch))
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def classify(self, document_text, timings=None):
+        """ Blocks until the batch holding this document has been answered, None if the model skipped it """
+        future = Future()
+        with self._lock:
+            self._pending.append((document_text, future))
+            batch = self._take() if len(self._pending) >= self.batch_size else None
+        if batch:
+            self._send(batch, timings)
+        try:
+            return future.result(timeout=self.wait_seconds)
+        except FutureTimeoutError:
+            with self._lock:
+                batch = self._take() if any(pending is future for _, pending in self._pending) else None
+            if batch:
+                self._send(batch, timings)
+            return future.result()
+
+_classifier = None
+_classifier_lock = threading.Lock()
+
+def get_classifier():
+    """ Returns the module level classifier, building it on first use """
+    global _classifier
+    if _classifier is None:
+        with _classifier_lock:
+            if _classifier is None:
+                _classifier = DocumentClassifier()
+    return _classifier
+
+def set_classifier(classifier):
+    """ Injects the classifier used by process_file_with_ai / process_batch (None resets to the default gpt-4o client) """
+    global _classifier
+    with _classifier_lock:
+        _classifier = classifier
+
+def classify_document(mime_type, document_text, base64_image, timings=None):
+    """ Sends the extracted text and image to the AI and returns the structured classification """
+    return get_classifier().classify(mime_type, document_text, base64_image, timings)
+
+
+##################   Local Pre-classifier ##################   
+
+PRECLASSIFIER_MODEL_PATH = "./preclassifier.json"
+PRECLASSIFIER_TARGET_AGREEMENT = 0.98 # accept local predictions only above the margin where held out agreement with the LLM reaches this
+PRECLASSIFIER_MIN_DOCUMENTS = 20 # per category, smaller categories are left to the LLM
+PRECLASSIFIER_MAX_FEATURES = 5000
+PRECLASSIFIER_MAX_TRAINING_DOCUMENTS = 50000
+PRECLASSIFIER_AUDIT_RATE = 0.05 # share of locally accepted documents also sent to the LLM to keep measuring agreement
+MEMBER_NUMBER_PATTERN = re.compile(r"\b\d{5,12}\b")
+DATE_PATTERN = re.compile(r"\b(\d{4}[-/]\d{1,2}[-/]\d{1,2}|\d{1,2}[-/]\d{1,2}[-/]\d{2,4}|[A-Z][a-z]{2,8}\.? \d{1,2}, \d{4}|\d{1,2} [A-Z][a-z]{2,8} \d{4})\b")
+
+def tokenize(text):
+    return re.findall(r"[a-z]{3,}", text.lower())
+
+class LocalPreClassifier:
+    """TF-IDF nearest centroid model (a linear classifier) over the extracted text of already classified documents.
+    The confidence of a prediction is the cosine margin between the best and second best category."""
+
+    def __init__(self, idf, centroids, margin_threshold=None, holdout=None):
+        self.idf = idf # token -> idf weight
+        self.centroids = centroids # category -> {token: weight}, unit length
+        self.margin_threshold = margin_threshold # None: never accept, everything goes to the LLM
+        self.holdout = holdout or {} # evaluation on held out documents, kept for the report
+
+    def vectorize(self, text):
+        counts = collections.Counter(token for token in tokenize(text) if token in self.idf)
+        vector = {token: (1 + math.log(count)) * self.idf[token] for token, count in counts.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        return {token: weight / norm for token, weight in vector.items()} if norm else {}
+
+    def predict(self, text):
+        """(category, margin), category is None when the text shares nothing with the training documents."""
+        vector = self.vectorize(text)
+        if not vector or not self.centroids:
+            return None, 0.0
+        scores = sorted(((sum(weight * centroid.get(token, 0.0) for token, weight in vector.items()), category)
+                         for category, centroid in self.centroids.items()), reverse=True)
+        margin = scores[0][0] - (scores[1][0] if len(scores) > 1 else 0.0)
+        return scores[0][1], margin
+
+    def accepts(self, margin):
+        return self.margin_threshold is not None and margin >= self.margin_threshold
+
+    @classmethod
+    def fit(cls, documents, max_features=PRECLASSIFIER_MAX_FEATURES):
+        """documents: (category, text) pairs."""
+        document_frequency = collections.Counter()
+        for _, text in documents:
+            document_frequency.update(set(tokenize(text)))
+        vocabulary = [token for token, df in document_frequency.most_common(max_features) if df >= 2]
+        idf = {token: math.log((len(documents) + 1) / (document_frequency[token] + 1)) + 1 for token in vocabulary}
+        model = cls(idf, {})
+        sums = {}
+        for category, text in documents:
+            centroid = sums.setdefault(category, collections.Counter())
+            centroid.update(model.vectorize(text))
+        for category, centroid in sums.items():
+            norm = math.sqrt(sum(weight * weight for weight in centroid.values()))
+            model.centroids[category] = {token: weight / norm for token, weight in centroid.items()} if norm else {}
+        return model
+
+    def save(self, path=PRECLASSIFIER_MODEL_PATH):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"idf": self.idf, "centroids": self.centroids, "margin_threshold": self.margin_threshold, "holdout": self.holdout}, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=PRECLASSIFIER_MODEL_PATH):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["idf"], data["centroids"], data.get("margin_threshold"), data.get("holdout"))
+
+def choose_margin_threshold(predictions, target_agreement=PRECLASSIFIER_TARGET_AGREEMENT, min_accepted=PRECLASSIFIER_MIN_DOCUMENTS):
+    """Lowest margin at which the held out predictions at or above it still agree with the LLM label often enough.
+    predictions: (margin, agreed) pairs. Returns (threshold or None, share accepted, agreement of the accepted)."""
+    best = (None, 0.0, 0.0)
+    agreed = 0
+    ranked = sorted(predictions, reverse=True)
+    for accepted, (margin, correct) in enumerate(ranked, start=1):
+        agreed += correct
+        if accepted >= min_accepted and agreed / accepted >= target_agreement:
+            best = (margin, accepted / len(ranked), agreed / accepted)
+    return best
+
+def train_preclassifier(model_path=PRECLASSIFIER_MODEL_PATH, search=None, target_agreement=PRECLASSIFIER_TARGET_AGREEMENT):
+    """ Trains the pre-classifier from the search index (LLM and reviewer labels + extracted text, never its own past
+    guesses), picks the acceptance margin on a held out fifth of the documents, then refits on everything and saves it.
+    Returns the held out report """
+    rows = (search or search_index).training_documents(PRECLASSIFIER_MAX_TRAINING_DOCUMENTS)
+    per_category = collections.Counter(category for _, category, _ in rows)
+    rows = [row for row in rows if per_category[row[1]] >= PRECLASSIFIER_MIN_DOCUMENTS]
+    if len({category for _, category, _ in rows}) < 2:
+        raise ValueError(f"Not enough classified documents with text to train on: {dict(per_category)} (need {PRECLASSIFIER_MIN_DOCUMENTS} in at least two categories).")
+
+    train = [(category, text) for doc_id, category, text in rows if doc_id % 5]
+    holdout = [(category, text) for doc_id, category, text in rows if not doc_id % 5]
+    model = LocalPreClassifier.fit(train)
+    predictions = []
+    for category, text in holdout:
+        predicted, margin = model.predict(text)
+        predictions.append((margin, predicted == category))
+    threshold, coverage, agreement = choose_margin_threshold(predictions, target_agreement)
+
+    model = LocalPreClassifier.fit([(category, text) for _, category, text in rows])
+    model.margin_threshold = threshold
+    model.holdout = {"documents": len(holdout), "overall_agreement": sum(correct for _, correct in predictions) / len(predictions) if predictions else 0.0,
+                     "margin_threshold": threshold, "coverage": coverage, "agreement_when_accepted": agreement,
+                     "training_documents": len(rows), "categories": {category: per_category[category] for category in model.centroids}}
+    model.save(model_path)
+    logging.info(f"PRECLASSIFIER: trained on {len(rows)} documents, held out report {model.holdout}")
+    return model.holdout
+
+_preclassifier = None
+_preclassifier_mtime = None
+_preclassifier_lock = threading.Lock()
+
+def get_preclassifier(model_path=PRECLASSIFIER_MODEL_PATH):
+    """ The trained pre-classifier, reloaded when the model file changes, None when there is no model yet """
+    global _preclassifier, _preclassifier_mtime
+    try:
+        mtime = os.stat(model_path).st_mtime
+    except OSError:
+        return None
+    if mtime != _preclassifier_mtime:
+        with _preclassifier_lock:
+            if mtime != _preclassifier_mtime:
+                _preclassifier = LocalPreClassifier.load(model_path)
+                _preclassifier_mtime = mtime
+    return _preclassifier
+
+def find_doc_date(text):
+    for match in DATE_PATTERN.finditer(text):
+        if normalize_doc_date(match.group(0)):
+            return match.group(0)
+    return None
+
+def preclassify(document_text):
+    """ Returns (predicted category or None, DocumentClassificationResult when it can be filed without the LLM).
+    Besides a confident category the member has to be identifiable: exactly one number in the text that is already
+    a known member number in the index, whose name we take from there. Everything else is escalated to the LLM """
+    model = get_preclassifier()
+    if model is None or not document_text:
+        return None, None
+    category, margin = model.predict(document_text)
+    if category is None or not model.accepts(margin):
+        return category, None
+    members = search_index.known_members(MEMBER_NUMBER_PATTERN.findall(document_text))
+    if len(members) != 1:
+        return category, None
+    member_number, member_name = next(iter(members.items()))
+    lowered = document_text.lower()
+    loan_type = next((loan_type for loan_type in search_index.known_loan_types() if loan_type.lower() in lowered), None) if category == "Loans" else None
+    confidence = model.holdout.get("agreement_when_accepted") or PRECLASSIFIER_TARGET_AGREEMENT
+    return category, DocumentClassificationResult(category_name=category, confidence_score=round(confidence, 4), member_name=member_name,
+                                                  member_number=member_number, doc_date=find_doc_date(document_text), loan_type=loan_type)
+
+def preclassifier_report(counters=None):
+    """ LLM calls saved and agreement with the LLM, by default from the lifetime counters of every process """
+    if counters is None:
+        counters = metrics_store.totals()
+    accepted = counters.get("preclassifier_accepted_total", 0)
+    audited = counters.get("preclassifier_audited_total", 0)
+    compared = counters.get("preclassifier_compared_total", 0)
+    classified = accepted + counters.get("llm_calls_total", 0) - audited
+    return {"llm_calls_saved": accepted - audited,
+            "share_saved": (accepted - audited) / classified if classified else 0.0,
+            "escalated": counters.get("preclassifier_escalated_total", 0),
+            "audited": audited,
+            "audit_agreement": counters.get("preclassifier_audit_agreed_total", 0) / audited if audited else None,
+            "compared": compared,
+            "agreement": counters.get("preclassifier_agreed_total", 0) / compared if compared else None}
+
+
+##################   Extraction Worker Pool ##################   
+
+EXTRACT_WARM_WORKERS = True # load the layout/OCR models when a worker starts instead of on its first document
+EXTRACT_MAX_TASKS_PER_CHILD = 200 # the Unstructured stack leaks, replace the workers after this many documents each
+EXTRACT_MAX_RSS_MB = 2048 # ...or as soon as a worker grows past this, None to disable
+EXTRACT_MAX_CRASHES = 2 # a document is failed once it has killed this many workers, the last one a worker of its own
+
+_worker_tasks = 0
+_worker_warmup_seconds = None
+_worker_started = None # shared (pid, task id) slots, the task a worker is running so a crash can be blamed on it
+_worker_slot = None
+
+def worker_rss_mb():
+    """ Resident memory of the current process in MB, None when it can't be read (Windows without psutil) """
+    psutil = optional_module("psutil")
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # peak rather than current on macOS, close enough for a ceiling on a process that only grows
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+def warm_extraction_worker(cores=None, log_queue=None, started=None, warm=True):
+    """ Pool initializer: partitions a tiny generated image with the hi_res strategy so the layout detection model is
+    loaded and tesseract has run once before the worker gets its first real document. Also hands the worker the pool's
+    core budget for page level OCR and claims the worker's slot in the pool's started table """
+    global _worker_warmup_seconds, _worker_started, _worker_slot, _ocr_core_budget
+    if log_queue is not None:
+        log_to_queue(log_queue)
+    _ocr_core_budget = cores
+    if started is not None:
+        with started.get_lock():
+            # executors don't replace their workers, so there is a free slot for each of them
+            _worker_slot = next(slot for slot in range(0, len(started), 2) if not started[slot])
+            started[_worker_slot] = os.getpid()
+        _worker_started = started
+    # the pool already runs a tesseract per worker (and per page), don't let each of them also spread over every core
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    if not warm:
+        return
+    start = time.perf_counter()
+    try:
+        from langchain_unstructured import UnstructuredLoader
+        img = Image.new("L", (320, 80), 255)
+        ImageDraw.Draw(img).text((10, 30), "Member statement 2025", fill=0)
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG")
+        buffer.seek(0)
+        list(UnstructuredLoader(file=buffer, metadata_filename="warmup.png", strategy="hi_res").lazy_load())
+    except Exception as e:
+        # a cold worker still works, it just loads the models on its first scan
+        logging.warning(f"WORKER {os.getpid()}: could not preload the extraction models: {e}")
+        return
+    _worker_warmup_seconds = time.perf_counter() - start
+    logging.info(f"WORKER {os.getpid()}: extraction models loaded in {_worker_warmup_seconds:.1f}s")
+
+def _run_in_worker(fn, args, task_id=0):
+    """ Runs one task in a pool worker and sends back, along with the outcome, how worn out the worker is """
+    global _worker_tasks, _worker_warmup_seconds
+    if _ocr_core_budget is not None:
+        _ocr_core_budget.acquire() # this worker's own core, only taken by another worker's pages while it was idle
+    if _worker_started is not None:
+        _worker_started[_worker_slot + 1] = task_id
     try:
+        result, error = fn(*args), None
+    except Exception as e:
+        result, error = None, e
+    finally:
+        if _worker_started is not None:
+            _worker_started[_worker_slot + 1] = 0
+        if _ocr_core_budget is not None:
+            _ocr_core_budget.release()
+    _worker_tasks += 1
+    warmup_seconds, _worker_warmup_seconds = _worker_warmup_seconds, None # only reported with the first task
+    return result, error, {"pid": os.getpid(), "tasks": _worker_tasks, "rss_mb": worker_rss_mb(), "warmup_seconds": warmup_seconds}
+
+class ExtractionPool:
+    """ ProcessPoolExecutor for the extraction stage with warmed up workers that get replaced once they have handled
+    max_tasks_per_child documents or grown past max_rss_mb. Replacement works a generation at a time: new and not yet
+    started work goes to a fresh executor and the worn out one exits once its running tasks are done. When a worker dies
+    the document it was running is retried on a worker of its own, everything else the crash took down goes to the next
+    generation. Recycling is done here rather than with ProcessPoolExecutor's own max_tasks_per_child, which needs 3.11
+    and can't look at memory """
+
+    def __init__(self, max_workers=None, max_tasks_per_child=EXTRACT_MAX_TASKS_PER_CHILD, max_rss_mb=EXTRACT_MAX_RSS_MB, warm=EXTRACT_WARM_WORKERS):
+        self.max_workers = max_workers or os.cpu_count()
+        # shared by the workers of a generation: one per document being extracted, the rest go to the pages of
+        # multi-page scans, so a lone scan spreads over the idle cores and a busy pool OCRs one page per worker
+        self.cores = max(os.cpu_count() or 1, self.max_workers)
+        self.max_tasks_per_child = max_tasks_per_child
+        self.max_rss_mb = max_rss_mb
+        self.warm = warm
+        self._mp_context = multiprocessing.get_context(WORKER_START_METHOD)
+        self._executor = None
+        self._quarantine = collections.deque() # (fn, args, future, task id, crashes) waiting for a worker of their own
+        self._isolated = set()
+        self._started = weakref.WeakKeyDictionary() # executor -> its workers' (pid, task id) slots
+        self._blamed = weakref.WeakKeyDictionary() # crashed executor -> ids of the tasks its dead workers were running
+        self._task_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._shutdowns = [] # threads waiting for retired and isolated executors to finish
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def _new_executor(self, max_workers, cores):
+        started = self._mp_context.Array("q", 2 * max_workers)
+        # a budget per executor, cores held by a worker that crashed go away with its generation
+        cores = self._mp_context.BoundedSemaphore(cores)
+        executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=self._mp_context, initializer=warm_extraction_worker,
+                                       initargs=(cores, _log_queue, started, self.warm))
+        self._started[executor] = started
+        return executor
+
+    def _current(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = self._new_executor(self.max_workers, self.cores)
+                pipeline_metrics.increment("extract_pool_generations_total")
+            return self._executor
+
+    def _retire(self, executor, reason):
+        with self._lock:
+            if executor is not self._executor:
+                return False # already replaced
+            self._executor = None
+        logging.info(f"EXTRACT POOL: recycling the workers, {reason}.")
+        pipeline_metrics.increment("extract_pool_recycled_total")
+        # tasks that haven't started are cancelled and re-dispatched to the new generation, the running ones finish
+        self._shut_down_later(executor, cancel_futures=True)
+        return True
+
+    def _shut_down_later(self, executor, cancel_futures=False):
+        """ Shuts an executor down from a thread of our own, this usually runs in the executor's management thread which
+        can't shut itself down. The thread waits for the workers to exit so shutdown() can wait for it in turn """
+        thread = threading.Thread(target=executor.shutdown, kwargs={"wait": True, "cancel_futures": cancel_futures}, daemon=True)
+        with self._lock:
+            self._shutdowns = [running for running in self._shutdowns if running.is_alive()]
+            self._shutdowns.append(thread)
+            thread.start()
+
+    def _crash_suspects(self, executor):
+        """ Ids of the tasks the dead workers of a broken executor were running. Called from its failed futures' callbacks,
+        which the executor runs before it terminates the workers that are still alive. None when nothing can be blamed """
+        with self._lock:
+            if executor not in self._blamed:
+                started = self._started.get(executor)
+                with started.get_lock():
+                    slots = list(started)
+                # a worker that just died can still look alive until it is reaped, its sentinel is what the executor saw
+                alive = {process.pid for process in multiprocessing.active_children() if not multiprocessing.connection.wait([process.sentinel], 0)}
+                self._blamed[executor] = {task_id for pid, task_id in zip(slots[::2], slots[1::2]) if pid and task_id and pid not in alive}
+            return self._blamed[executor] or None
+
+    def submit(self, fn, *args):
+        future = Future()
+        self._dispatch(fn, args, future, next(self._task_ids))
+        return future
+
+    def _dispatch(self, fn, args, future, task_id, crashes=0):
+        if crashes:
+            # rerun on a worker of its own, so a second crash can only be blamed on this document
+            with self._lock:
+                self._quarantine.append((fn, args, future, task_id, crashes))
+            self._start_quarantined()
+            return
+        executor = self._current()
+        executor.submit(_run_in_worker, fn, args, task_id).add_done_callback(functools.partial(self._done, executor, fn, args, future, task_id, crashes))
+
+    def _start_quarantined(self):
+        while True:
+            with self._lock:
+                if not self._quarantine or len(self._isolated) >= self.max_workers:
+                    return
+                fn, args, future, task_id, crashes = self._quarantine.popleft()
+                executor = self._new_executor(1, 1) # a core of its own but no spare ones for its pages
+                self._isolated.add(executor)
+            executor.submit(_run_in_worker, fn, args, task_id).add_done_callback(functools.partial(self._done, executor, fn, args, future, task_id, crashes))
+
+    def _done(self, executor, fn, args, future, task_id, crashes, worker_future):
+        isolated = crashes > 0
+        if isolated:
+            with self._lock:
+                self._isolated.discard(executor)
+            self._shut_down_later(executor)
+        try:
+            self._settle(executor, fn, args, future, task_id, crashes, worker_future)
+        finally:
+            if isolated:
+                self._start_quarantined()
+
+    def _settle(self, executor, fn, args, future, task_id, crashes, worker_future):
+        if worker_future.cancelled(): # never started on a generation that got retired, run it on the new one
+            self._dispatch(fn, args, future, task_id, crashes)
+            return
+        try:
+            result, error, stats = worker_future.result()
+        except BrokenProcessPool as e: # a worker died (OOM kill, segfault in the extraction stack)
+            # a crash fails every task of the generation, running or queued, not just the one that caused it
+            suspects = None if crashes else self._crash_suspects(executor)
+            if crashes or self._retire(executor, f"a worker died: {e}"):
+                pipeline_metrics.increment("extract_worker_crashes_total") # once per dead pool, not once per task it failed
+            if crashes or suspects is None or task_id in suspects:
+                if crashes + 1 >= EXTRACT_MAX_CRASHES:
+                    logging.error(f"EXTRACT POOL: giving up on {args}, it killed {crashes + 1} workers.")
+                    future.set_exception(e)
+                else:
+                    self._dispatch(fn, args, future, task_id, crashes + 1)
+            else:
+                self._dispatch(fn, args, future, task_id, crashes)
+            return
+        except Exception as e:
+            future.set_exception(e)
+            return
+        if stats["warmup_seconds"] is not None:
+            pipeline_metrics.record("worker_warmup", None, stats["warmup_seconds"])
+        if crashes:
+            pass # a worker of its own, already being shut down
+        elif self.max_rss_mb and stats["rss_mb"] and stats["rss_mb"] > self.max_rss_mb:
+            self._retire(executor, f"worker {stats['pid']} is using {stats['rss_mb']:.0f} MB")
+        elif self.max_tasks_per_child and stats["tasks"] >= self.max_tasks_per_child:
+            self._retire(executor, f"worker {stats['pid']} has handled {stats['tasks']} documents")
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            for _, _, future, _, _ in self._quarantine:
+                future.cancel()
+            self._quarantine.clear()
+            # retired executors, and isolated ones whose document is done, are already shutting down in a thread of ours
+            executors = list(self._isolated) + ([self._executor] if self._executor else [])
+            self._executor = None
+        for executor in executors:
+            executor.shutdown(wait=wait)
+        if wait:
+            # taken after the shutdowns above, whose last callbacks can still shut down an isolated executor
+            with self._lock:
+                shutdowns, self._shutdowns = self._shutdowns, []
+            for thread in shutdowns:
+                thread.join()
+
+
+##################   Main Processing Logic ##################   
+
+def extract_document(filepath):
+    """ CPU bound stage: hash the file and check the result cache, on a miss pull the text and encode the image.
+    Safe to run in a worker process, the stage timings travel back in the returned dict """
+    timings = {}
+    with stage_timer(timings, "mime"):
         mime_type = get_file_type(filepath)
-        document_text = extract_text_from_file(filepath)
-        base64_image = encode_image_to_base64(filepath, mime_type)
+    with stage_timer(timings, "hash"):
+        content_hash = hash_file(filepath)
+    with stage_timer(timings, "cache_lookup"):
+        cached_result = result_cache.get(content_hash)
+    if cached_result is not None:
+        # a re-submitted document, skip OCR and the LLM entirely
+        return {"content_hash": content_hash, "cached_result": cached_result, "mime_type": mime_type, "timings": timings}
+
+    document_text = extract_text_from_file(filepath, mime_type, timings=timings)
+    with stage_timer(timings, "encode_image"):
+        base64_image, image_mime_type, image_bytes_original, image_bytes_sent = encode_image_to_base64(filepath, mime_type) or (None, None, 0, 0)
+    return {"content_hash": content_hash, "cached_result": None,
+            "mime_type": mime_type, "document_text": document_text, "base64_image": base64_image,
+            "image_mime_type": image_mime_type, "image_bytes_original": image_bytes_original, "image_bytes_sent": image_bytes_sent,
+            "timings": timings}
+
+def classify_and_file_document(filepath, filename, extraction, job=None):
+    """ I/O bound stage: calls the AI for classification (unless the result is cached) then moves the file and updates the index.
+    When run for a queued job every step is checkpointed so a crash can resume where it left off """
+    timings = extraction.setdefault("timings", {})
+    try:
+        return _classify_and_file_document(filepath, filename, extraction, timings, job)
+    finally:
+        pipeline_metrics.record_timings(extraction.get("mime_type"), timings)
+
+def _classify_and_file_document(filepath, filename, extraction, timings, job):
+    extracted_data = extraction["cached_result"]
+    label_source = "llm" # only LLM answers are cached
+    if extracted_data is not None:
+        logging.info(f"CACHE HIT: {filename} matches a previously classified document ({extraction['content_hash'][:12]}).")
+        pipeline_metrics.increment("cache_hits_total")
+    else:
+        document_text, base64_image = extraction["document_text"], extraction["base64_image"]
 
         ### test results from extraction
-        logging.info(f"Extracted text: {document_text[:200]}...")
-        logging.info(f"Base64 image: {base64_image is not None}")
+        logging.info(f"EXTRACTED: {filename} {len(document_text or '')} chars of text, image: {base64_image is not None}")
+        # the text itself only at debug level, formatted lazily so it costs nothing when debug is off
+        logging.debug("Extracted text: %.200s...", document_text)
+        if base64_image:
+            logging.info(f"IMAGE BYTES: {filename} original={extraction['image_bytes_original']} sent={extraction['image_bytes_sent']} "
+                         f"saved={extraction['image_bytes_original'] - extraction['image_bytes_sent']}")
+            pipeline_metrics.increment("image_bytes_original_total", extraction["image_bytes_original"])
+            pipeline_metrics.increment("image_bytes_sent_total", extraction["image_bytes_sent"])
 
         if not document_text and not base64_image:
             # if the document is blank raise an error to be then handled by the exception block i.e. move to exception folder.
-            logging.info("No extractable content found for file {filepath}.")
+            logging.info(f"No extractable content found for file {filepath}.")
             raise ValueError("No extractable content found.")
-       
-        # Prepare multimodal input. only capture the first 2000 characters to prevent AI context window threshold
-        llm_input_content = [{"type": "text", "text": f"Classify this document based on its content and extracted text: {document_text[:2000]}."}]
-        if base64_image:
-            llm_input_content.append({"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{base64_image}"}})
 
-        prompt_template = ChatPromptTemplate.from_messages([
-            ("system", "You are an expert document classifier. Classify the input into one of three categories: Memberdoc, Loans, or Statements. Extract structured data including a confidence score into the JSON schema."),
-            HumanMessage(content=llm_input_content)
-        ])
+        # obvious documents are filed from the local model, the rest (and a small audit sample) go to the LLM
+        with stage_timer(timings, "preclassify"):
+            local_category, extracted_data = preclassify(document_text)
+        audit = extracted_data is not None and random.random() < PRECLASSIFIER_AUDIT_RATE
+        if extracted_data is not None:
+            logging.info(f"PRECLASSIFIED: {filename} -> {local_category} by the local model{' (audited)' if audit else ''}.")
+            pipeline_metrics.increment("preclassifier_accepted_total")
+        elif local_category is not None:
+            pipeline_metrics.increment("preclassifier_escalated_total")
 
-        llm = ChatOpenAI(api_key=OPENAI_API_KEY, model="gpt-4o", temperature=0)
-        chain = prompt_template | llm.with_structured_output(DocumentClassificationResult) 
-        # output here will be in the pydantic structure defined earlier
+        label_source = "local" if extracted_data is not None and not audit else "llm"
+        if extracted_data is None or audit:
+            with stage_timer(timings, "llm"):
+                extracted_data = classify_document(extraction["image_mime_type"] or extraction["mime_type"], document_text, base64_image, timings)
+            pipeline_metrics.increment("llm_calls_total")
+            if local_category is not None:
+                agreed = int(local_category == extracted_data.category_name)
+                pipeline_metrics.increment("preclassifier_compared_total")
+                pipeline_metrics.increment("preclassifier_agreed_total", agreed)
+                if audit:
+                    pipeline_metrics.increment("preclassifier_audited_total")
+                    pipeline_metrics.increment("preclassifier_audit_agreed_total", agreed)
+            # only the model's own answers are cached, a local guess would otherwise stick for CACHE_MAX_AGE_DAYS
+            result_cache.put(extraction["content_hash"], extracted_data)
+
+    if job:
+        job.checkpoint(stage="classified", result_json=extracted_data.model_dump_json())
+    return file_classified_document(filepath, filename, extracted_data, extraction.get("document_text"), timings, job, label_source=label_source)
+
+def file_classified_document(filepath, filename, extracted_data, document_text=None, timings=None, job=None, resume_from=None, label_source=None):
+    """ Confidence check, move into classified_output and index. resume_from ("moving"/"moved") skips the steps a
+    previous attempt of the job already finished, label_source is recorded in the search index """
+    timings = {} if timings is None else timings
+
+    # Confidence Check (80% threshold)
+    if resume_from is None and extracted_data.confidence_score < CONFIDENCE_THRESHOLD:
+        raise ValueError(f"Confidence score too low: {extracted_data.confidence_score*100}%")
+
+    # Naming convention and moving file
+    # determine if a member number is captured if not leave it empty
+    member_num_prefix = f"{extracted_data.member_number}_" if extracted_data.member_number else ""
+    new_filename = member_num_prefix + filename
+    category_name = extracted_data.category_name 
+    destination_folder = os.path.join("./classified_output", category_name)
+    if not os.path.exists(destination_folder): os.makedirs(destination_folder)
+
+    final_file_loc = os.path.join(destination_folder, new_filename)
+    already_moved = resume_from == "moved" or (resume_from == "moving" and not os.path.exists(filepath) and os.path.exists(final_file_loc))
+    if not already_moved:
+        if job:
+            # record where the file is going before moving it, so a crash mid move can be told apart from a lost file
+            job.checkpoint(stage="moving", destination=final_file_loc)
+        with stage_timer(timings, "move"):
+            shutil.move(filepath, final_file_loc)
+        if job:
+            job.checkpoint(stage="moved")
+
+    # Update data and index
+    extracted_data.file_loc = final_file_loc
+    if resume_from is not None and search_index.contains(final_file_loc):
+        logging.info(f"RESUME: {filename} was already indexed by a previous attempt.")
+    else:
+        with stage_timer(timings, "index"):
+            add_entry_to_index(destination_folder, extracted_data.model_dump(), document_text=document_text, label_source=label_source)
+    if job:
+        job.checkpoint(stage="indexed")
+    
+    logging.info(f"SUCCESS: {filename} -> {category_name}. Confidence: {extracted_data.confidence_score*100}%. Data: {extracted_data.model_dump()}")
+    return True, f"Classified as {category_name} ({extracted_data.confidence_score*100:.1f}%)"
+
+def move_to_exceptions(filepath, filename, exception_folder, error, job=None):
+    """ Move to exception folder on any failure """
+    logging.error(f"EXCEPTION: {filename}. Reason: {error}")
+    pipeline_metrics.increment("exceptions_total")
+    exception_path = os.path.join(exception_folder, filename)
+    if job:
+        job.checkpoint(stage="excepting", destination=exception_path, error=str(error)[:1000])
+        if not os.path.exists(filepath) and os.path.exists(exception_path):
+            # a previous attempt already moved it
+            return False, f"Exception: {str(error)[:100]}..."
+    shutil.move(filepath, exception_path)
+    return False, f"Exception: {str(error)[:100]}..."
+
+def process_file_with_ai(filepath, filename, exception_folder):
+    """ Calls the AI for classification and manages file movement and creation """
+    try:
+        extraction = extract_document(filepath)
+        return classify_and_file_document(filepath, filename, extraction)
+    except Exception as e:
+        return move_to_exceptions(filepath, filename, exception_folder, e)
+    finally:
+        export_metrics()
+
+def export_metrics():
+    """ Metrics export must never fail a document """
+    try:
+        pipeline_metrics.export()
+    except Exception as e:
+        logging.error(f"Could not export pipeline metrics: {e}")
+
+def profile_file(filepath, output_path="profile.prof", use_pyinstrument=False):
+    """ Profiles extraction and classification of a single file without moving or indexing it.
+    Writes a cProfile .prof file (or a pyinstrument .html report) and returns a short text summary """
+    def run():
+        extraction = extract_document(filepath)
+        if extraction["cached_result"] is None and (extraction["document_text"] or extraction["base64_image"]):
+            classify_document(extraction["image_mime_type"] or extraction["mime_type"], extraction["document_text"], extraction["base64_image"])
+
+    if use_pyinstrument:
+        from pyinstrument import Profiler # optional, pip install pyinstrument
+        profiler = Profiler()
+        profiler.start()
+        try:
+            run()
+        finally:
+            profiler.stop()
+        with open(output_path, 'w') as f:
+            f.write(profiler.output_html())
+        return profiler.output_text(unicode=True, color=False)
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(run)
+    finally:
+        # keep the profile of a failed run too, that's often the one worth looking at
+        profiler.dump_stats(output_path)
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(30)
+    return summary.getvalue()
 
-        extracted_data = chain.invoke({}) 
+##################   Batch Processing Logic ##################   
 
-        # Confidence Check (80% threshold)
-        if extracted_data.confidence_score < 0.80:
-            raise ValueError(f"Confidence score too low: {extracted_data.confidence_score*100}%")
+DEFAULT_LLM_WORKERS = 8 # concurrent gpt-4o requests, keep under the account rate limit
 
-        # Naming convention and moving file
-        # determine if a member number is captured if not leave it empty
-        member_num_prefix = f"{extracted_data.member_number}_" if extracted_data.member_number else ""
-        new_filename = member_num_prefix + filename
-        category_name = extracted_data.category_name 
-        destination_folder = os.path.join("./classified_output", category_name)
-        if not os.path.exists(destination_folder): os.makedirs(destination_folder)
+def _finish_document(filepath, filename, exception_folder, extraction_future, job=None):
+    """ Runs on the LLM thread pool once extraction for a file has completed """
+    try:
+        return classify_and_file_document(filepath, filename, extraction_future.result(), job)
+    except Exception as e:
+        return move_to_exceptions(filepath, filename, exception_folder, e, job)
+
+def _run_batch(tasks, exception_folder, extract_pool, llm_pool):
+    """ Runs (filepath, job or None) tasks through the pools and yields (filepath, job, success, message) as each finishes.
+    Jobs that a previous attempt already got past classification skip straight to resuming on the LLM pool """
+    pending = {}
+    for filepath, job in tasks:
+        if job and job.row["stage"] != "queued":
+            pending[llm_pool.submit(resume_job, job, exception_folder)] = ("classify", filepath, job)
+        else:
+            # submit every extraction up front, then hand each one to the LLM pool as soon as it completes
+            pending[extract_pool.submit(extract_document, filepath)] = ("extract", filepath, job)
+
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            stage, filepath, job = pending.pop(future)
+            filename = job.row["filename"] if job else os.path.basename(filepath)
+            if stage == "extract":
+                llm_future = llm_pool.submit(_finish_document, filepath, filename, exception_folder, future, job)
+                pending[llm_future] = ("classify", filepath, job)
+            else:
+                try:
+                    success, message = future.result()
+                except Exception as e:
+                    # the move to exceptions itself failed, report it and keep the batch going
+                    logging.error(f"EXCEPTION: {filename}. Could not be moved to exceptions: {e}")
+                    success, message = False, f"Exception: {str(e)[:100]}..."
+                yield filepath, job, success, message
+
+def process_batch(filepaths, exception_folder, workers=None, llm_workers=DEFAULT_LLM_WORKERS):
+    """ Classifies many files concurrently and yields (filepath, success, message) as each file finishes.
+    Extraction (Unstructured/tesseract) runs in a warmed up, self recycling process pool (ExtractionPool) sized to `workers` (defaults to the core count),
+    the LLM calls, file moves and index writes run in a bounded thread pool of `llm_workers`. """
+    filepaths = list(filepaths)
+    if not filepaths:
+        return
+
+    with ExtractionPool(max_workers=workers) as extract_pool, ThreadPoolExecutor(max_workers=llm_workers) as llm_pool:
+        for filepath, job, success, message in _run_batch([(filepath, None) for filepath in filepaths], exception_folder, extract_pool, llm_pool):
+            yield filepath, success, message
+    export_metrics()
+
+
+##################   Durable Work Queue ##################   
+
+QUEUE_DB_PATH = "./work_queue.sqlite3"
+QUEUE_LEASE_SECONDS = 300 # a running job whose worker hasn't renewed the lease in this long is picked up by another worker
+QUEUE_MAX_ATTEMPTS = 3 # jobs that keep killing their worker are failed instead of retried forever
+QUEUE_BATCH_SIZE = 50
+QUEUE_PAUSE_POLL_SECONDS = 1.0
+QUEUE_THROUGHPUT_WINDOW = 50 # finished jobs the rolling throughput (and so the ETA) is computed over
+QUEUE_IDLE_SECONDS = 120 # no job finished for this long means nothing is running, no ETA
+
+# job stages in pipeline order, the checkpoint tells a retry which steps already happened
+JOB_STAGES = ["queued", "classified", "moving", "moved", "indexed"]
+
+class WorkQueue:
+    """SQLite backed job queue with pending/running/done/failed states and leases, shared by every worker
+    (dashboard, CLI watchers on other processes). Same connection per call pattern as ResultCache."""
+
+    def __init__(self, db_path=QUEUE_DB_PATH, lease_seconds=QUEUE_LEASE_SECONDS, max_attempts=QUEUE_MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._initialized = False
+        self._init_lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        if not self._initialized:
+            with self._init_lock:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                    id INTEGER PRIMARY KEY,
+                                    filepath TEXT NOT NULL,
+                                    filename TEXT NOT NULL,
+                                    content_hash TEXT,
+                                    state TEXT NOT NULL DEFAULT 'pending',
+                                    stage TEXT NOT NULL DEFAULT 'queued',
+                                    attempts INTEGER NOT NULL DEFAULT 0,
+                                    lease_owner TEXT,
+                                    lease_expires REAL,
+                                    result_json TEXT,
+                                    destination TEXT,
+                                    message TEXT,
+                                    error TEXT,
+                                    created_at REAL NOT NULL,
+                                    updated_at REAL NOT NULL)""")
+                # a file can only be queued once while it's still waiting or in flight
+                conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active_filepath ON jobs (filepath) WHERE state IN ('pending', 'running')")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, id)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_content_hash ON jobs (content_hash)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_filepath ON jobs (filepath, updated_at)")
+                # queue wide switches (pause) shared by every worker and dashboard session
+                conn.execute("CREATE TABLE IF NOT EXISTS control (name TEXT PRIMARY KEY, value TEXT)")
+                self._initialized = True
+        return conn
+
+    def enqueue(self, filepath, content_hash=None):
+        """Queues a file, returns the job id or None when it is already pending/running, or when the last job for this
+        path failed or was cancelled and the file hasn't changed since (so a file that keeps failing or that a user
+        cancelled isn't picked up again by every folder scan, see requeue_cancelled)."""
+        now = time.time()
+        filepath = os.path.abspath(filepath)
+        modified = os.path.getmtime(filepath) if os.path.exists(filepath) else 0.0
+        conn = self._connect()
+        try:
+            latest = conn.execute("SELECT state, updated_at FROM jobs WHERE filepath = ? ORDER BY id DESC LIMIT 1", (filepath,)).fetchone()
+            if latest is not None and latest["state"] in ("failed", "cancelled") and latest["updated_at"] >= modified:
+                return None
+            cursor = conn.execute("""INSERT OR IGNORE INTO jobs (filepath, filename, content_hash, created_at, updated_at)
+                                     VALUES (?, ?, ?, ?, ?)""", (filepath, os.path.basename(filepath), content_hash, now, now))
+            return cursor.lastrowid if cursor.rowcount else None
+        finally:
+            conn.close()
+
+    def enqueue_folder(self, folder):
+        """Queues every file in a folder, returns the number of new jobs."""
+        added = 0
+        for name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, name)
+            if os.path.isfile(path) and not name.startswith(".") and self.enqueue(path) is not None:
+                added += 1
+        return added
+
+    def claim(self, owner, limit=QUEUE_BATCH_SIZE):
+        """Leases up to limit jobs to owner: pending ones first, then running ones whose lease expired (a dead worker)."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # expired jobs that already used up their attempts are left for fail_exhausted, not retried
+            rows = conn.execute("""SELECT * FROM jobs WHERE state = 'pending' OR (state = 'running' AND lease_expires < ? AND attempts < ?)
+                                   ORDER BY id LIMIT ?""", (now, self.max_attempts, limit)).fetchall()
+            ids = [row["id"] for row in rows]
+            if ids:
+                conn.execute(f"""UPDATE jobs SET state = 'running', lease_owner = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ?
+                                 WHERE id IN ({",".join("?" * len(ids))})""", (owner, now + self.lease_seconds, now, *ids))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return [JobHandle(self, dict(row, state="running", attempts=row["attempts"] + 1), owner) for row in rows]
+
+    def fail_exhausted(self):
+        """Fails the jobs that used up their attempts while leased to workers that died (the file keeps killing its
+        worker) and returns their rows, so the caller can move the files out of the input folder."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute("SELECT * FROM jobs WHERE state = 'running' AND lease_expires < ? AND attempts >= ?", (now, self.max_attempts)).fetchall()
+            ids = [row["id"] for row in rows]
+            if ids:
+                conn.execute(f"""UPDATE jobs SET state = 'failed', message = 'Gave up after repeated worker failures.', lease_owner = NULL, lease_expires = NULL,
+                                 updated_at = ? WHERE id IN ({",".join("?" * len(ids))})""", (now, *ids))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return [dict(row) for row in rows]
+
+    def _update(self, sql, params):
+        conn = self._connect()
+        try:
+            return conn.execute(sql, params).rowcount
+        finally:
+            conn.close()
+
+    def checkpoint(self, job_id, owner, **fields):
+        """Records progress on a leased job (stage, result_json, destination, error) and renews its lease."""
+        now = time.time()
+        assignments = "".join(f", {name} = ?" for name in fields)
+        updated = self._update(f"UPDATE jobs SET lease_expires = ?, updated_at = ?{assignments} WHERE id = ? AND lease_owner = ?",
+                               (now + self.lease_seconds, now, *fields.values(), job_id, owner))
+        if not updated:
+            raise RuntimeError(f"Lost the lease on job {job_id}, another worker has taken it over.")
+
+    def renew(self, job_ids, owner):
+        """Heartbeat for jobs still being worked on."""
+        if job_ids:
+            now = time.time()
+            self._update(f"UPDATE jobs SET lease_expires = ? WHERE lease_owner = ? AND state = 'running' AND id IN ({','.join('?' * len(job_ids))})",
+                         (now + self.lease_seconds, owner, *job_ids))
+
+    def finish(self, job_id, owner, success, message):
+        self._update("UPDATE jobs SET state = ?, message = ?, lease_owner = NULL, lease_expires = NULL, updated_at = ? WHERE id = ? AND lease_owner = ?",
+                     ("done" if success else "failed", message, time.time(), job_id, owner))
+
+    def release(self, owner):
+        """Hands this worker's unfinished jobs back to the queue (graceful shutdown), keeping their checkpoints."""
+        return self._update("UPDATE jobs SET state = 'pending', lease_owner = NULL, lease_expires = NULL, attempts = MAX(attempts - 1, 0), updated_at = ? WHERE state = 'running' AND lease_owner = ?",
+                            (time.time(), owner))
+
+    def active_job_for_hash(self, content_hash):
+        """Filepath of a pending or running job with this content, None if there isn't one."""
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT filepath FROM jobs WHERE content_hash = ? AND state IN ('pending', 'running') LIMIT 1", (content_hash,)).fetchone()
+            return row["filepath"] if row else None
+        finally:
+            conn.close()
+
+    def set_paused(self, paused):
+        """While paused, workers finish the jobs they hold but don't claim new ones."""
+        self._update("INSERT OR REPLACE INTO control (name, value) VALUES ('paused', ?)", ("1" if paused else "0",))
+
+    def is_paused(self):
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT value FROM control WHERE name = 'paused'").fetchone()
+            return row is not None and row["value"] == "1"
+        finally:
+            conn.close()
 
-        final_file_loc = os.path.join(destination_folder, new_filename)
-        shutil.move(filepath, final_file_loc)
+    def cancel_pending(self):
+        """Cancels every job that hasn't been claimed yet. The files stay where they are but aren't queued again
+        until requeue_cancelled is called (or the file changes)."""
+        return self._update("UPDATE jobs SET state = 'cancelled', message = 'Cancelled.', updated_at = ? WHERE state = 'pending'", (time.time(),))
 
-        # Update data and index
-        extracted_data.file_loc = final_file_loc
-        add_entry_to_index(destination_folder, extracted_data.model_dump())
-        
-        logging.info(f"SUCCESS: {filename} -> {category_name}. Confidence: {extracted_data.confidence_score*100}%. Data: {extracted_data.model_dump()}")
-        return True, f"Classified as {category_name} ({extracted_data.confidence_score*100:.1f}%)"
+    def requeue_cancelled(self):
+        """Queues the cancelled files that are still in place again, returns the number of new jobs."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute("""SELECT filepath, filename, content_hash FROM jobs AS job WHERE state = 'cancelled'
+                                   AND id = (SELECT MAX(id) FROM jobs WHERE filepath = job.filepath)""").fetchall()
+            added = 0
+            for row in rows:
+                if os.path.exists(row["filepath"]):
+                    added += conn.execute("""INSERT OR IGNORE INTO jobs (filepath, filename, content_hash, created_at, updated_at)
+                                             VALUES (?, ?, ?, ?, ?)""", (row["filepath"], row["filename"], row["content_hash"], now, now)).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return added
 
+    def recent_jobs(self, limit=50):
+        """The most recently updated jobs, for the per file status table."""
+        conn = self._connect()
+        try:
+            return [dict(row) for row in conn.execute("""SELECT filename, state, stage, attempts, message, updated_at FROM jobs
+                                                         ORDER BY updated_at DESC LIMIT ?""", (limit,))]
+        finally:
+            conn.close()
+
+    def status(self, since=None, window=QUEUE_THROUGHPUT_WINDOW):
+        """Counts, progress since `since` (epoch seconds), throughput over the last `window` finished jobs and an ETA
+        for what is left. Throughput comes from the job timestamps, so it covers every worker on the queue."""
+        counts = self.counts()
+        remaining = counts["pending"] + counts["running"]
+        conn = self._connect()
+        try:
+            finished = [row[0] for row in conn.execute("SELECT updated_at FROM jobs WHERE state IN ('done', 'failed') ORDER BY updated_at DESC LIMIT ?", (window,))]
+            finished_since = conn.execute("SELECT COUNT(*) FROM jobs WHERE state IN ('done', 'failed') AND updated_at >= ?", (since or 0,)).fetchone()[0]
+        finally:
+            conn.close()
+        # only a recent burst counts as the current rate, an old finish would drag it down
+        span = finished[0] - finished[-1] if len(finished) > 1 else 0.0
+        docs_per_sec = (len(finished) - 1) / span if span > 0 and time.time() - finished[0] < QUEUE_IDLE_SECONDS else 0.0
+        return {"counts": counts, "remaining": remaining, "finished": finished_since,
+                "progress": finished_since / (finished_since + remaining) if finished_since + remaining else 1.0,
+                "docs_per_sec": docs_per_sec, "eta_seconds": remaining / docs_per_sec if docs_per_sec else None,
+                "paused": self.is_paused()}
+
+    def counts(self):
+        """Number of jobs in each state."""
+        conn = self._connect()
+        try:
+            counts = {state: 0 for state in ("pending", "running", "done", "failed", "cancelled")}
+            counts.update({row["state"]: row["n"] for row in conn.execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state")})
+            return counts
+        finally:
+            conn.close()
+
+class JobHandle:
+    """A job leased to one worker, passed through the pipeline so each step can checkpoint its progress."""
+
+    def __init__(self, queue, row, owner):
+        self.queue = queue
+        self.row = row
+        self.owner = owner
+        self.id = row["id"]
+
+    def checkpoint(self, **fields):
+        self.queue.checkpoint(self.id, self.owner, **fields)
+        self.row.update(fields)
+
+def resume_job(job, exception_folder):
+    """ Picks a job back up after the checkpoint a previous (crashed) attempt reached, without redoing OCR or the LLM call """
+    row = job.row
+    filepath, filename = row["filepath"], row["filename"]
+    logging.info(f"RESUME: job {job.id} ({filename}) from stage {row['stage']}, attempt {row['attempts']}.")
+    try:
+        if row["stage"] == "excepting":
+            return move_to_exceptions(filepath, filename, exception_folder, row["error"] or "Resumed exception", job)
+        extracted_data = DocumentClassificationResult.model_validate_json(row["result_json"])
+        resume_from = None if row["stage"] == "classified" else row["stage"]
+        if resume_from == "indexed":
+            resume_from = "moved" # only the final bookkeeping was missing
+        return file_classified_document(filepath, filename, extracted_data, job=job, resume_from=resume_from)
+    except Exception as e:
+        return move_to_exceptions(filepath, filename, exception_folder, e, job)
+
+def abandon_job(row, exception_folder):
+    """ Moves the file of a job the queue gave up on to exceptions, like any other failure """
+    if not os.path.exists(row["filepath"]):
+        return # it got past the move before its worker died
+    try:
+        move_to_exceptions(row["filepath"], row["filename"], exception_folder, row["message"] or "Gave up after repeated worker failures.")
     except Exception as e:
-        # Move to exception folder on any failure
-        logging.error(f"EXCEPTION: {filename}. Reason: {e}")
-        shutil.move(filepath, os.path.join(exception_folder, filename))
-        return False, f"Exception: {str(e)[:100]}..."
+        logging.error(f"EXCEPTION: {row['filename']}. Could not be moved to exceptions: {e}")
+
+def new_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+work_queue = WorkQueue()
+
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+def persist_upload(stream, filename, folder, queue=None):
+    """ Writes an uploaded file object into folder in chunks (hashing as it goes) and queues it. Content that is already
+    waiting in the queue is not written again. A different file with the same name gets a hash prefix instead of
+    overwriting it. Returns (path of the queued file, True if this call added it)
+    Streamlit's UploadedFile already holds the whole upload in memory, so chunking doesn't bound memory for dashboard
+    uploads, it only avoids making a second full copy (getbuffer/read()) while hashing and writing. """
+    queue = queue or work_queue
+    os.makedirs(folder, exist_ok=True)
+    filename = os.path.basename(filename)
+    digest = hashlib.sha256()
+    # hidden .part name so enqueue_folder and the watcher leave it alone until it is complete
+    part_path = os.path.join(folder, f".{uuid.uuid4().hex}.part")
+    try:
+        if hasattr(stream, "seek"):
+            stream.seek(0)
+        with open(part_path, "wb") as f:
+            for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_BYTES), b""):
+                digest.update(chunk)
+                f.write(chunk)
+        content_hash = digest.hexdigest()
+
+        existing = queue.active_job_for_hash(content_hash)
+        if existing:
+            logging.info(f"UPLOAD: {filename} is already queued as {existing}, not saved again.")
+            return existing, False
+        target_path = os.path.join(folder, filename)
+        if os.path.exists(target_path) and hash_file(target_path) != content_hash:
+            target_path = os.path.join(folder, f"{content_hash[:8]}_{filename}")
+        os.replace(part_path, target_path)
+        added = queue.enqueue(target_path, content_hash) is not None
+        logging.info(f"UPLOAD: saved {filename} to {target_path} ({content_hash[:12]}){'' if added else ', already queued'}.")
+        return os.path.abspath(target_path), added
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+def drain_queue(exception_folder, queue=None, workers=None, llm_workers=DEFAULT_LLM_WORKERS, batch_size=QUEUE_BATCH_SIZE, stop_event=None, extract_pool=None):
+    """ Claims and processes jobs until the queue is empty (or stop_event is set), yielding (filepath, success, message).
+    Several of these can run against the same queue at once, in this process or others. Leases are renewed by a
+    heartbeat thread while jobs are in flight, and anything unfinished is handed back to the queue on the way out.
+    Long lived callers pass their own extract_pool so its warm workers outlive the drain, otherwise one is started
+    for this call and shut down at the end """
+    queue = queue or work_queue
+    owner = new_worker_id()
+
+    def stopped():
+        return stop_event is not None and stop_event.is_set()
+
+    def next_jobs():
+        # hold off claiming while the queue is paused, the jobs already claimed have all finished by now
+        while queue.is_paused() and not stopped():
+            time.sleep(QUEUE_PAUSE_POLL_SECONDS)
+        if stopped():
+            return []
+        for row in queue.fail_exhausted():
+            abandon_job(row, exception_folder)
+        return queue.claim(owner, batch_size)
+
+    jobs = next_jobs()
+    if not jobs:
+        return # nothing to do, don't pay for starting the pools
+    in_flight = set()
+    heartbeat_stop = threading.Event()
+
+    def heartbeat():
+        while not heartbeat_stop.wait(queue.lease_seconds / 3):
+            try:
+                queue.renew(list(in_flight), owner)
+            except Exception as e:
+                logging.error(f"Could not renew job leases: {e}")
+
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    pool = extract_pool or ExtractionPool(max_workers=workers) # starts no workers until the first document
+    try:
+        with ThreadPoolExecutor(max_workers=llm_workers) as llm_pool:
+            while jobs:
+                in_flight.update(job.id for job in jobs)
+                for filepath, job, success, message in _run_batch([(job.row["filepath"], job) for job in jobs], exception_folder, pool, llm_pool):
+                    queue.finish(job.id, owner, success, message)
+                    in_flight.discard(job.id)
+                    yield filepath, success, message
+                jobs = next_jobs()
+    finally:
+        heartbeat_stop.set()
+        queue.release(owner)
+        if pool is not extract_pool:
+            pool.shutdown()
+        export_metrics()
+
+class BackgroundProcessor:
+    """ Drains the work queue on a background thread so the dashboard stays responsive. One instance is shared by
+    every browser session, start() is a no-op while it is already running so sessions can't start duplicate work """
+
+    def __init__(self, exception_folder, queue=None, workers=None, llm_workers=DEFAULT_LLM_WORKERS, batch_size=16):
+        self.exception_folder = exception_folder
+        self.queue = queue or work_queue
+        self.workers = workers
+        self.llm_workers = llm_workers
+        self.batch_size = batch_size # small claims so pause and cancel take effect quickly
+        # kept for the life of the dashboard so every run after the first starts on warm workers
+        self.extract_pool = ExtractionPool(max_workers=workers)
+        self.started_at = None
+        self.last_result = None
+        self.error = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Starts draining the queue, returns False if a run is already in progress."""
+        with self._lock:
+            if self.running:
+                return False
+            self._stop.clear()
+            self.started_at = time.time()
+            self.error = None
+            self._thread = threading.Thread(target=self._run, name="queue-drain", daemon=True)
+            self._thread.start()
+            return True
+
+    def _run(self):
+        try:
+            for filepath, success, message in drain_queue(self.exception_folder, self.queue, self.workers, self.llm_workers, self.batch_size, self._stop, self.extract_pool):
+                self.last_result = (os.path.basename(filepath), success, message)
+                if not success:
+                    # have the review tab's preview ready before anyone opens it
+                    preview_cache.prefetch([os.path.join(self.exception_folder, os.path.basename(filepath))])
+        except Exception as e:
+            logging.error(f"Background processing stopped: {e}")
+            self.error = str(e)
+
+    def cancel(self):
+        """Stops after the jobs in flight and cancels everything still pending."""
+        self._stop.set()
+        return self.queue.cancel_pending()
+
+    def status(self):
+        return dict(self.queue.status(self.started_at), running=self.running, last_result=self.last_result, error=self.error)
+
+
+##################   Offline Batch API ##################   
+
+BATCH_API_ENDPOINT = "/v1/chat/completions"
+
+def batch_manifest_path(requests_path):
+    """ Where export_batch_requests keeps the request -> documents mapping that ingest_batch_results needs """
+    return os.path.splitext(requests_path)[0] + ".manifest.jsonl"
+
+def export_batch_requests(input_folder, requests_path, batch_size=5, workers=None):
+    """ Extracts every file in input_folder and writes OpenAI Batch API requests (one JSON object per line, same shape
+    as the chat completions calls made online) for the documents that aren't in the result cache. Small text documents
+    are packed batch_size to a request. Returns counts of documents, requests and cache hits """
+    filepaths = [os.path.join(input_folder, name) for name in sorted(os.listdir(input_folder))
+                 if os.path.isfile(os.path.join(input_folder, name)) and not name.startswith(".")]
+    classifier = DocumentClassifier(llm=_RequestOnlyLLM(), batch_size=batch_size)
+    counts = {"documents": 0, "requests": 0, "cached": 0, "skipped": 0, "failed": 0}
+    packed = []
+
+    with open(requests_path, "w", encoding="utf-8") as requests_file, open(batch_manifest_path(requests_path), "w", encoding="utf-8") as manifest_file:
+        def write_request(message, documents, batched):
+            custom_id = f"doc-batch-{counts['requests']:06d}"
+            requests_file.write(json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_API_ENDPOINT,
+                                            "body": classifier.request_body(message, batched)}) + "\n")
+            manifest_file.write(json.dumps({"custom_id": custom_id, "batched": batched, "documents": documents}) + "\n")
+            counts["requests"] += 1
+
+        def flush_packed():
+            if packed:
+                write_request(classifier.build_batch_message([document["document_text"] for document in packed]), list(packed), True)
+                packed.clear()
+
+        with ExtractionPool(max_workers=workers) as extract_pool:
+            futures = [extract_pool.submit(extract_document, filepath) for filepath in filepaths]
+            for filepath, future in zip(filepaths, futures):
+                try:
+                    extraction = future.result()
+                except Exception as e:
+                    # left in place, the online pipeline will retry it and send it to exceptions if it fails again
+                    logging.error(f"BATCH EXPORT: could not extract {filepath}: {e}")
+                    counts["failed"] += 1
+                    continue
+                if extraction["cached_result"] is not None:
+                    counts["cached"] += 1 # `process` files these without calling the API
+                    continue
+                if not extraction["document_text"] and not extraction["base64_image"]:
+                    counts["skipped"] += 1
+                    continue
+                document = {"filepath": os.path.abspath(filepath), "filename": os.path.basename(filepath), "content_hash": extraction["content_hash"],
+                            "mime_type": extraction["mime_type"], "document_text": extraction["document_text"]}
+                counts["documents"] += 1
+                if classifier.is_batchable(extraction["document_text"], extraction["base64_image"]):
+                    packed.append(document)
+                    if len(packed) >= batch_size:
+                        flush_packed()
+                else:
+                    message = classifier.build_message(extraction["image_mime_type"] or extraction["mime_type"], extraction["document_text"], extraction["base64_image"])
+                    write_request(message, [document], False)
+        flush_packed()
+    logging.info(f"BATCH EXPORT: {counts} -> {requests_path}")
+    return counts
+
+class _RequestOnlyLLM:
+    """ Lets DocumentClassifier build request bodies for the batch export without an API key or HTTP client """
+
+    def with_structured_output(self, schema, **kwargs):
+        return self.refuse
+
+    def refuse(self, prompt_value):
+        raise RuntimeError("The batch export classifier only builds requests, it can't classify.")
+
+def parse_batch_response(line, batched):
+    """ One line of a Batch API results file -> list of DocumentClassificationResult keyed by document_id (1 for single requests) """
+    if line.get("error"):
+        raise ValueError(f"Batch request failed: {line['error']}")
+    response = line.get("response") or {}
+    if response.get("status_code") != 200:
+        raise ValueError(f"Batch request failed with status {response.get('status_code')}: {str(response.get('body'))[:200]}")
+    message = response["body"]["choices"][0]["message"]
+    arguments = message["tool_calls"][0]["function"]["arguments"] if message.get("tool_calls") else message["content"]
+    if not batched:
+        return {1: DocumentClassificationResult.model_validate_json(arguments)}
+    batch = DocumentBatchClassificationResult.model_validate_json(arguments)
+    return {result.document_id: DocumentClassificationResult(**result.model_dump(exclude={"document_id"})) for result in batch.results}
+
+def ingest_batch_results(results_path, manifest_path, exception_folder):
+    """ Files every document in a downloaded Batch API results file, yielding (filepath, success, message) like process_batch.
+    Answers go into the result cache too. Documents whose request failed, or that the model left out, stay where they
+    are for the next `process` run; documents already moved since the export are skipped """
+    manifest = {}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                manifest[entry["custom_id"]] = entry
+
+    with open(results_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            line = json.loads(line)
+            entry = manifest.get(line.get("custom_id"))
+            if entry is None:
+                logging.warning(f"BATCH INGEST: no manifest entry for {line.get('custom_id')}, skipped.")
+                continue
+            try:
+                results = parse_batch_response(line, entry["batched"])
+            except Exception as e:
+                logging.error(f"BATCH INGEST: {entry['custom_id']} could not be read: {e}")
+                results = {}
+            for document_id, document in enumerate(entry["documents"], start=1):
+                filepath, filename = document["filepath"], document["filename"]
+                if not os.path.exists(filepath):
+                    yield filepath, False, "Skipped: file was moved after the export."
+                    continue
+                extracted_data = results.get(document_id)
+                if extracted_data is None:
+                    yield filepath, False, "Left in place: no batch result, it will be classified online."
+                    continue
+                result_cache.put(document["content_hash"], extracted_data)
+                try:
+                    yield (filepath, *file_classified_document(filepath, filename, extracted_data, document["document_text"], label_source="llm"))
+                except Exception as e:
+                    yield (filepath, *move_to_exceptions(filepath, filename, exception_folder, e))
+    export_metrics()
+
+
+##################   Folder Watcher ##################   
+
+WATCH_SETTLE_SECONDS = 2.0 # a file must stop changing for this long before we pick it up (uploads/copies still in flight)
+WATCH_POLL_SECONDS = 5.0 # rescan interval, watchdog events wake the loop up sooner
+WATCH_IGNORED_SUFFIXES = (".tmp", ".part", ".crdownload", ".lock")
+
+class FolderWatcher:
+    """Reports files in a folder once they have settled. Uses watchdog (inotify/ReadDirectoryChangesW) when it is
+    installed so new files are noticed immediately, otherwise polls every WATCH_POLL_SECONDS."""
+
+    def __init__(self, folder, settle_seconds=WATCH_SETTLE_SECONDS, poll_seconds=WATCH_POLL_SECONDS):
+        self.folder = folder
+        self.settle_seconds = settle_seconds
+        self.poll_seconds = poll_seconds
+        self.changed = threading.Event()
+        self._seen = {} # filename -> (size, mtime_ns, first seen unchanged at)
+        self._observer = None
+
+    def start(self):
+        if Observer is not None:
+            watcher = self
+            class _Handler(FileSystemEventHandler):
+                def on_any_event(self, event):
+                    watcher.changed.set()
+            self._observer = Observer()
+            self._observer.schedule(_Handler(), self.folder, recursive=False)
+            self._observer.start()
+        self.changed.set() # pick up whatever is already waiting
+
+    def stop(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+
+    def wait(self, stop_event):
+        """Sleeps until something changes in the folder, the poll interval passes or we are asked to stop."""
+        deadline = time.monotonic() + (self.settle_seconds if self._seen else self.poll_seconds)
+        while not stop_event.is_set() and time.monotonic() < deadline:
+            if self.changed.wait(timeout=0.25):
+                self.changed.clear()
+                return
+
+    def ready_files(self, exclude=()):
+        """Paths whose size and mtime haven't changed for settle_seconds."""
+        now = time.monotonic()
+        ready = []
+        current = set()
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if name.startswith(".") or name.endswith(WATCH_IGNORED_SUFFIXES) or path in exclude or not os.path.isfile(path):
+                continue
+            current.add(name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            size_mtime = (stat.st_size, stat.st_mtime_ns)
+            seen = self._seen.get(name)
+            if seen is None or seen[:2] != size_mtime:
+                self._seen[name] = (*size_mtime, now)
+            elif now - seen[2] >= self.settle_seconds:
+                ready.append(path)
+        # forget files that are gone (processed or moved away)
+        for name in list(self._seen):
+            if name not in current:
+                del self._seen[name]
+        return ready
+
+def run_watcher(input_folder="./temp_dir", exception_folder="./exceptions", workers=None, llm_workers=DEFAULT_LLM_WORKERS,
+                settle_seconds=WATCH_SETTLE_SECONDS, poll_seconds=WATCH_POLL_SECONDS):
+    """ Long lived worker: queues files as they land in input_folder and drains the work queue until SIGINT/SIGTERM.
+    The first signal lets the current batch finish then exits, a second one stops immediately """
+    for folder in [input_folder, exception_folder]:
+        os.makedirs(folder, exist_ok=True)
+
+    stop_event = threading.Event()
+    def request_stop(signum, frame):
+        if stop_event.is_set():
+            raise KeyboardInterrupt
+        logging.info(f"Received signal {signum}, finishing the current batch before shutting down.")
+        print("Shutting down after the current batch (signal again to stop now)...", flush=True)
+        stop_event.set()
+    signal.signal(signal.SIGINT, request_stop)
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, request_stop)
+
+    watcher = FolderWatcher(input_folder, settle_seconds, poll_seconds)
+    watcher.start()
+    logging.info(f"Watching {input_folder} (watchdog: {Observer is not None}, workers: {workers or os.cpu_count()}, llm workers: {llm_workers}).")
+    print(f"Watching {input_folder} for documents. Ctrl+C to stop.", flush=True)
+    processed = 0
+    # one pool for the whole watch, a trickle of new files shouldn't pay for warming up every worker again
+    extract_pool = ExtractionPool(max_workers=workers)
+    try:
+        while not stop_event.is_set():
+            watcher.wait(stop_event)
+            if stop_event.is_set():
+                break
+            for filepath in watcher.ready_files():
+                work_queue.enqueue(filepath)
+            # drain everything pending, including jobs other workers left behind when they died
+            for filepath, success, message in drain_queue(exception_folder, workers=workers, llm_workers=llm_workers, stop_event=stop_event, extract_pool=extract_pool):
+                processed += 1
+                print(f"{os.path.basename(filepath)}: {message}", flush=True)
+    finally:
+        watcher.stop()
+        extract_pool.shutdown()
+        logging.info(f"Watcher stopped after {processed} documents.")
+    return processed
+
+
+##################   Command Line ##################   
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="AI document classifier: headless processing and maintenance commands.")
+    parser.add_argument("--json-logs", action="store_true", help="Write the log as JSON lines.")
+    parser.add_argument("--llm-rpm", type=int, default=None, help=f"LLM requests per minute budget, 0 for no limit (default: {LLM_REQUESTS_PER_MINUTE} or $LLM_REQUESTS_PER_MINUTE).")
+    parser.add_argument("--llm-tpm", type=int, default=None, help=f"LLM tokens per minute budget, 0 for no limit (default: {LLM_TOKENS_PER_MINUTE} or $LLM_TOKENS_PER_MINUTE).")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("queue-status", help="Show how many jobs are pending, running, done and failed.")
+    subparsers.add_parser("queue-control", help="Pause or resume every worker on the queue, cancel the pending jobs or requeue the cancelled ones.").add_argument("action", choices=["pause", "resume", "cancel", "requeue"])
+
+    process_parser = subparsers.add_parser("process", help="Queue every file currently in a folder, drain the work queue and exit.")
+    process_parser.add_argument("--input", default="./temp_dir")
+    process_parser.add_argument("--exceptions", default="./exceptions")
+    process_parser.add_argument("--workers", type=int, default=None, help="Extraction processes (default: core count).")
+    process_parser.add_argument("--llm-workers", type=int, default=DEFAULT_LLM_WORKERS, help="Concurrent LLM calls.")
+    process_parser.add_argument("--llm-batch-size", type=int, default=LLM_BATCH_SIZE, help="Pack up to this many small text documents into one LLM request.")
+
+    watch_parser = subparsers.add_parser("watch", help="Run as a long lived worker that classifies files as they land in the input folder.")
+    watch_parser.add_argument("--input", default="./temp_dir")
+    watch_parser.add_argument("--exceptions", default="./exceptions")
+    watch_parser.add_argument("--workers", type=int, default=None, help="Extraction processes (default: core count).")
+    watch_parser.add_argument("--llm-workers", type=int, default=DEFAULT_LLM_WORKERS, help="Concurrent LLM calls.")
+    watch_parser.add_argument("--llm-batch-size", type=int, default=LLM_BATCH_SIZE, help="Pack up to this many small text documents into one LLM request.")
+    watch_parser.add_argument("--settle", type=float, default=WATCH_SETTLE_SECONDS, help="Seconds a file must be unchanged before it is processed.")
+    watch_parser.add_argument("--poll", type=float, default=WATCH_POLL_SECONDS, help="Folder rescan interval in seconds.")
+
+    compact_parser = subparsers.add_parser("compact", help="Merge the small index_NNN.jsonl files into large shards.")
+    compact_parser.add_argument("--output-dir", default="./classified_output")
+    compact_parser.add_argument("--max-mb", type=float, default=INDEX_MAX_SHARD_BYTES / (1024 * 1024), help="Shard size limit in MB.")
+    compact_parser.add_argument("--max-records", type=int, default=None, help="Optional record limit per shard.")
+
+    subparsers.add_parser("build-columnar", help="Write Parquet copies of the sealed index shards for the analytics dashboard.").add_argument("--output-dir", default="./classified_output")
+
+    subparsers.add_parser("reindex-search", help="Rebuild the SQLite search index from the JSONL index shards.").add_argument("--output-dir", default="./classified_output")
+
+    export_parser = subparsers.add_parser("batch-export", help="Write OpenAI Batch API requests for every uncached file in a folder.")
+    export_parser.add_argument("--input", default="./temp_dir")
+    export_parser.add_argument("--out", default="batch_requests.jsonl")
+    export_parser.add_argument("--batch-size", type=int, default=5, help="Small text documents packed into each request.")
+    export_parser.add_argument("--workers", type=int, default=None, help="Extraction processes (default: core count).")
+
+    ingest_parser = subparsers.add_parser("batch-ingest", help="File the documents answered in a downloaded Batch API results file.")
+    ingest_parser.add_argument("results")
+    ingest_parser.add_argument("--manifest", default=batch_manifest_path("batch_requests.jsonl"), help="Manifest written by batch-export.")
+    ingest_parser.add_argument("--exceptions", default="./exceptions")
+
+    train_parser = subparsers.add_parser("train-preclassifier", help="Train the local pre-classifier from the search index and report held out agreement.")
+    train_parser.add_argument("--target-agreement", type=float, default=PRECLASSIFIER_TARGET_AGREEMENT, help="Agreement with the LLM required before local predictions are accepted.")
+
+    subparsers.add_parser("preclassifier-report", help="LLM calls saved by the pre-classifier and its agreement with the LLM, totals across every process and run.")
+
+    profile_parser = subparsers.add_parser("profile", help="Profile extraction and classification of one file (the file is not moved).")
+    profile_parser.add_argument("filepath")
+    profile_parser.add_argument("--out", default="profile.prof")
+    profile_parser.add_argument("--pyinstrument", action="store_true", help="Use pyinstrument and write an HTML report instead of cProfile.")
+
+    args = parser.parse_args(argv)
+    setup_logging(process_log_filename(args.command), json_lines=args.json_logs or LOG_JSON)
+    load_dotenv() # headless workers read OPENAI_API_KEY (and the LLM budgets) from the environment or a local .env
+    for name, value in (("LLM_REQUESTS_PER_MINUTE", args.llm_rpm), ("LLM_TOKENS_PER_MINUTE", args.llm_tpm)):
+        if value is not None:
+            os.environ[name] = str(value) # read by llm_budgets when the classifier is built
+    if getattr(args, "llm_batch_size", 1) > 1:
+        set_classifier(DocumentClassifier(batch_size=args.llm_batch_size))
+    if args.command == "process":
+        os.makedirs(args.exceptions, exist_ok=True)
+        added = work_queue.enqueue_folder(args.input)
+        print(f"Queued {added} new file(s) from {args.input}. Queue: {work_queue.counts()}", flush=True)
+        for i, (filepath, success, message) in enumerate(drain_queue(args.exceptions, workers=args.workers, llm_workers=args.llm_workers)):
+            print(f"{i+1} {os.path.basename(filepath)}: {message}", flush=True)
+    elif args.command == "queue-status":
+        status = work_queue.status()
+        eta = "n/a" if status["eta_seconds"] is None else f"{status['eta_seconds']:.0f}s"
+        print(f"{status['counts']} paused={status['paused']} throughput={status['docs_per_sec']:.2f} docs/sec eta={eta}")
+    elif args.command == "queue-control":
+        if args.action == "cancel":
+            print(f"Cancelled {work_queue.cancel_pending()} pending job(s).")
+        elif args.action == "requeue":
+            print(f"Requeued {work_queue.requeue_cancelled()} cancelled file(s).")
+        else:
+            work_queue.set_paused(args.action == "pause")
+            print(f"Queue {'paused' if args.action == 'pause' else 'resumed'}.")
+    elif args.command == "watch":
+        run_watcher(args.input, args.exceptions, args.workers, args.llm_workers, args.settle, args.poll)
+    elif args.command == "compact":
+        results = compact_index(args.output_dir, max_bytes=int(args.max_mb * 1024 * 1024), max_entries=args.max_records)
+        for category, (shards_before, shards_after, records) in results.items():
+            print(f"{category}: {shards_before} shards -> {shards_after} shards, {records} records")
+    elif args.command == "build-columnar":
+        print(f"Wrote {build_columnar_index(args.output_dir)} columnar shard(s).")
+    elif args.command == "batch-export":
+        counts = export_batch_requests(args.input, args.out, args.batch_size, args.workers)
+        print(f"{counts['documents']} document(s) in {counts['requests']} request(s) -> {args.out} (manifest {batch_manifest_path(args.out)}). "
+              f"{counts['cached']} already cached, {counts['skipped']} without content, {counts['failed']} failed to extract.")
+    elif args.command == "batch-ingest":
+        os.makedirs(args.exceptions, exist_ok=True)
+        for filepath, success, message in ingest_batch_results(args.results, args.manifest, args.exceptions):
+            print(f"{os.path.basename(filepath)}: {message}", flush=True)
+    elif args.command == "train-preclassifier":
+        report = train_preclassifier(target_agreement=args.target_agreement)
+        for key, value in report.items():
+            print(f"{key}: {value}")
+    elif args.command == "preclassifier-report":
+        for key, value in preclassifier_report().items():
+            print(f"{key}: {value}")
+    elif args.command == "profile":
+        print(profile_file(args.filepath, args.out, args.pyinstrument))
+        print(f"Full profile written to {args.out}")
+    elif args.command == "reindex-search":
+        print(f"Indexed {search_index.rebuild(args.output_dir)} documents into {search_index.db_path}.")
+
+if __name__ == "__main__":
+    main()
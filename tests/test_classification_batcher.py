@@ -0,0 +1,85 @@
+import re
+import threading
+import time
+
+import pytest
+
+import main
+from benchmark import FakeStructuredLLM
+
+
+class RecordingLLM(FakeStructuredLLM):
+    """The benchmark's fake model, recording every request and leaving out of batched answers any document containing `drop`."""
+
+    def __init__(self, drop=None):
+        super().__init__(latency=0.01)
+        self.drop = drop
+        self.requests = [] # ("batch", number of documents) or ("single", 1)
+
+    def respond(self, schema, prompt_value):
+        answer = super().respond(schema, prompt_value)
+        if "results" not in schema.model_fields:
+            self.requests.append(("single", 1))
+            return answer
+        text = prompt_value.to_messages()[-1].content[0]["text"]
+        sections = dict(zip(map(int, re.findall(r"--- Document (\d+) ---", text)), re.split(r"--- Document \d+ ---", text)[1:]))
+        self.requests.append(("batch", len(sections)))
+        answer.results = [result for result in answer.results if not (self.drop and self.drop in sections[result.document_id])]
+        return answer
+
+
+@pytest.fixture(autouse=True)
+def metrics(monkeypatch):
+    monkeypatch.setattr(main, "pipeline_metrics", main.PipelineMetrics())
+
+
+def classifier(llm, batch_size, wait_seconds):
+    return main.DocumentClassifier(llm=llm, scheduler=main.LLMScheduler(main.RateLimiter(None, None)),
+                                   batch_size=batch_size, batch_wait_seconds=wait_seconds)
+
+
+def classify_together(classifier, texts):
+    """Classifies each text from its own thread, all starting at once. Returns the results in input order."""
+    results = [None] * len(texts)
+    start = threading.Barrier(len(texts))
+
+    def worker(index):
+        start.wait()
+        results[index] = classifier.classify("text/plain", texts[index], None)
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(len(texts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+    return results
+
+
+TEXTS = ["loan agreement for member 1234567", "monthly statement for member 2345678", "membership application 3456789"]
+
+
+def test_a_full_batch_is_sent_without_waiting():
+    llm = RecordingLLM()
+    started = time.monotonic()
+    results = classify_together(classifier(llm, batch_size=3, wait_seconds=20), TEXTS)
+    assert time.monotonic() - started < 10
+    assert llm.requests == [("batch", 3)]
+    assert [(result.category_name, result.member_number) for result in results] == [
+        ("Loans", "1234567"), ("Statements", "2345678"), ("Memberdoc", "3456789")]
+    assert main.pipeline_metrics.snapshot()["counters"]["llm_batched_documents_total"] == 3
+
+
+def test_a_partial_batch_is_sent_once_the_wait_runs_out():
+    llm = RecordingLLM()
+    results = classify_together(classifier(llm, batch_size=8, wait_seconds=0.2), TEXTS)
+    # whichever thread times out first sends the batch for everyone, the others just pick up their results
+    assert llm.requests == [("batch", 3)]
+    assert [result.category_name for result in results] == ["Loans", "Statements", "Memberdoc"]
+
+
+def test_a_document_missing_from_the_answer_is_asked_about_on_its_own():
+    llm = RecordingLLM(drop="statement")
+    results = classify_together(classifier(llm, batch_size=3, wait_seconds=20), TEXTS)
+    assert sorted(llm.requests) == [("batch", 3), ("single", 1)]
+    assert [result.category_name for result in results] == ["Loans", "Statements", "Memberdoc"]
+    assert results[1].member_number == "2345678"
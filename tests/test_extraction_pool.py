@@ -0,0 +1,82 @@
+import collections
+import os
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def executors(monkeypatch):
+    """Records the max_workers of every executor the pool starts."""
+    created = []
+
+    class RecordingExecutor(main.ProcessPoolExecutor):
+        def __init__(self, max_workers=None, **kwargs):
+            created.append(max_workers)
+            super().__init__(max_workers=max_workers, **kwargs)
+
+    monkeypatch.setattr(main, "ProcessPoolExecutor", RecordingExecutor)
+    return created
+
+
+def test_a_crash_only_isolates_the_document_that_was_running(executors):
+    with main.ExtractionPool(max_workers=2, warm=False) as pool:
+        poison = pool.submit(os._exit, 1)
+        others = [pool.submit(time.sleep, 0.05) for _ in range(29)]
+        with pytest.raises(BrokenProcessPool):
+            poison.result(timeout=60)
+        assert [future.result(timeout=60) for future in others] == [None] * 29
+
+    shared, isolated = executors.count(2), executors.count(1)
+    assert shared == 2 # the generation the crash broke and the one that took over its queued work
+    # the poison's second and last try, at most one document that happened to be running next to it
+    assert 1 <= isolated <= 2
+
+
+def test_recycles_workers_after_max_tasks(executors):
+    with main.ExtractionPool(max_workers=2, max_tasks_per_child=3, warm=False) as pool:
+        futures = [pool.submit(os.getpid) for _ in range(12)]
+        pids = collections.Counter(future.result(timeout=60) for future in futures)
+    assert executors.count(2) >= 2
+    # a generation may leave one of its workers idle, but no worker outlives its documents for the whole run
+    assert len(pids) >= 2 and max(pids.values()) < 12
+
+
+@pytest.fixture
+def slow_pages(monkeypatch):
+    """Fake page OCR that records how many pages run at once."""
+    state = {"running": 0, "peak": 0}
+    lock = threading.Lock()
+
+    def ocr_scan_page(filepath, mime_type, page_number):
+        with lock:
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+        time.sleep(0.05)
+        with lock:
+            state["running"] -= 1
+        return f"page {page_number}"
+
+    monkeypatch.setattr(main, "ocr_scan_page", ocr_scan_page)
+    return state
+
+
+def test_pages_fan_out_onto_spare_cores_and_give_them_back(slow_pages):
+    cores = threading.BoundedSemaphore(4)
+    cores.acquire() # the worker's own core
+    pages = list(main.iter_ocr_pages("scan.tif", "image/tiff", 6, workers=8, cores=cores))
+    assert pages == [(number, f"page {number}") for number in range(1, 7)]
+    assert slow_pages["peak"] == 4
+    assert [cores.acquire(False) for _ in range(4)] == [True, True, True, False]
+
+
+def test_pages_run_one_at_a_time_when_every_core_is_busy(slow_pages):
+    cores = threading.BoundedSemaphore(2)
+    cores.acquire()
+    cores.acquire() # another worker is extracting a document
+    assert len(list(main.iter_ocr_pages("scan.tif", "image/tiff", 4, workers=8, cores=cores))) == 4
+    assert slow_pages["peak"] == 1
@@ -0,0 +1,77 @@
+import json
+import os
+
+import pytest
+
+import main
+
+
+class Crash(Exception):
+    pass
+
+
+def write_index(folder, records, max_entries=3):
+    writer = main.IndexWriter(str(folder), max_entries=max_entries, max_bytes=None)
+    for number in range(records):
+        writer.append({"member_name": f"Member {number}", "member_number": str(number), "doc_date": "2025-01-01"})
+    return writer
+
+
+def indexed_numbers(folder):
+    numbers = []
+    for shard_path in main.list_shard_files(str(folder)):
+        with open(shard_path) as f:
+            numbers.extend(json.loads(line)["member_number"] for line in f if line.strip())
+    return sorted(numbers, key=int)
+
+
+def crash_on_replace(monkeypatch, nth):
+    """Makes the nth os.replace call of the compaction raise, like the process dying at that point."""
+    real_replace = os.replace
+    calls = {"count": 0}
+
+    def replace(src, dst):
+        calls["count"] += 1
+        if calls["count"] == nth:
+            raise Crash(f"crashed on os.replace #{nth}")
+        return real_replace(src, dst)
+
+    monkeypatch.setattr(main.os, "replace", replace)
+    return calls
+
+
+@pytest.fixture(autouse=True)
+def no_columnar(monkeypatch):
+    monkeypatch.setattr(main, "INDEX_COLUMNAR", False)
+
+
+def test_compact_merges_shards_without_losing_records(tmp_path):
+    write_index(tmp_path, 10)
+    assert len(main.list_shard_files(str(tmp_path))) == 4
+    old_count, new_count, records = main.IndexWriter(str(tmp_path), max_entries=None, max_bytes=None).compact()
+    assert (old_count, new_count, records) == (4, 1, 10)
+    assert indexed_numbers(tmp_path) == [str(number) for number in range(10)]
+
+
+@pytest.mark.parametrize("nth", range(1, 10))
+def test_a_crash_at_any_point_of_the_swap_loses_nothing(tmp_path, monkeypatch, nth):
+    write_index(tmp_path, 10)
+    calls = crash_on_replace(monkeypatch, nth)
+    try:
+        main.IndexWriter(str(tmp_path), max_entries=4, max_bytes=None).compact()
+    except Crash:
+        pass
+    monkeypatch.undo()
+    if calls["count"] < nth:
+        pytest.skip("the compaction finished before this crash point")
+
+    # the next writer, appending or compacting, sees every record exactly once
+    writer = main.IndexWriter(str(tmp_path), max_entries=4, max_bytes=None)
+    writer.append({"member_name": "Member 10", "member_number": "10", "doc_date": "2025-01-01"})
+    assert indexed_numbers(tmp_path) == [str(number) for number in range(11)]
+    writer.compact()
+    assert indexed_numbers(tmp_path) == [str(number) for number in range(11)]
+    assert not os.path.exists(tmp_path / ".compact_new")
+    assert not os.path.exists(tmp_path / ".compact_old")
+    with open(tmp_path / main.INDEX_MANIFEST_NAME) as f:
+        assert sum(shard["records"] for shard in json.load(f)["shards"]) == 11
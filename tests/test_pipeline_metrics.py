@@ -0,0 +1,36 @@
+import json
+
+import main
+
+
+def test_export_combines_processes_and_keeps_counting_across_restarts(tmp_path):
+    store = main.MetricsStore(str(tmp_path / "metrics.sqlite3"))
+    paths = {"json_path": str(tmp_path / "metrics.json"), "prom_path": str(tmp_path / "metrics.prom"),
+             "store": store, "process_dir": str(tmp_path / "processes")}
+
+    dashboard, worker = main.PipelineMetrics(), main.PipelineMetrics()
+    dashboard.increment("llm_calls_total", 2)
+    dashboard.record("llm", "application/pdf", 1.0)
+    worker.increment("llm_calls_total", 3)
+    worker.increment("preclassifier_accepted_total")
+    for _ in range(3):
+        worker.record("llm", "application/pdf", 2.0)
+
+    dashboard.export(**paths)
+    worker.export(**paths)
+    dashboard.export(**paths) # only what changed since the last export is added again
+
+    with open(paths["json_path"]) as f:
+        merged = json.load(f)
+    assert merged["processes"] == 2
+    assert merged["counters"] == {"llm_calls_total": 5, "preclassifier_accepted_total": 1}
+    [llm] = merged["stages"]
+    assert llm["count"] == 4
+    assert llm["mean_ms"] == 1750.0
+    assert llm["p95_ms"] == 2000.0
+
+    restarted = main.PipelineMetrics()
+    restarted.increment("llm_calls_total")
+    restarted.export(**paths)
+    assert store.totals()["llm_calls_total"] == 6
+    assert main.preclassifier_report(store.totals())["llm_calls_saved"] == 1
@@ -0,0 +1,91 @@
+import random
+
+import pytest
+
+import main
+
+WORDS = {
+    "Loans": ["loan", "borrower", "principal", "interest", "repayment", "collateral", "installment", "lender"],
+    "Statements": ["statement", "balance", "deposit", "withdrawal", "period", "opening", "closing", "transaction"],
+}
+COMMON = ["member", "credit", "union", "account", "page", "date"]
+
+
+def document(category, rng, extra=""):
+    words = rng.choices(WORDS[category], k=30) + rng.choices(COMMON, k=10)
+    rng.shuffle(words)
+    return " ".join(words) + " " + extra
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    search = main.SearchIndex(str(tmp_path / "search_index.sqlite3"))
+    monkeypatch.setattr(main, "search_index", search)
+    return search
+
+
+def add_documents(search, category, count, label_source, rng, text_category=None, loan_type=None):
+    for number in range(count):
+        entry = {"category_name": category, "confidence_score": 0.95, "member_name": "Jane Doe", "member_number": "123456",
+                 "loan_type": loan_type, "file_loc": f"./classified_output/{category}/{label_source}_{number}_{rng.random()}.pdf"}
+        search.add(entry, document(text_category or category, rng), label_source)
+
+
+def test_fit_predicts_the_closest_category():
+    rng = random.Random(0)
+    model = main.LocalPreClassifier.fit([(category, document(category, rng)) for category in WORDS for _ in range(10)])
+    category, margin = model.predict(document("Loans", rng))
+    assert category == "Loans" and margin > 0
+    assert model.predict("nothing in common") == (None, 0.0)
+
+
+def test_margin_threshold_is_the_lowest_that_keeps_agreement():
+    predictions = [(0.9, True), (0.8, True), (0.7, True), (0.6, False), (0.5, True)]
+    assert main.choose_margin_threshold(predictions, target_agreement=1.0, min_accepted=2) == (0.7, 0.6, 1.0)
+    assert main.choose_margin_threshold(predictions, target_agreement=0.8, min_accepted=2) == (0.5, 1.0, 0.8)
+    assert main.choose_margin_threshold(predictions, target_agreement=1.0, min_accepted=4)[0] is None
+
+
+def test_training_ignores_the_preclassifiers_own_labels(index, tmp_path):
+    rng = random.Random(1)
+    add_documents(index, "Loans", 60, "llm", rng)
+    add_documents(index, "Statements", 50, "llm", rng)
+    add_documents(index, "Statements", 10, "manual", rng)
+    # wrong guesses the local model filed itself, and rows from before label sources were recorded
+    add_documents(index, "Loans", 100, "local", rng, text_category="Statements")
+    add_documents(index, "Loans", 20, None, rng, text_category="Statements")
+
+    report = main.train_preclassifier(str(tmp_path / "preclassifier.json"), search=index)
+    assert report["training_documents"] == 120
+    assert report["categories"] == {"Loans": 60, "Statements": 60}
+    assert report["overall_agreement"] == 1.0
+    assert report["margin_threshold"] is not None
+
+
+def test_preclassify_files_only_documents_of_a_known_member(index, tmp_path, monkeypatch):
+    rng = random.Random(2)
+    add_documents(index, "Loans", 40, "llm", rng, loan_type="Auto Loan")
+    add_documents(index, "Statements", 40, "llm", rng)
+    model_path = str(tmp_path / "preclassifier.json")
+    main.train_preclassifier(model_path, search=index)
+    model = main.LocalPreClassifier.load(model_path)
+    model.margin_threshold = 0.0
+    monkeypatch.setattr(main, "get_preclassifier", lambda: model)
+
+    category, result = main.preclassify(document("Loans", rng, extra="member 123456 auto loan dated 2025-03-01"))
+    assert category == "Loans"
+    assert (result.member_number, result.member_name, result.loan_type, result.doc_date) == ("123456", "Jane Doe", "Auto Loan", "2025-03-01")
+
+    # a number that isn't a known member is escalated to the LLM
+    assert main.preclassify(document("Loans", rng, extra="member 999999")) == ("Loans", None)
+
+
+def test_known_loan_types_are_cached_but_see_new_entries(index):
+    index.add({"category_name": "Loans", "loan_type": "Auto Loan", "file_loc": "a.pdf"}, "text", "llm")
+    assert index.known_loan_types() == ["Auto Loan"]
+    connects = []
+    real_connect = index._connect
+    index._connect = lambda: connects.append(1) or real_connect()
+    index.add({"category_name": "Loans", "loan_type": "Mortgage", "file_loc": "b.pdf"}, "text", "llm")
+    assert sorted(index.known_loan_types()) == ["Auto Loan", "Mortgage"]
+    assert len(connects) == 1 # the add itself, the list came from the cache
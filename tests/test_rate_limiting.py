@@ -0,0 +1,108 @@
+import time
+
+import httpx
+import openai
+import pytest
+
+import main
+
+
+class FakeClock:
+    """Stands in for the time module in main: monotonic() only moves when something sleeps."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(main, "time", clock)
+    monkeypatch.setattr(main, "pipeline_metrics", main.PipelineMetrics())
+    return clock
+
+
+def api_error(error_class, status_code, headers=None):
+    response = httpx.Response(status_code, headers=headers or {}, request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+    return error_class("error", response=response, body=None)
+
+
+def scripted(outcomes):
+    """A model call that raises or returns the next outcome each time, and counts its calls."""
+    calls = []
+
+    def call():
+        calls.append(1)
+        outcome = outcomes[min(len(calls), len(outcomes)) - 1]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    return call, calls
+
+
+def test_request_budget_is_a_sliding_window(clock):
+    limiter = main.RateLimiter(requests_per_minute=3, tokens_per_minute=None)
+    sent_at = []
+    for _ in range(7):
+        limiter.acquire()
+        sent_at.append(clock.now - 1000.0)
+    assert sent_at == [0, 0, 0, 60, 60, 60, 120]
+
+
+def test_token_budget_waits_for_enough_tokens_to_expire(clock):
+    limiter = main.RateLimiter(requests_per_minute=None, tokens_per_minute=1000)
+    assert limiter.acquire(400) == 0
+    clock.sleep(10)
+    assert limiter.acquire(400) == 0
+    assert limiter.acquire(400) == 50 # the first call has to slide out of the window
+    # bigger than the whole budget: charged as the full budget instead of waiting forever
+    assert limiter.acquire(5000) == 60
+
+
+def test_pause_holds_back_the_next_caller(clock):
+    limiter = main.RateLimiter(requests_per_minute=None, tokens_per_minute=None)
+    limiter.pause(5)
+    assert limiter.acquire() == 5
+
+
+def test_429s_are_retried_no_sooner_than_retry_after(clock):
+    scheduler = main.LLMScheduler(main.RateLimiter(None, None), max_retries=3, backoff_base=0.001)
+    rate_limited = api_error(openai.RateLimitError, 429, {"retry-after": "7"})
+    call, calls = scripted([rate_limited, rate_limited, "result"])
+    timings = {}
+    assert scheduler.run(call, timings=timings) == "result"
+    assert len(calls) == 3
+    assert timings["llm_wait"] >= 14
+    counters = main.pipeline_metrics.snapshot()["counters"]
+    assert counters["llm_rate_limited_total"] == 2
+    assert counters["llm_retries_total"] == 2
+
+
+def test_non_transient_errors_are_not_retried(clock):
+    scheduler = main.LLMScheduler(main.RateLimiter(None, None), max_retries=3)
+    call, calls = scripted([api_error(openai.BadRequestError, 400)])
+    with pytest.raises(openai.BadRequestError):
+        scheduler.run(call)
+    assert len(calls) == 1
+    assert clock.slept == []
+
+
+def test_gives_up_after_max_retries_with_the_last_error(clock):
+    scheduler = main.LLMScheduler(main.RateLimiter(None, None), max_retries=2, backoff_base=0.01)
+    call, calls = scripted([api_error(openai.InternalServerError, 500)])
+    with pytest.raises(openai.InternalServerError):
+        scheduler.run(call)
+    assert len(calls) == 3
+    assert main.pipeline_metrics.snapshot()["counters"]["llm_failures_total"] == 1
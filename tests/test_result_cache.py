@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+import main
+
+
+class FakeClock:
+    """Stands in for the time module in main so entries can be aged without waiting."""
+
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(main, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def cache(tmp_path, clock):
+    return main.ResultCache(str(tmp_path / "result_cache.sqlite3"), max_entries=2, max_age_days=1)
+
+
+def result(confidence=0.95, **fields):
+    return main.DocumentClassificationResult(category_name="Loans", confidence_score=confidence, member_name="Jane Doe",
+                                             member_number="123456", **fields)
+
+
+def test_hits_and_misses_are_counted(cache):
+    cache.put("a", result(file_loc="./classified_output/Loans/a.pdf"))
+    cached = cache.get("a")
+    assert cached.category_name == "Loans"
+    assert cached.file_loc is None # where the first copy was filed means nothing for the next one
+    assert cache.get("b") is None
+    assert cache.stats() == {"hits": 1, "misses": 1, "entries": 1, "hit_rate": 0.5}
+
+
+def test_low_confidence_results_are_not_cached(cache):
+    cache.put("a", result(confidence=0.5))
+    assert cache.stats()["entries"] == 0
+
+
+def test_a_low_confidence_entry_counts_as_a_miss(cache):
+    # written before put refused low confidence results
+    conn = cache._connect()
+    with conn:
+        conn.execute("INSERT INTO results (content_hash, result_json, created_at, last_used) VALUES (?, ?, ?, ?)",
+                     ("a", result(confidence=0.5).model_dump_json(), main.time.time(), main.time.time()))
+    conn.close()
+    assert cache.get("a") is None
+    assert cache.stats()["misses"] == 1 and cache.stats()["hits"] == 0
+
+
+def test_expired_entries_miss_and_are_evicted(cache, clock):
+    cache.put("old", result())
+    clock.now += 86400 + 1
+    assert cache.get("old") is None
+    cache.put("new", result())
+    assert cache.stats()["entries"] == 1
+
+
+def test_least_recently_used_entry_is_evicted(cache, clock):
+    cache.put("a", result())
+    clock.now += 1
+    cache.put("b", result())
+    clock.now += 1
+    assert cache.get("a") is not None # now more recently used than b
+    clock.now += 1
+    cache.put("c", result())
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
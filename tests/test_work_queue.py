@@ -0,0 +1,181 @@
+import os
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return main.WorkQueue(str(tmp_path / "work_queue.sqlite3"), lease_seconds=60, max_attempts=2)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Runs the test inside tmp_path with its own search index, so filing a document doesn't touch the real output."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, "search_index", main.SearchIndex(str(tmp_path / "search_index.sqlite3")))
+    os.makedirs("input")
+    os.makedirs("exceptions")
+    return tmp_path
+
+
+def make_file(folder, name, content=b"document"):
+    path = os.path.join(folder, name)
+    with open(path, "wb") as f:
+        f.write(content)
+    return os.path.abspath(path)
+
+
+def expire_leases(queue):
+    queue._update("UPDATE jobs SET lease_expires = 0 WHERE state = 'running'", ())
+
+
+def job_row(queue, job_id):
+    conn = queue._connect()
+    try:
+        return dict(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+    finally:
+        conn.close()
+
+
+def test_enqueue_ignores_files_already_pending(queue, tmp_path):
+    path = make_file(tmp_path, "a.pdf")
+    assert queue.enqueue(path) is not None
+    assert queue.enqueue(path) is None
+    assert queue.counts()["pending"] == 1
+
+
+def test_claim_leases_jobs_to_one_owner(queue, tmp_path):
+    for name in ("a.pdf", "b.pdf", "c.pdf"):
+        queue.enqueue(make_file(tmp_path, name))
+    first = queue.claim("worker-1", limit=2)
+    second = queue.claim("worker-2", limit=5)
+    assert [job.row["filename"] for job in first] == ["a.pdf", "b.pdf"]
+    assert [job.row["filename"] for job in second] == ["c.pdf"]
+    assert all(job.row["state"] == "running" and job.row["attempts"] == 1 for job in first + second)
+    assert queue.claim("worker-3") == []
+
+
+def test_expired_lease_is_taken_over_and_the_old_owner_loses_it(queue, tmp_path):
+    queue.enqueue(make_file(tmp_path, "a.pdf"))
+    [job] = queue.claim("dead-worker")
+    expire_leases(queue)
+    [taken] = queue.claim("worker-2")
+    assert taken.id == job.id and taken.row["attempts"] == 2
+    with pytest.raises(RuntimeError):
+        job.checkpoint(stage="classified")
+    taken.checkpoint(stage="classified")
+    assert job_row(queue, job.id)["stage"] == "classified"
+
+
+def test_renew_keeps_a_lease_alive(queue, tmp_path):
+    queue.enqueue(make_file(tmp_path, "a.pdf"))
+    [job] = queue.claim("worker-1")
+    expire_leases(queue)
+    queue.renew([job.id], "worker-1")
+    assert queue.claim("worker-2") == []
+
+
+def test_release_hands_jobs_back_with_their_checkpoint(queue, tmp_path):
+    queue.enqueue(make_file(tmp_path, "a.pdf"))
+    [job] = queue.claim("worker-1")
+    job.checkpoint(stage="classified", result_json="{}")
+    assert queue.release("worker-1") == 1
+    row = job_row(queue, job.id)
+    assert (row["state"], row["stage"], row["attempts"], row["lease_owner"]) == ("pending", "classified", 0, None)
+    [again] = queue.claim("worker-2")
+    assert again.row["stage"] == "classified"
+
+
+def test_finish_only_applies_to_the_lease_owner(queue, tmp_path):
+    queue.enqueue(make_file(tmp_path, "a.pdf"))
+    [job] = queue.claim("worker-1")
+    queue.finish(job.id, "someone-else", True, "done")
+    assert job_row(queue, job.id)["state"] == "running"
+    queue.finish(job.id, "worker-1", True, "done")
+    assert queue.counts()["done"] == 1
+
+
+def test_exhausted_jobs_are_failed_instead_of_claimed(queue, tmp_path):
+    queue.enqueue(make_file(tmp_path, "a.pdf"))
+    for _ in range(queue.max_attempts):
+        assert queue.claim("crashing-worker")
+        expire_leases(queue)
+    assert queue.claim("worker-2") == []
+    [row] = queue.fail_exhausted()
+    assert row["filename"] == "a.pdf"
+    assert queue.counts()["failed"] == 1
+    assert queue.fail_exhausted() == []
+
+
+def test_failed_file_is_not_queued_again_until_it_changes(queue, tmp_path):
+    path = make_file(tmp_path, "a.pdf")
+    queue.enqueue(path)
+    [job] = queue.claim("worker-1")
+    queue.finish(job.id, "worker-1", False, "Exception")
+    assert queue.enqueue(path) is None
+    later = job_row(queue, job.id)["updated_at"] + 10
+    os.utime(path, (later, later))
+    assert queue.enqueue(path) is not None
+
+
+def test_drain_moves_files_the_queue_gave_up_on_to_exceptions(queue, workdir):
+    path = make_file("input", "poison.pdf")
+    queue.enqueue(path)
+    for _ in range(queue.max_attempts):
+        queue.claim("crashing-worker")
+        expire_leases(queue)
+    assert list(main.drain_queue("exceptions", queue=queue)) == []
+    assert os.listdir("input") == []
+    assert os.listdir("exceptions") == ["poison.pdf"]
+    assert queue.enqueue_folder("input") == 0
+
+
+def test_resume_after_a_crash_mid_move(queue, workdir):
+    path = make_file("input", "a.pdf")
+    queue.enqueue(path)
+    [job] = queue.claim("dead-worker")
+    result = main.DocumentClassificationResult(category_name="Loans", confidence_score=0.95, member_name="Jane Doe", member_number="123")
+    job.checkpoint(stage="classified", result_json=result.model_dump_json())
+    job.checkpoint(stage="moving", destination=os.path.join("./classified_output", "Loans", "123_a.pdf"))
+    os.makedirs(os.path.join("classified_output", "Loans"))
+    os.replace(path, os.path.join("classified_output", "Loans", "123_a.pdf")) # the move happened, the checkpoint after it didn't
+
+    expire_leases(queue)
+    [resumed] = queue.claim("worker-2")
+    success, message = main.resume_job(resumed, "exceptions")
+    assert success, message
+    assert job_row(queue, job.id)["stage"] == "indexed"
+    assert main.search_index.contains(os.path.join("./classified_output", "Loans", "123_a.pdf"))
+
+
+def test_resume_an_interrupted_exception(queue, workdir):
+    path = make_file("input", "a.pdf")
+    queue.enqueue(path)
+    [job] = queue.claim("dead-worker")
+    job.checkpoint(stage="excepting", error="Confidence score too low")
+    expire_leases(queue)
+    [resumed] = queue.claim("worker-2")
+    success, _ = main.resume_job(resumed, "exceptions")
+    assert not success
+    assert os.listdir("exceptions") == ["a.pdf"]
+
+
+def test_cancelled_files_stay_out_of_the_queue_until_requeued(queue, workdir):
+    path = make_file("input", "a.pdf")
+    queue.enqueue(path)
+    assert queue.cancel_pending() == 1
+    assert queue.enqueue_folder("input") == 0
+    assert queue.requeue_cancelled() == 1
+    assert queue.requeue_cancelled() == 0
+    [job] = queue.claim("worker-1")
+    assert job.row["filepath"] == path and job.row["attempts"] == 1
+
+
+def test_requeue_skips_cancelled_files_that_were_removed(queue, tmp_path):
+    path = make_file(tmp_path, "a.pdf")
+    queue.enqueue(path)
+    queue.cancel_pending()
+    os.remove(path)
+    assert queue.requeue_cancelled() == 0